@@ -1,7 +1,9 @@
 import backend.tm.TransactionManager as TransactionManager
 import backend.dm.DataManager as DataManager
+import backend.dm.logger.Logger as Logger
 from backend.vm.VersionManager import VersionManager
 import backend.tbm.TableManager as TableManager
+import backend.tbm.Upgrade as Upgrade
 from backend.server.Server import Server
 from argparse import ArgumentParser
 
@@ -15,17 +17,25 @@ def createDB(path: str) -> None:
     tm = TransactionManager.create(path)
     dm = DataManager.create(path, DEFALUT_MEM, tm)
     vm = VersionManager(tm, dm)
-    TableManager.create(path, vm, dm)
+    tbm = TableManager.create(path, vm, dm)
+    tbm.booter.close()
     dm.close()
+    tm.close()
 
-def openDB(path: str, mem = DEFALUT_MEM) -> None:
+def openDB(path: str, mem = DEFALUT_MEM, useMmap = False, synchronousCommit = True, archiveDir = None) -> None:
+    DataManager.checkFormat(path)
     tm = TransactionManager.fileopen(path)
-    dm = DataManager.fileopen(path, mem, tm)
-    vm = VersionManager(tm, dm)
+    archive = Logger.archiveToDirectory(archiveDir) if archiveDir else None
+    dm = DataManager.fileopen(path, mem, tm, useMmap, walArchive = archive)
+    vm = VersionManager(tm, dm, synchronousCommit)
     tbm = TableManager.fileopen(path, vm, dm)
     server = Server(port, tbm)
     server.start()
 
+def upgradeDB(oldPath: str, path: str, mem = DEFALUT_MEM) -> None:
+    count = Upgrade.upgrade(oldPath, path, mem)
+    print("Upgraded " + str(count) + " rows from " + oldPath + " to " + path)
+
 def parseMem(memStr: str) -> int:
     if memStr is None or memStr == "":
         return DEFALUT_MEM
@@ -47,19 +57,25 @@ creat a database:
 python Launcher_server.py -create "C:/Users/91026/Desktop/vscode/py/LDBMS/tmp/ldbms"
 start the database:
 python Launcher_server.py -open "C:/Users/91026/Desktop/vscode/py/LDBMS/tmp/ldbms"
+upgrade a database of the old format into a new database:
+python Launcher_server.py -upgrade "C:/Users/91026/Desktop/vscode/py/LDBMS/tmp/ldbms" -create "C:/Users/91026/Desktop/vscode/py/LDBMS/tmp/ldbms2"
 '''
 
 if __name__ == "__main__":
-#    createDB("C:/Users/91026/Desktop/vscode/py/LDBMS/tmp/ldbms")
-    openDB("C:/Users/91026/Desktop/vscode/py/LDBMS/tmp/ldbms", DEFALUT_MEM)
     parser = ArgumentParser(description="Database Launcher")
     parser.add_argument("-open", type=str, help="Open existing database at DBPath")
     parser.add_argument("-create", type=str, help="Create new database at DBPath")
-    parser.add_argument("-mem", type=str, default="64MB", help="Memory size (default: 64MB)")
+    parser.add_argument("-upgrade", type=str, help="Dump the old-format database at this path and reload it into the database given by -create")
+    parser.add_argument("-mem", type=str, default="64MB", help="Buffer pool size (default: 64MB)")
+    parser.add_argument("-mmap", action="store_true", help="Access the data file through a private copy-on-write mmap; modified pages keep an anonymous copy until evicted, so memory stays bounded by -mem")
+    parser.add_argument("-asynccommit", action="store_true", help="Return from commit before the commit record is flushed")
+    parser.add_argument("-archive", type=str, help="Copy finished log segments into this directory")
     args = parser.parse_args()
     if args.open:
-        openDB(args.open, parseMem(args.mem))
+        openDB(args.open, parseMem(args.mem), args.mmap, not args.asynccommit, args.archive)
+    elif args.create and args.upgrade:
+        upgradeDB(args.upgrade, args.create, parseMem(args.mem))
     elif args.create:
         createDB(args.create)
     else:
-        print("Usage: launcher -open DBPath | -create DBPath [-mem MemorySize]")
+        print("Usage: launcher -open DBPath | -create DBPath [-upgrade OldDBPath] [-mem MemorySize] [-mmap] [-asynccommit] [-archive Dir]")
@@ -1,9 +1,16 @@
 from abc import ABC, abstractmethod
-import traceback
-import time
+from collections import OrderedDict
 import threading
 
-class AbstractClass(ABC):
+# 缓存按 key 的哈希值分成若干条带, 每个条带有自己的锁, 不同条带上的访问互不阻塞
+CACHE_STRIPES = 16
+# 有容量限制时, 每个条带至少分到的资源数, 避免条带太小导致被引用的资源挤满条带
+MIN_STRIPE_RESOURCES = 8
+
+class CacheStripe(object):
+    '''
+    缓存的一个条带, 字段含义与整个缓存相同, 由 cond 保护
+    '''
     def __init__(self, maxResources: int):
         self.maxResources = maxResources
         # 获取资源的操作个数
@@ -12,92 +19,206 @@ class AbstractClass(ABC):
         self.cache = {}
         # 资源的引用个数
         self.references = {}
-        # 资源正在被获取
+        # 资源正在被获取或写回, 等待的线程在 cond 上阻塞
         self.getting = {}
-        self.lock = threading.RLock()
+        # 已经被驱逐还没有写回完成的资源
+        self.evicting = {}
+        # CLOCK 置换算法的环: key -> 访问位, 环首即为时钟指针所指的位置
+        self.clock = OrderedDict()
+        self.cond = threading.Condition()
+        # 预读进来还没有被访问过的资源
+        self.prefetched = set()
+        # 命中, 未命中, 预读的次数, 以及预读的资源后来被访问到的次数
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.prefetchHits = 0
+
+class AbstractClass(ABC):
+    def __init__(self, maxResources: int, keepUnpinned: bool = False):
+        self.maxResources = maxResources
+        # 引用个数降为 0 的资源是否继续留在缓存中, 直到被置换算法驱逐
+        self.keepUnpinned = keepUnpinned
+        stripes = CACHE_STRIPES
+        if maxResources > 0:
+            stripes = max(1, min(CACHE_STRIPES, maxResources // MIN_STRIPE_RESOURCES))
+        # 容量平均分给各个条带, 余数分给前面的条带
+        self.stripes = []
+        for i in range(stripes):
+            limit = 0
+            if maxResources > 0:
+                limit = maxResources // stripes + (1 if i < maxResources % stripes else 0)
+            self.stripes.append(CacheStripe(limit))
+
+    def stripeOf(self, key: int) -> CacheStripe:
+        return self.stripes[hash(key) % len(self.stripes)]
 
     def get(self, key: int) -> any:
         '''
         获取资源,检查目的资源是否存在读取冲突等情况
+        缓存已满时, 用 CLOCK 算法驱逐一个没有被引用的资源
         '''
-        while 1:
-            self.lock.acquire()
-            # 请求的资源正在被其它进程获取
-            if key in self.getting:
-                self.lock.release()
-                try:
-                    time.sleep(0.001)
-                except Exception as e:
-                    traceback.print_exc()
-                    continue
-                continue
+        return self.fetch(key, True)
+
+    def preload(self, key: int) -> bool:
+        '''
+        把资源读入缓存但不持有引用, 用于预读, 只适用于 keepUnpinned 的缓存
+        资源已经在缓存中, 正在被其它线程读取, 或者缓存中没有可以驱逐的资源时什么也不做
+        '''
+        return self.fetch(key, False) is not None
+
+    def fetch(self, key: int, pin: bool) -> any:
+        '''
+        pin 为 True 时获取资源并持有一个引用, 否则只把资源读入缓存
+        '''
+        stripe = self.stripeOf(key)
+        victim = None
+        with stripe.cond:
+            # 请求的资源正在被其它线程获取或写回, 等待其完成
+            while key in stripe.getting:
+                if not pin:
+                    return None
+                stripe.cond.wait()
             # 资源在缓存中
-            if key in self.cache:
-                obj = self.cache.get(key)
-                self.references[key] += 1
-                self.lock.release()
-                return obj
+            if key in stripe.cache:
+                if not pin:
+                    return None
+                stripe.hits += 1
+                if key in stripe.prefetched:
+                    stripe.prefetched.discard(key)
+                    stripe.prefetchHits += 1
+                stripe.references[key] += 1
+                if self.keepUnpinned:
+                    stripe.clock[key] = True
+                return stripe.cache[key]
             # 获取操作大于资源数
-            if self.maxResources > 0 and self.count == self.maxResources:
-                self.lock.release()
-                raise Exception("CacheFullException")
+            if stripe.maxResources > 0 and stripe.count == stripe.maxResources:
+                victim = self.evict(stripe)
+                if victim is None:
+                    if not pin:
+                        return None
+                    raise Exception("CacheFullException")
+                # 被驱逐的资源写回之前, 其它线程不能重新读取它
+                stripe.getting[victim[0]] = True
+                stripe.evicting[victim[0]] = victim[1]
             # 不在缓存中的资源, 从数据源中读取
-            self.count += 1
-            self.getting[key] = True
-            self.lock.release()
-            break
+            if pin:
+                stripe.misses += 1
+            else:
+                stripe.prefetches += 1
+            stripe.count += 1
+            stripe.getting[key] = True
         obj = None
         try:
+            if victim is not None:
+                try:
+                    self.releaseForCache(victim[1])
+                finally:
+                    with stripe.cond:
+                        stripe.getting.pop(victim[0], None)
+                        stripe.evicting.pop(victim[0], None)
+                        stripe.cond.notify_all()
             obj = self.getForCache(key)
         except Exception as e:
-            self.lock.acquire()
-            try:
-                self.count -= 1
-                self.getting.pop(key, None)
-            finally:
-                self.lock.release()
+            with stripe.cond:
+                stripe.count -= 1
+                stripe.getting.pop(key, None)
+                stripe.cond.notify_all()
             raise e
-        self.lock.acquire()
-        try:
-            self.getting.pop(key, None)
-            self.cache[key] = obj
-            self.references[key] = 1
-        finally:
-            self.lock.release()
+        with stripe.cond:
+            stripe.getting.pop(key, None)
+            stripe.cache[key] = obj
+            # 预读的资源访问位为 0, 没有被用到时会最先被驱逐
+            stripe.references[key] = 1 if pin else 0
+            if self.keepUnpinned:
+                stripe.clock[key] = pin
+            if not pin:
+                stripe.prefetched.add(key)
+            stripe.cond.notify_all()
         return obj
-    
+
+    def evict(self, stripe: CacheStripe) -> tuple | None:
+        '''
+        CLOCK 置换: 从时钟指针处开始扫描, 跳过仍被引用的资源
+        访问位为 1 的资源清零后给予第二次机会, 访问位为 0 的资源被驱逐
+        调用者需要持有条带的锁, 返回 (key, obj), 找不到可驱逐的资源时返回 None
+        '''
+        for _ in range(2 * len(stripe.clock)):
+            key, referenced = next(iter(stripe.clock.items()))
+            stripe.clock.move_to_end(key)
+            if stripe.references[key] > 0:
+                continue
+            if referenced:
+                stripe.clock[key] = False
+                continue
+            obj = stripe.cache.pop(key)
+            stripe.references.pop(key, None)
+            stripe.clock.pop(key, None)
+            stripe.prefetched.discard(key)
+            stripe.count -= 1
+            return (key, obj)
+        return None
+
     def release(self, key: int) -> None:
         '''
         释放资源
         '''
-        self.lock.acquire()
-        try:
-            ref = self.references[key] - 1
-            # 资源没有引用了, 清除掉
-            if ref == 0:
-                obj = self.cache[key]
+        stripe = self.stripeOf(key)
+        with stripe.cond:
+            ref = stripe.references[key] - 1
+            # 资源没有引用了, 清除掉或留给置换算法处理
+            if ref == 0 and not self.keepUnpinned:
+                obj = stripe.cache[key]
                 self.releaseForCache(obj)
-                self.references.pop(key, None)
-                self.cache.pop(key, None)
-                self.count -= 1
+                stripe.references.pop(key, None)
+                stripe.cache.pop(key, None)
+                stripe.count -= 1
             else:
-                self.references[key] = ref
-        finally:
-            self.lock.release()
-    
+                stripe.references[key] = ref
+
+    def referenceCount(self, key: int) -> int:
+        '''
+        资源当前的引用个数, 不在缓存中时为 0
+        '''
+        stripe = self.stripeOf(key)
+        with stripe.cond:
+            return stripe.references.get(key, 0)
+
+    def stats(self) -> dict:
+        '''
+        缓存的命中统计, 用来调整预读窗口等参数
+        '''
+        res = {'hits': 0, 'misses': 0, 'prefetches': 0, 'prefetchHits': 0}
+        for stripe in self.stripes:
+            with stripe.cond:
+                res['hits'] += stripe.hits
+                res['misses'] += stripe.misses
+                res['prefetches'] += stripe.prefetches
+                res['prefetchHits'] += stripe.prefetchHits
+        return res
+
+    def cachedObjects(self) -> list:
+        '''
+        当前缓存中所有资源的快照
+        '''
+        objs = []
+        for stripe in self.stripes:
+            with stripe.cond:
+                objs.extend(stripe.cache.values())
+        return objs
+
     def close(self) -> None:
         '''
         释放缓存中的所有数据
         '''
-        self.lock.acquire()
-        try:
-            for key in self.cache:
-                obj = self.cache[key]
-                self.releaseForCache(obj)
-                self.references.pop(key, None)
-                self.cache.pop(key, None)
-        finally:
-            self.lock.release()
+        for stripe in self.stripes:
+            with stripe.cond:
+                for key, obj in list(stripe.cache.items()):
+                    self.releaseForCache(obj)
+                    stripe.references.pop(key, None)
+                    stripe.cache.pop(key, None)
+                    stripe.clock.pop(key, None)
+                    stripe.count -= 1
 
     @abstractmethod
     def getForCache(key):
@@ -105,4 +226,4 @@ class AbstractClass(ABC):
 
     @abstractmethod
     def releaseForCache(obj):
-        pass
\ No newline at end of file
+        pass
@@ -0,0 +1,84 @@
+# 长期持有一个文件描述符, 用 pread/pwrite 按偏移量读写
+# 读写不依赖文件指针, 多个线程可以同时对同一个文件做定位读写, 不需要每次都重新打开文件
+import os
+import threading
+
+# Windows 等平台没有 pread/pwrite, 退化为加锁的 seek + read/write
+HAS_PREAD = hasattr(os, 'pread') and hasattr(os, 'pwrite')
+# 没有 posix_fallocate 的平台用扩展文件长度代替预分配
+HAS_FALLOCATE = hasattr(os, 'posix_fallocate')
+
+class RandomAccessFile(object):
+    def __init__(self, file: str, create: bool = False):
+        flags = os.O_RDWR | getattr(os, 'O_BINARY', 0)
+        if create:
+            flags |= os.O_CREAT
+        self.file = file
+        self.fd = os.open(file, flags, 0o644)
+        self.seekLock = threading.Lock()
+
+    def read(self, offset: int, length: int) -> bytes:
+        '''
+        从 offset 处读取 length 个字节, 读到文件末尾时返回的数据会变短
+        '''
+        if not HAS_PREAD:
+            with self.seekLock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                return os.read(self.fd, length)
+        buf = os.pread(self.fd, length, offset)
+        if len(buf) == length or len(buf) == 0:
+            return buf
+        chunks = [buf]
+        got = len(buf)
+        while got < length:
+            buf = os.pread(self.fd, length - got, offset + got)
+            if len(buf) == 0:
+                break
+            chunks.append(buf)
+            got += len(buf)
+        return b''.join(chunks)
+
+    def write(self, offset: int, data: bytes | bytearray | memoryview) -> None:
+        '''
+        把 data 写到 offset 处
+        '''
+        if not HAS_PREAD:
+            with self.seekLock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[os.write(self.fd, view):]
+            return
+        view = memoryview(data)
+        while len(view) > 0:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    def size(self) -> int:
+        return os.fstat(self.fd).st_size
+
+    def truncate(self, size: int) -> None:
+        os.ftruncate(self.fd, size)
+
+    def allocate(self, offset: int, length: int) -> None:
+        '''
+        预先为 [offset, offset + length) 分配磁盘空间, 之后写入这段空间不会再扩展文件
+        '''
+        if HAS_FALLOCATE:
+            try:
+                os.posix_fallocate(self.fd, offset, length)
+                return
+            except OSError:
+                # 文件系统不支持预分配
+                pass
+        if self.size() < offset + length:
+            self.truncate(offset + length)
+
+    def sync(self) -> None:
+        os.fsync(self.fd)
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -1,32 +1,72 @@
+import threading
+import traceback
 from backend.dm.dataItem import DataItem
 from backend.dm.logger import Logger
 from backend.dm.page import PageOne
 from backend.dm.page import PageX
 from backend.dm.pageCache import PageCache
 from backend.dm.pageIndex import PageIndex
+from backend.dm.pageIndex.FreeSpaceMap import FreeSpaceMap
 from backend.common.AbstractCache import AbstractClass
 from backend.dm import Recover
-from backend.tm.TransactionManager import TransactionManager
+from backend.tm.TransactionManager import TransactionManager, SUPER_XID
+
+# 检查点线程默认的间隔(秒), 不大于 0 时不启动
+CHECKPOINT_INTERVAL = 60
 
 class DataManager(AbstractClass):
     def __init__(self, pc: PageCache.PageCache, logger: Logger.Logger, tm: TransactionManager):
         super().__init__(0)
         self.pc = pc
-        self.logger = logger
+        self.setLogger(logger)
         self.tm = tm
         self.pIndex = PageIndex.PageIndex()
         self.pageOne = None
+        self.fsm = None
+        # 事务 xid -> 该事务第一条日志位置的下界, 检查点用它确定撤销的起点
+        self.firstLogs = {}
+        self.firstLogsLock = threading.Lock()
+        # 最近一条异步提交日志的位置, 它落盘之前, TM 中已提交的事务在崩溃后仍可能被撤销
+        self.lastAsyncCommit = -1
+        self.checkpointLock = threading.Lock()
+        # 上一个检查点开始时的日志末尾, 在那之前变脏的页面在下一个检查点时写回
+        self.lastCheckpoint = 0
+        self.checkpointer = None
+        self.checkpointerStop = threading.Event()
         
+    def setLogger(self, logger: Logger.Logger) -> None:
+        self.logger = logger
+        # 写回页面之前先把日志刷到磁盘上
+        self.pc.logFlusher = logger.flush
+        self.pc.logTail = logger.tail
+
     def read(self, uid: int) -> DataItem.DataItem | None:
         '''
         通过 uid 地址获取对应的 DataItem
+        uid 指向的槽已经被释放或复用时返回 None
         '''
-        di = super().get(uid)
+        try:
+            di = super().get(uid)
+        except Exception as e:
+            if str(e) == "NullDataItemException":
+                return None
+            raise e
         if not di.isValid():
             di.release()
             return None
         return di
 
+    def prefetch(self, uids: list) -> None:
+        '''
+        提示之后会按顺序读取 uids, 异步预读它们所在的前 prefetchWindow 个页面
+        '''
+        pgnos = {}
+        for uid in uids:
+            if len(pgnos) >= self.pc.prefetchWindow:
+                break
+            pgnos[DataItem.parseUid(uid)[0]] = True
+        self.pc.prefetch(list(pgnos))
+
     def insert(self, xid: int, data: bytearray) -> int:
         '''
         在 pageIndex 中获取一个足以存储 data 的页号
@@ -36,42 +76,255 @@ class DataManager(AbstractClass):
         raw = DataItem.wrapDataItemRaw(data)
         if len(raw) > PageX.MAX_FREE_SPACE:
             raise Exception("DataTooLargeException")
-        pi = None
-        for i in range(5):
-            pi = self.pIndex.select(len(raw))
-            if pi != None:
-                break
-            else:
-                newPgno = self.pc.newPage(PageX.initRaw())
-                self.pIndex.add(newPgno, PageX.MAX_FREE_SPACE)
-        if pi == None:
-            raise Exception("DatabaseBusyException")
+        self.noteFirstLog(xid)
         pg = None
+        # 放不下的页面在这次插入结束前不放回 pageIndex, 避免反复选中它们
+        skipped = []
+        extents = 0
         try:
-            pg = self.pc.getPage(pi.pgno)
-            log = Recover.insertLog(xid, pg, raw)
-            self.logger.log(log)
-            offset = PageX.insert(pg, raw)
+            while pg == None:
+                pi = self.pIndex.select(len(raw))
+                if pi == None:
+                    if extents == 5:
+                        raise Exception("DatabaseBusyException")
+                    self.newExtent()
+                    extents += 1
+                    continue
+                try:
+                    pg = self.pc.getPage(pi.pgno)
+                except Exception as e:
+                    self.addPageIndex(pi.pgno, 0)
+                    raise e
+                pg.lock()
+                if self.makeRoom(pg, len(raw)):
+                    break
+                # pageIndex 中的信息已经过时, 或者页面正在被使用无法整理, 换一个页面
+                skipped.append((pi.pgno, PageX.getFreeSpace(pg)))
+                pg.unlock()
+                pg.release()
+                pg = None
+        finally:
+            for pgno, freeSpace in skipped:
+                self.addPageIndex(pgno, freeSpace)
+        freeSpace = 0
+        try:
+            # 写日志和写页面在页面锁内完成, 写回页面时不会看到写了日志却还没有插入的状态
+            slot, gen = PageX.nextSlot(pg)
+            uid = DataItem.uidOf(pg.pageNumber, slot, gen)
+            log = Recover.insertLog(xid, uid, raw)
+            pg.setDirty(True)
+            lsn = self.logger.log(log)
+            PageX.insert(pg, raw, slot, gen)
+            PageX.setLsn(pg, lsn)
+            freeSpace = PageX.getFreeSpace(pg)
+            return uid
+        finally:
+            pg.unlock()
             pg.release()
-            return pi.pgno << 32 | offset
+            self.addPageIndex(pg.pageNumber, freeSpace)
+
+    def newExtent(self) -> None:
+        '''
+        一次开一个区段的新页, 全部放入 pageIndex
+        '''
+        first = self.pc.newPages(PageX.initRaw(), PageCache.EXTENT_PAGES)
+        for pgno in range(first, first + PageCache.EXTENT_PAGES):
+            self.addPageIndex(pgno, PageX.MAX_FREE_SPACE)
+
+    def makeRoom(self, pg, length: int) -> bool:
+        '''
+        检查页面能否放下 length 字节的数据, 连续空间不够时整理页面
+        其它线程还引用着这个页面时, 可能持有指向页面内部的 DataItem, 不能整理
+        调用者需要持有页面锁
+        '''
+        if PageX.getContiguousFreeSpace(pg) >= length:
+            return True
+        if PageX.getFreeSpace(pg) < length:
+            return False
+        if self.pc.referenceCount(pg.pageNumber) > 1:
+            return False
+        PageX.compact(pg)
+        return True
+
+    def free(self, di: DataItem.DataItem) -> None:
+        '''
+        释放一个对所有事务都不再可见的 DataItem, 它占用的空间留给之后的插入
+        释放由超级事务完成, 恢复时总是重做
+        '''
+        pgno, slot, gen = DataItem.parseUid(di.uid)
+        pg = di.pg
+        pg.lock()
+        try:
+            if PageX.getItem(pg, slot, gen) == None:
+                return
+            pg.setDirty(True)
+            lsn = self.logger.log(Recover.freeLog(di))
+            di.setInvalid()
+            PageX.free(pg, slot)
+            PageX.setLsn(pg, lsn)
+            freeSpace = PageX.getFreeSpace(pg)
         finally:
-            if pg != None:
-                self.pIndex.add(pi.pgno, PageX.getFreeSpace(pg))
-            else:
-                self.pIndex.add(pi.pgno, 0)
+            pg.unlock()
+        self.pIndex.update(pgno, freeSpace)
+        self.fsm.update(pgno, freeSpace)
+
+    def addPageIndex(self, pgno: int, freeSpace: int) -> None:
+        '''
+        把页面放回 pageIndex, 并同步修改 FSM
+        '''
+        self.pIndex.add(pgno, freeSpace)
+        self.fsm.update(pgno, freeSpace)
     
     def close(self) -> None:
+        '''
+        先写回所有脏页面, 最后才写回带有正常关闭标记的 PageOne
+        '''
+        self.stopCheckpointer()
+        self.pc.stopBgWriter()
         super(DataManager, self).close()
+        self.pc.flushAll()
+        PageOne.setPageNumber_page(self.pageOne, self.pc.getPageNumber())
         PageOne.setVcClose_page(self.pageOne)
+        self.pc.flushPage(self.pageOne)
         self.pageOne.release()
         self.pc.close()
+        self.logger.close()
 
     def logDataItem(self, xid: int, di: DataItem.DataItem) -> None:
         '''
         把事务及 DataItem 打包成更新日志
         '''
         log = Recover.updateLog(xid, di)
-        self.logger.log(log)
+        self.noteFirstLog(xid)
+        lsn = self.logger.log(log)
+        di.pg.lock()
+        try:
+            PageX.setLsn(di.pg, lsn)
+        finally:
+            di.pg.unlock()
+
+    def commit(self, xid: int, synchronous: bool = True) -> None:
+        '''
+        写入提交日志并等待它落盘, 并发提交的事务由同一次 fsync 完成, 然后在 TM 中提交事务
+        没有写过日志的事务不需要提交日志
+        synchronous 为 False 时不等待, 提交日志由刷盘线程在 walFlushInterval 秒内写到磁盘上, 没有刷盘线程时仍然等待
+        '''
+        self.firstLogsLock.acquire()
+        try:
+            logged = xid in self.firstLogs
+        finally:
+            self.firstLogsLock.release()
+        position = -1
+        if logged:
+            position = self.logger.log(Recover.commitLog(xid))
+            if synchronous or self.logger.flusher is None:
+                self.logger.flush(position)
+                position = -1
+        self.finish(xid, True, position)
+
+    def abort(self, xid: int) -> None:
+        '''
+        在 TM 中撤销事务, 撤销的事务不写日志
+        '''
+        self.finish(xid, False, -1)
+
+    def finish(self, xid: int, committed: bool, asyncCommit: int) -> None:
+        '''
+        修改事务在 TM 中的状态, 并移除它在 firstLogs 中的记录
+        两者在 firstLogsLock 中一起完成, 检查点读 firstLogs 时已经移除的事务在 TM 中都已经结束, 之后的 tm.sync 会把它写到磁盘上
+        asyncCommit 是异步提交日志的位置, 同步提交时为 -1
+        '''
+        self.firstLogsLock.acquire()
+        try:
+            # 先记下异步提交日志的位置, 读到事务已提交时也能知道它的提交日志是否已经落盘
+            self.lastAsyncCommit = max(self.lastAsyncCommit, asyncCommit)
+            if committed:
+                self.tm.commit(xid)
+            else:
+                self.tm.abort(xid)
+            self.firstLogs.pop(xid, None)
+        finally:
+            self.firstLogsLock.release()
+
+    def commitsFlushed(self) -> bool:
+        '''
+        异步提交的日志是否都已经落盘, 此时 TM 中已提交的事务在崩溃后也是已提交的
+        '''
+        return self.lastAsyncCommit < self.logger.flushedSize
+
+    def noteFirstLog(self, xid: int) -> None:
+        '''
+        在事务写第一条日志之前记下当前日志末尾, 这个位置不会晚于它的第一条日志
+        超级事务不会被撤销, 不需要记录
+        '''
+        if xid == SUPER_XID:
+            return
+        self.firstLogsLock.acquire()
+        try:
+            if xid not in self.firstLogs:
+                self.firstLogs[xid] = self.logger.tail()
+        finally:
+            self.firstLogsLock.release()
+
+    def checkpoint(self) -> None:
+        '''
+        模糊检查点, 不需要等待所有脏页面写回:
+        记下当前日志末尾作为检查点的起点, 把仍在进行的事务及其第一条日志的位置作为活跃事务表
+        上一个检查点之前就已经变脏的页面现在写回, 其余脏页面和它们的 recLsn 作为脏页表
+        重做从脏页表中最早的 recLsn 开始, 撤销从活跃事务表中最早的日志开始, 都不晚于检查点的起点
+        写入检查点日志并把它的位置记在 PageOne 中, 之后回收重做和撤销起点之前的日志
+        恢复时只需要从检查点记录的位置开始扫描日志
+        '''
+        self.checkpointLock.acquire()
+        try:
+            start = self.logger.tail()
+            self.firstLogsLock.acquire()
+            try:
+                activeTransactions = dict(self.firstLogs)
+            finally:
+                self.firstLogsLock.release()
+            dirtyPages = self.pc.dirtyPageTable(self.lastCheckpoint)
+            self.pc.sync()
+            # 检查点之前提交的事务, 恢复时不会再读到它们的提交日志
+            self.tm.sync()
+            redoPosition = min(dirtyPages.values(), default = start)
+            redoPosition = min(redoPosition, start)
+            undoPosition = min(activeTransactions.values(), default = start)
+            undoPosition = min(undoPosition, start)
+            log = Recover.checkpointLog(redoPosition, undoPosition, self.pc.getPageNumber(), start, activeTransactions, dirtyPages)
+            position = self.logger.log(log)
+            self.logger.flush(position)
+            PageOne.setCheckpoint_page(self.pageOne, position)
+            self.pc.flushPage(self.pageOne)
+            self.pc.sync()
+            self.logger.recycle(min(redoPosition, undoPosition))
+            self.lastCheckpoint = start
+        finally:
+            self.checkpointLock.release()
+
+    def startCheckpointer(self, interval: float = CHECKPOINT_INTERVAL) -> None:
+        '''
+        启动检查点线程, 每隔 interval 秒做一次检查点
+        '''
+        if interval <= 0 or self.checkpointer is not None:
+            return
+        self.checkpointerStop.clear()
+        self.checkpointer = threading.Thread(target = self.runCheckpointer, args = (interval,), daemon = True)
+        self.checkpointer.start()
+
+    def stopCheckpointer(self) -> None:
+        if self.checkpointer is None:
+            return
+        self.checkpointerStop.set()
+        self.checkpointer.join()
+        self.checkpointer = None
+
+    def runCheckpointer(self, interval: float) -> None:
+        while not self.checkpointerStop.wait(interval):
+            try:
+                self.checkpoint()
+            except Exception:
+                traceback.print_exc()
         
     def releaseDataItem(self, di: DataItem.DataItem) -> None:
         '''
@@ -81,13 +334,15 @@ class DataManager(AbstractClass):
 
     def getForCache(self, uid: int) -> DataItem.DataItem:
         '''
-        从 uid 中解析出页号, 从 PageCache 中获取到页面, 再根据偏移, 解析出 DataItem 
+        从 uid 中解析出页号, 从 PageCache 中获取到页面, 再根据槽号, 解析出 DataItem 
         '''
-        offset = (uid & ((1 << 16) - 1))
-        uid = (uid >> 32)
-        pgno = (uid & ((1 << 32) - 1))
+        pgno, slot, gen = DataItem.parseUid(uid)
         pg = self.pc.getPage(pgno)
-        return DataItem.parseDataItem(pg, offset, self)
+        di = DataItem.parseDataItem(pg, slot, gen, self)
+        if di == None:
+            pg.release()
+            raise Exception("NullDataItemException")
+        return di
     
     def releaseForCache(self, di: DataItem.DataItem) -> None:
         '''
@@ -103,48 +358,88 @@ class DataManager(AbstractClass):
         assert pgno == 1
         self.pageOne = self.pc.getPage(pgno)
         self.pc.flushPage(self.pageOne)
+        self.fsm = FreeSpaceMap(self.pc, self.pageOne)
 
     def loadCheckPageOne(self) -> bool:
         '''
         在打开已有文件时读入 PageOne 并验证正确性
+        正常关闭时用 PageOne 中记录的高水位作为页数, 预分配的空页不计入
         '''
         self.pageOne = self.pc.getPage(1)
-        return PageOne.checkVc_page(self.pageOne)
+        if not PageOne.checkVc_page(self.pageOne):
+            return False
+        self.pc.setPageNumber(PageOne.getPageNumber_page(self.pageOne))
+        return True
 
-    def fillPageIndex(self) -> None:
+    def fillPageIndex(self, recovered: bool) -> None:
         '''
         初始化 pageIndex
+        正常打开时直接读入 FSM, 只有崩溃恢复之后或者 FSM 缺失时才扫描所有页面重建
         '''
-        pageNumber = self.pc.pageNumber
-        for i in range(2, pageNumber + 1):
-            pg = self.pc.getPage(i)
-            self.pIndex.add(pg.pageNumber, PageX.getFreeSpace(pg))
-            pg.release()
+        self.fsm = FreeSpaceMap(self.pc, self.pageOne)
+        if not recovered and self.fsm.load(self.pIndex):
+            return
+        self.fsm.rebuild(self.pIndex)
 
-def create(path: str, mem: int, tm: TransactionManager) -> DataManager:
+def create(path: str, mem: int, tm: TransactionManager, walSegmentSize: int = Logger.SEGMENT_SIZE) -> DataManager:
     '''
-    以 path 为目录创建一个数据文件和记录文件
+    以 path 为目录创建一个数据文件和记录文件, 日志分成 walSegmentSize 字节的段
     '''
     # data.db
     pc = PageCache.create(path, mem)
-    # data.log
-    lg = Logger.create(path)
+    # data.log.*
+    lg = Logger.create(path, walSegmentSize)
     dm = DataManager(pc, lg, tm)
     dm.initPageOne()
     return dm
 
-def fileopen(path, mem, tm) -> DataManager:
+def checkFormat(path: str) -> None:
+    '''
+    检查数据文件的格式版本, 不一致时抛出 InvalidDataFileException
+    只读取 PageOne, 需要在打开日志和 xid 文件之前调用, 拒绝打开的数据库不会被修改
+    '''
+    with open(path + PageCache.DB_SUFFIX, 'rb') as f:
+        raw = f.read(PageOne.LEN_FORMAT)
+    if not PageOne.checkFormat_raw(raw):
+        raise Exception("InvalidDataFileException")
+
+def fileopen(path, mem, tm, useMmap: bool = False,
+             bgWriterInterval: float = PageCache.BGWRITER_INTERVAL, bgWriterMaxPages: int = PageCache.BGWRITER_MAX_PAGES,
+             checkpointInterval: float = CHECKPOINT_INTERVAL, prefetchWindow: int = PageCache.PREFETCH_WINDOW,
+             walFlushInterval: float = Logger.FLUSH_INTERVAL, walBatchSize: int = Logger.FLUSH_BATCH_SIZE,
+             recoveryWorkers: int = Recover.RECOVERY_WORKERS, walArchive = None) -> DataManager:
     '''
     打开 path 数据文件和记录文件
+    useMmap 为 True 时数据文件以 mmap 模式打开
+    后台写线程每隔 bgWriterInterval 秒最多写回 bgWriterMaxPages 个脏页面, 检查点线程每隔 checkpointInterval 秒做一次检查点
+    顺序访问时预读之后的 prefetchWindow 个页面, 不大于 0 时关闭预读
+    日志刷盘线程每隔 walFlushInterval 秒, 或者日志缓冲区超过 walBatchSize 字节时写一次日志
+    崩溃恢复时由 recoveryWorkers 个线程按页面并行重做和撤销
+    walArchive 是写满的日志段的归档回调函数, 例如 Logger.archiveToDirectory 的返回值, 为 None 时不归档
     '''
+    checkFormat(path)
     # data.db
-    pc = PageCache.fileopen(path, mem)
-    # data.log
+    pc = PageCache.fileopen(path, mem, useMmap)
+    pc.prefetchWindow = prefetchWindow
+    # data.log.*, 旧版本是单个的 data.log
     lg = Logger.fileopen(path)
     dm = DataManager(pc, lg, tm)
+    recovered = False
     if dm.loadCheckPageOne() == False:
-        Recover.recover(tm, lg, pc)
-    dm.fillPageIndex()
+        Recover.recover(tm, lg, pc, PageOne.getCheckpoint_page(dm.pageOne), recoveryWorkers)
+        recovered = True
+    # 上次没有结束的事务, 恢复流程没有读到它们的日志时仍是进行中, 不撤销的话会一直阻止冻结
+    tm.abortActive()
+    dm.fillPageIndex(recovered)
     PageOne.setVcOpen_page(dm.pageOne)
     dm.pc.flushPage(dm.pageOne)
+    # 旧版本的单文件日志只用来恢复, 其中的修改此时都已经写回, 换成分段日志之后做一次检查点
+    if lg.version != Logger.LOG_VERSION:
+        lg = Logger.convert(path, lg)
+        dm.setLogger(lg)
+        dm.checkpoint()
+    lg.startFlusher(walFlushInterval, walBatchSize)
+    lg.startArchiver(walArchive)
+    dm.pc.startBgWriter(bgWriterInterval, bgWriterMaxPages)
+    dm.startCheckpointer(checkpointInterval)
     return dm
@@ -1,139 +1,301 @@
 # 单线程: 假设日志中最后一个事务是 Ti
 # 对 Ti 之前的事务的日志进行重做, 然后若 Ti 是已完成(committed, aborted), 将 Ti 重做, 否则进行撤销
+# 恢复时只读一遍日志, 读入的日志按页面分组, 重做和撤销都在内存中按页面完成
 
 # 多线程: 
 # 正在进行的事务, 不会读取其他任何未提交的事务产生的数据
 # 正在进行的事务, 不会修改其他任何未提交的事务修改或产生的数据
 import struct
+from concurrent.futures import ThreadPoolExecutor
 from backend.dm.dataItem import DataItem
 from backend.dm.page import PageX
-from backend.tm.TransactionManager import TransactionManager
-from backend.dm.logger.Logger import Logger
+from backend.tm.TransactionManager import TransactionManager, SUPER_XID
+from backend.dm.logger.Logger import Logger, LOG_VERSION_LEGACY
 from backend.dm.pageCache.PageCache import PageCache
 from backend.dm.page.Page import Page
 
-# 两种日志的格式
-# [LogType] [XID] [Pgno] [Offset] [Raw]
+# 日志的格式
+# 插入, 更新, 差量更新和释放日志都按 uid 定位到页面中的槽, 重做和撤销时与数据在页面内的实际位置无关
+# [LogType] [XID] [UID] [Raw]
 LOG_TYPE_INSERT = 0
 # [LogType] [XID] [UID] [OldRaw] [NewRaw]
 LOG_TYPE_UPDATE = 1
+# [LogType] [RedoPosition] [UndoPosition] [PageNumber] [Start] [ATTCount] [XID FirstLog]... [DPTCount] [Pgno RecLsn]...
+# 早期的检查点日志只有前四项
+LOG_TYPE_CHECKPOINT = 2
+# [LogType] [XID] [UID]
+LOG_TYPE_FREE = 3
+# 提交日志落盘后事务才算提交, xid 文件中的状态可能还没有写到磁盘上, 恢复时以提交日志为准
+# [LogType] [XID]
+LOG_TYPE_COMMIT = 4
+# 差量更新日志只记录 DataItem 中发生变化的几段字节, Length 是整个 DataItem 的长度
+# [LogType] [XID] [UID] [Length] [RangeCount] [Offset Len OldRaw NewRaw]...
+LOG_TYPE_DELTA = 5
         
 REDO = 0
 UNDO = 1
 
-# 插入日志参数位置
+# 并行恢复的线程数, 每个线程负责一段连续的页面, 不大于 1 时在当前线程中逐页恢复
+RECOVERY_WORKERS = 4
+
 OF_TYPE = 0
 OF_XID = OF_TYPE + 1
-OF_UPDATE_UID = OF_XID + 8
+# 插入, 更新, 差量更新和释放日志中 uid 的位置相同
+OF_UID = OF_XID + 8
+
+# 更新日志参数位置
+OF_UPDATE_UID = OF_UID
 OF_UPDATE_RAW = OF_UPDATE_UID + 8
         
-# 更新日志参数位置
-OF_INSERT_PGNO = OF_XID + 8
-OF_INSERT_OFFSET = OF_INSERT_PGNO + 4
-OF_INSERT_RAW = OF_INSERT_OFFSET + 2
+# 插入日志参数位置
+OF_INSERT_UID = OF_UID
+OF_INSERT_RAW = OF_INSERT_UID + 8
+
+# 差量更新日志参数位置
+OF_DELTA_UID = OF_UID
+OF_DELTA_LENGTH = OF_DELTA_UID + 8
+OF_DELTA_COUNT = OF_DELTA_LENGTH + 2
+OF_DELTA_RANGES = OF_DELTA_COUNT + 2
+# 每一段的 [Offset] [Len] 的长度
+LEN_DELTA_RANGE = 2 + 2
+# 比较新旧数据时每次比较的字节数, 相邻的不同块合并为一段
+DELTA_BLOCK = 16
+
+# 释放日志参数位置
+OF_FREE_UID = OF_UID
+OF_FREE_END = OF_FREE_UID + 8
+
+# 提交日志参数位置
+OF_COMMIT_END = OF_XID + 8
+
+# 检查点日志参数位置
+OF_CHECKPOINT_REDO = OF_TYPE + 1
+OF_CHECKPOINT_UNDO = OF_CHECKPOINT_REDO + 8
+OF_CHECKPOINT_PGNO = OF_CHECKPOINT_UNDO + 8
+OF_CHECKPOINT_END = OF_CHECKPOINT_PGNO + 4
+OF_CHECKPOINT_START = OF_CHECKPOINT_END
+OF_CHECKPOINT_ATT = OF_CHECKPOINT_START + 8
+# 活跃事务表和脏页表中每一项的长度
+LEN_ATT_ENTRY = 8 + 8
+LEN_DPT_ENTRY = 4 + 8
 
 # 插入日志
 class InsertLogInfo(object):
-    def __init__(self, xid: int, pgno: int, offset: int, raw: bytearray | bytes):
+    def __init__(self, xid: int, pgno: int, slot: int, gen: int, raw: bytearray | bytes):
         self.xid = xid
         self.pgno = pgno
-        self.offset = offset
+        self.slot = slot
+        self.gen = gen
         self.raw = raw
 
 # 更新日志
 class UpdateLogInfo(object):
-    def __init__(self, xid: int, pgno: int, offset: int, oldRaw: bytearray | bytes, newRaw: bytearray | bytes):
+    def __init__(self, xid: int, pgno: int, slot: int, gen: int, oldRaw: bytearray | bytes, newRaw: bytearray | bytes):
         self.xid = xid
         self.pgno = pgno
-        self.offset = offset
+        self.slot = slot
+        self.gen = gen
         self.oldRaw = oldRaw
         self.newRaw = newRaw
 
-def recover(tm: TransactionManager, lg: Logger, pc: PageCache) -> None:
+# 差量更新日志
+class DeltaLogInfo(object):
+    def __init__(self, xid: int, pgno: int, slot: int, gen: int, length: int, ranges: list):
+        self.xid = xid
+        self.pgno = pgno
+        self.slot = slot
+        self.gen = gen
+        self.length = length
+        # [(Offset, OldRaw, NewRaw)]
+        self.ranges = ranges
+
+# 释放日志
+class FreeLogInfo(object):
+    def __init__(self, xid: int, pgno: int, slot: int, gen: int):
+        self.xid = xid
+        self.pgno = pgno
+        self.slot = slot
+        self.gen = gen
+
+# 检查点日志
+class CheckpointLogInfo(object):
+    def __init__(self, redoPosition: int, undoPosition: int, pageNumber: int,
+                 start: int = -1, activeTransactions: dict = None, dirtyPages: dict = None):
+        self.redoPosition = redoPosition
+        self.undoPosition = undoPosition
+        self.pageNumber = pageNumber
+        # 检查点开始时的日志末尾, 早期的检查点日志没有这一项, 为 -1
+        self.start = start
+        # 活跃事务表 xid -> 第一条日志的位置, 脏页表 页号 -> recLsn
+        self.activeTransactions = activeTransactions if activeTransactions != None else {}
+        self.dirtyPages = dirtyPages if dirtyPages != None else {}
+
+class Analysis(object):
+    '''
+    分析阶段的结果
+    '''
+    def __init__(self):
+        # 事务状态表: xid -> 恢复结束时是否仍是未完成的事务
+        self.transactions = {}
+        # 有提交日志, 但 xid 文件中还没有记为已提交的事务
+        self.committed = []
+        # 页号 -> 按日志顺序排列的 (日志位置, xid, 日志)
+        self.pages = {}
+        self.maxPgno = 0
+        self.records = 0
+
+def recover(tm: TransactionManager, lg: Logger, pc: PageCache, checkpoint: int = 0, workers: int = RECOVERY_WORKERS) -> None:
     '''
     恢复数据
-    根据 Logger 的记录确定最大页数, 并截断
-    重做所有已完成的事务
-    撤销所有未完成的事务
+    checkpoint 是最近一次检查点日志的位置, 没有检查点时从头开始
+    分析: 只读一遍日志, 得到事务状态表, 最大页数和每个页面上的日志
+    根据最大页数截断数据文件, 有提交日志但 xid 文件中仍是进行中的事务改为已提交
+    按页号逐页处理, 每个页面只读取一次: 按日志顺序重做已完成的事务, 再按相反顺序撤销未完成的事务
+    不同页面上的日志互不相关, 由 workers 个线程各自负责一部分页面并行处理
     '''
     print("Recovering...")
 
-    lg.rewind()
-    maxPgno = 0
-    while 1:
-        log = lg.next()
-        if log == None:
-            break
-        if isInsertLog(log):
-            pgno = struct.unpack('>i', log[OF_INSERT_PGNO : OF_INSERT_OFFSET])[0]
-        else:
-            uid = struct.unpack('>q', log[OF_UPDATE_UID : OF_UPDATE_RAW])[0]
-            uid >>= 32
-            pgno = uid & ((1 << 32) - 1)
-        if pgno > maxPgno:
-            maxPgno = pgno
-    if maxPgno == 0:
-        maxPgno = 1
+    ci = None
+    if checkpoint > 0:
+        ci = readCheckpointLog(lg, checkpoint)
+    if ci != None:
+        redoPosition = ci.redoPosition
+        undoPosition = ci.undoPosition
+        minPgno = ci.pageNumber
+        print("Start from checkpoint at " + str(checkpoint) + ".")
+    else:
+        lg.rewind()
+        redoPosition = lg.position
+        undoPosition = lg.position
+        minPgno = 1
 
+    an = analyze(tm, lg, min(redoPosition, undoPosition))
+    print("Analyze " + str(an.records) + " logs of " + str(len(an.transactions)) + " transactions.")
+    # 检查点之前创建的页面都已经写回, 不能被截掉
+    maxPgno = max(an.maxPgno, minPgno)
     pc.truncateByBgno(maxPgno)
     print("Truncate to " + str(maxPgno) + " pages.")
-    redoTransactions(tm, lg, pc)
-    print("Redo Transactions Over.")
-    undoTransactions(tm, lg, pc)
-    print("Undo Transactions Over.")
+    for xid in an.committed:
+        tm.commit(xid)
+    parts = partitionPages(an, workers)
+    if len(parts) <= 1:
+        for part in parts:
+            recoverPages(pc, an, part, redoPosition, ci)
+    else:
+        with ThreadPoolExecutor(max_workers = len(parts)) as executor:
+            futures = [executor.submit(recoverPages, pc, an, part, redoPosition, ci) for part in parts]
+            for future in futures:
+                future.result()
+    print("Redo and Undo Over.")
+    for xid, active in an.transactions.items():
+        if active:
+            tm.abort(xid)
+    # 恢复时修改的页面没有可靠的 recLsn, 在之后的检查点回收日志之前就要写回, 大部分已经由恢复线程写回
+    pc.flushAll()
+    pc.sync()
+    tm.sync()
     print("Recovery Over.")
 
-def redoTransactions(tm: TransactionManager, lg: Logger, pc: PageCache) -> None:
-    '''
-    挨个访问记录
-    重做所有已完成的事务
-    '''
-    lg.rewind()
-    while True:
-        log = lg.next()
-        if log == None:
-            break
-        if isInsertLog(log):
-            xid = struct.unpack('>q', log[OF_XID : OF_INSERT_PGNO])[0]   
-            if tm.isActive(xid) == False:
-                doInsertLog(pc, log, REDO)
-        else:
-            xid = struct.unpack('>q', log[OF_XID : OF_UPDATE_UID])[0]
-            if tm.isActive(xid) == False:
-                doUpdateLog(pc, log, REDO)
-
-def undoTransactions(tm: TransactionManager, lg: Logger, pc: PageCache) -> None:
-    '''
-    挨个访问记录
-    撤销所有未完成的事务
-    '''
-    logCache = {}
-    lg.rewind()
-    while 1:
-        log = lg.next()
-        if log == None:
-            break
-        if isInsertLog(log):
-            xid = struct.unpack('>q', log[OF_XID : OF_INSERT_PGNO])[0]
-            if tm.isActive(xid):
-                if logCache.get(xid) == None:
-                    logCache[xid] = []
-                logCache.get(xid).append(log)
-        else:
-            xid = struct.unpack('>q', log[OF_XID : OF_UPDATE_UID])[0]
-            if tm.isActive(xid):
-                if logCache.get(xid) == None:
-                    logCache[xid] = []
-                logCache.get(xid).append(log)
-    for key in logCache:
-        logs = logCache[key]
-        for i in range(len(logs) - 1, -1, -1):
-            log = logs[i]
+def analyze(tm: TransactionManager, lg: Logger, position: int) -> Analysis:
+    '''
+    从 position 开始读一遍日志
+    每个事务只在第一次出现时查询一次 xid 文件, 之后读到它的提交日志时改为已完成
+    xid 文件头可能没有来得及落盘, 遇到比 xidCounter 大的事务时先提高 xidCounter, 再查询它的状态
+    异步提交的事务在 xid 文件中已经提交时, 提交日志可能还在缓冲区中, 没有读到提交日志的要当作未完成的事务撤销
+    旧格式的日志中没有提交日志, 不做这个判断
+    日志是读入的块上的 memoryview, 按页面分组保存时不复制
+    '''
+    an = Analysis()
+    # xid 文件中已提交, 还没有读到提交日志的事务; 已经冻结的事务都在冻结之前结束, 不需要确认
+    unconfirmed = set()
+    for lsn, log in lg.records(position):
+        if isCheckpointLog(log):
+            continue
+        xid = struct.unpack('>q', log[OF_XID : OF_XID + 8])[0]
+        if xid not in an.transactions:
+            if xid > tm.xidCounter:
+                tm.advanceCounter(xid)
+            an.transactions[xid] = tm.isActive(xid)
+            if not an.transactions[xid] and xid != SUPER_XID and not tm.isFrozen(xid) and tm.isCommitted(xid):
+                unconfirmed.add(xid)
+        if isCommitLog(log):
+            unconfirmed.discard(xid)
+            if an.transactions[xid]:
+                an.committed.append(xid)
+                an.transactions[xid] = False
+            continue
+        uid = struct.unpack('>q', log[OF_UID : OF_UID + 8])[0]
+        pgno = DataItem.parseUid(uid)[0]
+        if pgno > an.maxPgno:
+            an.maxPgno = pgno
+        records = an.pages.get(pgno)
+        if records == None:
+            records = []
+            an.pages[pgno] = records
+        records.append((lsn, xid, log))
+        an.records += 1
+    if lg.version != LOG_VERSION_LEGACY:
+        for xid in unconfirmed:
+            an.transactions[xid] = True
+    return an
+
+def partitionPages(an: Analysis, workers: int) -> list:
+    '''
+    把有日志的页面按页号分成最多 workers 段互不相交的连续区间, 每段的日志条数大致相同
+    '''
+    pgnos = sorted(an.pages.keys())
+    workers = max(1, min(workers, len(pgnos)))
+    parts = []
+    part = []
+    count = 0
+    for pgno in pgnos:
+        part.append(pgno)
+        count += len(an.pages[pgno])
+        if count * workers >= an.records * (len(parts) + 1) and len(parts) < workers - 1:
+            parts.append(part)
+            part = []
+    if len(part) > 0:
+        parts.append(part)
+    return parts
+
+def recoverPages(pc: PageCache, an: Analysis, pgnos: list, redoPosition: int, ci: CheckpointLogInfo) -> None:
+    for pgno in pgnos:
+        recoverPage(pc, pgno, an.pages[pgno], an.transactions, redoPosition, ci)
+
+def recoverPage(pc: PageCache, pgno: int, records: list, transactions: dict, redoPosition: int, ci: CheckpointLogInfo) -> None:
+    '''
+    恢复一个页面
+    重做 redoPosition 之后已完成的事务的日志, 检查点开始之前的日志, 只有页面在脏页表中并且不早于页面的 recLsn 时才需要重做
+    不晚于页面上 PageLsn 的日志已经作用到写回的页面上, 也不需要重做
+    释放日志属于超级事务, 不会被撤销
+    恢复完的页面由处理它的线程直接写回
+    '''
+    pg = pc.getPage(pgno)
+    try:
+        pageLsn = PageX.getLsn(pg)
+        for lsn, xid, log in records:
+            if transactions[xid] or lsn < redoPosition or lsn <= pageLsn:
+                continue
+            if ci != None and lsn < ci.start and lsn < ci.dirtyPages.get(pgno, ci.start):
+                continue
             if isInsertLog(log):
-                doInsertLog(pc, log, UNDO)
+                doInsertLog(pg, log, REDO)
+            elif isFreeLog(log):
+                doFreeLog(pg, log)
             else:
-                doUpdateLog(pc, log, UNDO)
-        tm.abort(key)
+                doUpdateLog(pg, log, REDO)
+            PageX.setLsn(pg, lsn)
+        for lsn, xid, log in reversed(records):
+            if not transactions[xid]:
+                continue
+            if isInsertLog(log):
+                doInsertLog(pg, log, UNDO)
+            else:
+                doUpdateLog(pg, log, UNDO)
+        if pg.isDirty():
+            pc.flushPage(pg)
+    finally:
+        pg.release()
 
 def isInsertLog(log: bytearray | bytes) -> bool:
     '''
@@ -141,53 +303,180 @@ def isInsertLog(log: bytearray | bytes) -> bool:
     '''
     return log[0] == LOG_TYPE_INSERT
 
-def insertLog(xid: int, pg: Page, raw: bytearray | bytes) -> bytes | bytearray:
+def isCheckpointLog(log: bytearray | bytes) -> bool:
+    return log[0] == LOG_TYPE_CHECKPOINT
+
+def isFreeLog(log: bytearray | bytes) -> bool:
+    return log[0] == LOG_TYPE_FREE
+
+def isCommitLog(log: bytearray | bytes) -> bool:
+    return log[0] == LOG_TYPE_COMMIT
+
+def isDeltaLog(log: bytearray | bytes) -> bool:
+    return log[0] == LOG_TYPE_DELTA
+
+def commitLog(xid: int) -> bytes:
+    '''
+    提交日志打包
+    [提交日志标记][xid]
+    '''
+    return struct.pack("B", LOG_TYPE_COMMIT) + struct.pack(">q", xid)
+
+def checkpointLog(redoPosition: int, undoPosition: int, pageNumber: int,
+                  start: int, activeTransactions: dict, dirtyPages: dict) -> bytes:
+    '''
+    检查点日志打包
+    [检查点日志标记][重做起点][撤销起点][检查点时的页数][检查点的起点][活跃事务表][脏页表]
+    '''
+    logTypeRaw = struct.pack("B", LOG_TYPE_CHECKPOINT)
+    res = [logTypeRaw, struct.pack(">q", redoPosition), struct.pack(">q", undoPosition), struct.pack(">i", pageNumber),
+           struct.pack(">q", start), struct.pack(">i", len(activeTransactions))]
+    for xid, firstLog in activeTransactions.items():
+        res.append(struct.pack(">qq", xid, firstLog))
+    res.append(struct.pack(">i", len(dirtyPages)))
+    for pgno, recLsn in dirtyPages.items():
+        res.append(struct.pack(">iq", pgno, recLsn))
+    return b''.join(res)
+
+def parseCheckpointLog(log: bytearray | bytes) -> CheckpointLogInfo:
+    redoPosition = struct.unpack('>q', log[OF_CHECKPOINT_REDO : OF_CHECKPOINT_UNDO])[0]
+    undoPosition = struct.unpack('>q', log[OF_CHECKPOINT_UNDO : OF_CHECKPOINT_PGNO])[0]
+    pageNumber = struct.unpack('>i', log[OF_CHECKPOINT_PGNO : OF_CHECKPOINT_END])[0]
+    if len(log) == OF_CHECKPOINT_END:
+        return CheckpointLogInfo(redoPosition, undoPosition, pageNumber)
+    start = struct.unpack('>q', log[OF_CHECKPOINT_START : OF_CHECKPOINT_ATT])[0]
+    of = OF_CHECKPOINT_ATT
+    count = struct.unpack('>i', log[of : of + 4])[0]
+    of += 4
+    activeTransactions = {}
+    for i in range(count):
+        xid, firstLog = struct.unpack('>qq', log[of : of + LEN_ATT_ENTRY])
+        activeTransactions[xid] = firstLog
+        of += LEN_ATT_ENTRY
+    count = struct.unpack('>i', log[of : of + 4])[0]
+    of += 4
+    dirtyPages = {}
+    for i in range(count):
+        pgno, recLsn = struct.unpack('>iq', log[of : of + LEN_DPT_ENTRY])
+        dirtyPages[pgno] = recLsn
+        of += LEN_DPT_ENTRY
+    return CheckpointLogInfo(redoPosition, undoPosition, pageNumber, start, activeTransactions, dirtyPages)
+
+def readCheckpointLog(lg: Logger, position: int) -> CheckpointLogInfo | None:
+    '''
+    读取 position 处的检查点日志, 日志已经损坏或不是检查点日志时返回 None
+    '''
+    lg.seek(position)
+    log = lg.next()
+    if log == None or not isCheckpointLog(log):
+        return None
+    return parseCheckpointLog(log)
+
+def insertLog(xid: int, uid: int, raw: bytearray | bytes) -> bytes | bytearray:
     '''
     插入日志打包
-    [插入日志标记][xid][页数][偏移量][本身的内容]
+    [插入日志标记][xid][uid][本身的内容]
     '''
     logTypeRaw = struct.pack("B", LOG_TYPE_INSERT)
     xidRaw = struct.pack(">q", xid)
-    pgnoRaw = struct.pack(">i", pg.getPageNumber())
-    offsetRaw = struct.pack(">h", PageX.getFSO_page(pg))
-    return logTypeRaw + xidRaw + pgnoRaw + offsetRaw + raw
+    uidRaw = struct.pack(">q", uid)
+    return logTypeRaw + xidRaw + uidRaw + raw
 
 def parseInsertLog(log: bytearray | bytes) -> InsertLogInfo:
     '''
-    读取更新日志, 写成 InsertLogInfo 类
+    读取插入日志, 写成 InsertLogInfo 类
     '''
-    xid = struct.unpack('>q', log[OF_XID : OF_INSERT_PGNO])[0]
-    pgno = struct.unpack('>i', log[OF_INSERT_PGNO : OF_INSERT_OFFSET])[0]
-    offset = struct.unpack('>h', log[OF_INSERT_OFFSET : OF_INSERT_RAW])[0]
+    xid = struct.unpack('>q', log[OF_XID : OF_INSERT_UID])[0]
+    uid = struct.unpack('>q', log[OF_INSERT_UID : OF_INSERT_RAW])[0]
+    pgno, slot, gen = DataItem.parseUid(uid)
     raw = log[OF_INSERT_RAW : len(log)]
-    li = InsertLogInfo(xid, pgno, offset, raw)
+    li = InsertLogInfo(xid, pgno, slot, gen, raw)
     return li
 
-def doInsertLog(pc: PageCache, log: bytearray | bytes, flag: int) -> None:
+def doInsertLog(pg: Page, log: bytearray | bytes, flag: int) -> None:
     '''
-    在主页面完成更新
+    在日志所在的页面 pg 上完成更新
+    撤销插入时释放这个槽, 并把槽的 Gen 推进到这一代
     '''
     li = parseInsertLog(log)
-    pg = pc.getPage(li.pgno)
-    try:
-        if flag == UNDO:
-            DataItem.setDataItemRawInvalid(li.raw)
-        PageX.recoverInsert(pg, li.raw, li.offset)
-    finally:
-        pg.release()
+    if flag == UNDO:
+        PageX.recoverFree(pg, li.slot, li.gen)
+    else:
+        PageX.recoverInsert(pg, li.raw, li.slot, li.gen)
 
 def updateLog(xid: int, di: DataItem.DataItem) -> bytearray | bytes:
     '''
     更新日志打包
-    [更新日志标记][xid][页数][偏移量][本身的内容]
+    [更新日志标记][xid][uid][旧的内容][新的内容]
+    只修改了少量字节时打包成更短的差量更新日志
     '''
-    logType = struct.pack(">b", LOG_TYPE_UPDATE)
-    xidRaw = struct.pack(">q", xid)
-    uidRaw = struct.pack(">q", di.uid)
     oldRaw = di.oldRaw
     raw = di.raw
     newRaw = raw.raw[raw.start : raw.end]
+    ranges = diffRanges(oldRaw, newRaw)
+    deltaSize = OF_DELTA_RANGES + sum(LEN_DELTA_RANGE + 2 * (end - start) for start, end in ranges)
+    if deltaSize < OF_UPDATE_RAW + 2 * len(newRaw):
+        return deltaLog(xid, di.uid, oldRaw, newRaw, ranges)
+    logType = struct.pack(">b", LOG_TYPE_UPDATE)
+    xidRaw = struct.pack(">q", xid)
+    uidRaw = struct.pack(">q", di.uid)
     return logType + xidRaw + uidRaw + oldRaw + newRaw
+
+def diffRanges(oldRaw: bytearray | bytes, newRaw: bytearray | bytes) -> list:
+    '''
+    按 DELTA_BLOCK 字节一块比较新旧数据, 相邻的不同块合并成一段, 再去掉每段首尾没有变化的字节
+    返回 [(起始位置, 结束位置)]
+    '''
+    ranges = []
+    start = -1
+    for of in range(0, len(newRaw), DELTA_BLOCK):
+        same = oldRaw[of : of + DELTA_BLOCK] == newRaw[of : of + DELTA_BLOCK]
+        if not same and start < 0:
+            start = of
+        elif same and start >= 0:
+            ranges.append(trimRange(oldRaw, newRaw, start, of))
+            start = -1
+    if start >= 0:
+        ranges.append(trimRange(oldRaw, newRaw, start, len(newRaw)))
+    return ranges
+
+def trimRange(oldRaw: bytearray | bytes, newRaw: bytearray | bytes, start: int, end: int) -> tuple:
+    while oldRaw[start] == newRaw[start]:
+        start += 1
+    while oldRaw[end - 1] == newRaw[end - 1]:
+        end -= 1
+    return (start, end)
+
+def deltaLog(xid: int, uid: int, oldRaw: bytearray | bytes, newRaw: bytearray | bytes, ranges: list) -> bytes:
+    '''
+    差量更新日志打包
+    [差量更新日志标记][xid][uid][数据长度][段数][每一段的位置, 长度, 旧的内容, 新的内容]
+    '''
+    res = [struct.pack("B", LOG_TYPE_DELTA), struct.pack(">q", xid), struct.pack(">q", uid),
+           struct.pack(">H", len(newRaw)), struct.pack(">H", len(ranges))]
+    for start, end in ranges:
+        res.append(struct.pack(">HH", start, end - start))
+        res.append(oldRaw[start : end])
+        res.append(newRaw[start : end])
+    return b''.join(res)
+
+def parseDeltaLog(log: bytearray | bytes) -> DeltaLogInfo:
+    '''
+    读取差量更新日志, 写成 DeltaLogInfo 类
+    '''
+    xid = struct.unpack('>q', log[OF_XID : OF_DELTA_UID])[0]
+    uid = struct.unpack('>q', log[OF_DELTA_UID : OF_DELTA_LENGTH])[0]
+    pgno, slot, gen = DataItem.parseUid(uid)
+    length = struct.unpack('>H', log[OF_DELTA_LENGTH : OF_DELTA_COUNT])[0]
+    count = struct.unpack('>H', log[OF_DELTA_COUNT : OF_DELTA_RANGES])[0]
+    ranges = []
+    of = OF_DELTA_RANGES
+    for i in range(count):
+        offset, size = struct.unpack('>HH', log[of : of + LEN_DELTA_RANGE])
+        of += LEN_DELTA_RANGE
+        ranges.append((offset, log[of : of + size], log[of + size : of + size * 2]))
+        of += size * 2
+    return DeltaLogInfo(xid, pgno, slot, gen, length, ranges)
     
 def parseUpdateLog(log: bytearray | bytes) -> UpdateLogInfo:
     '''
@@ -195,28 +484,49 @@ def parseUpdateLog(log: bytearray | bytes) -> UpdateLogInfo:
     '''
     xid = struct.unpack('>q', log[OF_XID : OF_UPDATE_UID])[0]
     uid = struct.unpack('>q', log[OF_UPDATE_UID : OF_UPDATE_RAW])[0]
-    offset = uid & ((1 << 16) - 1)
-    uid >>= 32
-    pgno = uid & ((1 << 32) - 1)
+    pgno, slot, gen = DataItem.parseUid(uid)
     length = (len(log) - OF_UPDATE_RAW) // 2
     oldRaw = log[OF_UPDATE_RAW : OF_UPDATE_RAW + length]
     newRaw = log[OF_UPDATE_RAW + length : OF_UPDATE_RAW + length * 2]
-    li = UpdateLogInfo(xid, pgno, offset, oldRaw, newRaw)
+    li = UpdateLogInfo(xid, pgno, slot, gen, oldRaw, newRaw)
     return li
 
-def doUpdateLog(pc: PageCache, log: Logger, flag: int) -> None:
+def doUpdateLog(pg: Page, log: bytearray | bytes, flag: int) -> None:
     '''
-    在主页面完成更新
+    在日志所在的页面 pg 上完成更新, 包括差量更新
     '''
+    if isDeltaLog(log):
+        xi = parseDeltaLog(log)
+        for offset, oldRaw, newRaw in xi.ranges:
+            raw = newRaw if flag == REDO else oldRaw
+            PageX.recoverUpdateRange(pg, xi.length, offset, raw, xi.slot, xi.gen)
+        return
     xi = parseUpdateLog(log)
-    pgno = xi.pgno
-    offset = xi.offset
-    try:
-        if flag == REDO:
-            raw = xi.newRaw
-        else:
-            raw = xi.oldRaw
-        pg = pc.getPage(pgno)
-        PageX.recoverUpdate(pg, raw, offset)
-    finally:
-        pg.release()
+    if flag == REDO:
+        raw = xi.newRaw
+    else:
+        raw = xi.oldRaw
+    PageX.recoverUpdate(pg, raw, xi.slot, xi.gen)
+
+def freeLog(di: DataItem.DataItem) -> bytearray | bytes:
+    '''
+    释放日志打包, 释放总是由超级事务完成
+    [释放日志标记][xid][uid]
+    '''
+    logType = struct.pack("B", LOG_TYPE_FREE)
+    xidRaw = struct.pack(">q", SUPER_XID)
+    uidRaw = struct.pack(">q", di.uid)
+    return logType + xidRaw + uidRaw
+
+def parseFreeLog(log: bytearray | bytes) -> FreeLogInfo:
+    xid = struct.unpack('>q', log[OF_XID : OF_FREE_UID])[0]
+    uid = struct.unpack('>q', log[OF_FREE_UID : OF_FREE_END])[0]
+    pgno, slot, gen = DataItem.parseUid(uid)
+    return FreeLogInfo(xid, pgno, slot, gen)
+
+def doFreeLog(pg: Page, log: bytearray | bytes) -> None:
+    '''
+    在日志所在的页面 pg 上重做释放
+    '''
+    fi = parseFreeLog(log)
+    PageX.recoverFree(pg, fi.slot, fi.gen)
@@ -6,6 +6,7 @@ import struct
 import threading
 from backend.common.SubArray import SubArray
 from backend.dm.page.Page import Page
+from backend.dm.page import PageX
 
 # 段位置标记
 OF_VALID = 0
@@ -37,9 +38,10 @@ class DataItem(object):
     def before(self) -> None:
         '''
         准备对 DataItem 修改
-        把 raw 数据备份到 oldRaw
+        把 raw 数据备份到 oldRaw, 修改完成之前页面不会被写回
         '''
         self.wLock.acquire()
+        self.pg.beginWrite()
         self.pg.setDirty(True)
         self.oldRaw[0 : len(self.oldRaw)] = self.raw.raw[self.raw.start : self.raw.start + len(self.oldRaw)]
 
@@ -50,14 +52,26 @@ class DataItem(object):
         '''
         for i in range(self.raw.start, self.raw.start + len(self.oldRaw)):
             self.raw.raw[i] = self.oldRaw[i - self.raw.start]
+        self.pg.setDirty(True)
+        self.pg.endWrite()
         self.wLock.release()
     
     def after(self, xid: int) -> None:
         '''
         修改完成
+        日志写入并记到页面上之后才允许写回, 写回时刷日志一定会刷到这条日志
         '''
-        self.dm.logDataItem(xid, self)
-        self.wLock.release()
+        try:
+            self.dm.logDataItem(xid, self)
+        finally:
+            self.pg.endWrite()
+            self.wLock.release()
+
+    def setInvalid(self) -> None:
+        '''
+        标记为非法, 已经持有这个 DataItem 的线程再次读取时会得到 None
+        '''
+        self.raw.raw[self.raw.start + OF_VALID] = 1
 
     def release(self) -> None:
         '''
@@ -71,18 +85,39 @@ def wrapDataItemRaw(raw: bytearray) -> bytearray:
     根据 DataItem 规定结构包装一个数据对象
     '''
     valid_byte = bytearray(1)
-    size_bytes = struct.pack('>h', len(raw))
+    size_bytes = struct.pack('>H', len(raw))
     return valid_byte + size_bytes + raw
 
-def parseDataItem(pg: Page, offset: int, dm) -> DataItem:
+def uidOf(pgno: int, slot: int, gen: int) -> int:
+    '''
+    uid 的高 32 位是页号, 低 32 位是槽的 Gen 和槽号
+    '''
+    return (pgno << 32) | (gen << 16) | slot
+
+def parseUid(uid: int) -> tuple:
+    '''
+    从 uid 中解析出 (页号, 槽号, Gen)
+    '''
+    slot = uid & ((1 << 16) - 1)
+    gen = (uid >> 16) & ((1 << 16) - 1)
+    pgno = (uid >> 32) & ((1 << 32) - 1)
+    return (pgno, slot, gen)
+
+def parseDataItem(pg: Page, slot: int, gen: int, dm) -> DataItem | None:
     '''
-    从页面 pg 的 offset 处解析 DataItem
+    从页面 pg 的第 slot 个槽解析 DataItem, 槽已经被释放或复用时返回 None
+    在页面锁内读取槽, 不会看到整理到一半的页面
     '''
-    raw = pg.data
-    size = struct.unpack('>h', raw[offset + OF_SIZE : offset + OF_DATA])[0]
-    length = (size + OF_DATA) & ((1 << 16) - 1)
-    uid = (pg.pageNumber << 32) | offset
-    return DataItem(SubArray(raw, offset, offset + length), bytearray(length), pg, uid, dm)
+    pg.lock()
+    try:
+        item = PageX.getItem(pg, slot, gen)
+    finally:
+        pg.unlock()
+    if item == None:
+        return None
+    offset, length = item
+    uid = uidOf(pg.pageNumber, slot, gen)
+    return DataItem(SubArray(pg.data, offset, offset + length), bytearray(length), pg, uid, dm)
     
 def setDataItemRawInvalid(raw: bytearray) -> None:
     '''
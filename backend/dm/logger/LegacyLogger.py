@@ -0,0 +1,191 @@
+# 旧版本的单文件日志: [Header][Log1][Log2][Log3]...[LogN][BadTail]
+# 版本 3 的 [Header] 为 [Magic][Version][XChecksum][Base], 日志位置是逻辑位置, 在文件中的偏移量为 逻辑位置 - Base
+# 版本 2 的 [Header] 没有 [Base]
+# 版本 1 的 [Header] 只有 [XChecksum], 校验和是逐字节计算的多项式哈希, 之后的版本是 CRC32
+# 每个 [Log] 包括 [Size][Checksum][Data]
+# 只在打开旧版本的数据库时用来恢复, 不再追加日志, 恢复完成后由 Logger.convert 换成分段日志
+# 槽页布局之前的数据文件打开时就被拒绝, 版本 1 的日志由 Upgrade 读取; 版本 2, 3 的日志记录的是没有格式标记的槽页, 不再有办法恢复
+import os
+import struct
+import zlib
+from typing import Iterator
+from backend.common.RandomAccessFile import RandomAccessFile
+
+LOG_MAGIC = b'LDBL'
+LOG_VERSION_LEGACY = 1
+LOG_VERSION_V2 = 2
+LOG_VERSION_V3 = 3
+OF_MAGIC = 0
+OF_VERSION = OF_MAGIC + 4
+OF_XCHECKSUM = OF_VERSION + 4
+OF_BASE = OF_XCHECKSUM + 4
+V3_HEADER_SIZE = OF_BASE + 8
+V2_HEADER_SIZE = OF_BASE
+V1_HEADER_SIZE = 4
+
+# 版本 1 校验和的种子
+SEED = 13331
+OF_SIZE = 0
+OF_CHECKSUM = OF_SIZE + 4
+OF_DATA = OF_CHECKSUM + 4
+MASK = 0xFFFFFFFF
+
+LOG_SUFFIX = ".log"
+LOG_TMP_SUFFIX = ".log_tmp"
+# 顺序读取日志时每次读入的字节数, 比它长的 [log] 单独读入
+READ_CHUNK = 1 << 20
+
+class LegacyLogger(object):
+    def __init__(self, file: str):
+        self.fileName = file
+        self.file = RandomAccessFile(file)
+        self.version = LOG_VERSION_V3
+        self.headerSize = V3_HEADER_SIZE
+        # 文件开头对应的逻辑位置
+        self.base = 0
+        # 日志指针的位置
+        self.position = 0
+        # 最后一条有效的 [log] 之后的位置
+        self.fileSize = 0
+
+    def init(self) -> None:
+        '''
+        读取文件头确定日志格式, 再找到最后一条有效的 [log]
+        '''
+        raw = self.file.read(0, V3_HEADER_SIZE)
+        if len(raw) >= V2_HEADER_SIZE and raw[OF_MAGIC : OF_VERSION] == LOG_MAGIC:
+            self.version = struct.unpack(">I", raw[OF_VERSION : OF_XCHECKSUM])[0]
+            if self.version == LOG_VERSION_V3 and len(raw) == V3_HEADER_SIZE:
+                self.headerSize = V3_HEADER_SIZE
+                self.base = struct.unpack(">q", raw[OF_BASE : V3_HEADER_SIZE])[0]
+            elif self.version == LOG_VERSION_V2:
+                self.headerSize = V2_HEADER_SIZE
+            else:
+                raise Exception("BadLogFileException")
+        else:
+            self.version = LOG_VERSION_LEGACY
+            self.headerSize = V1_HEADER_SIZE
+        self.fileSize = self.base + self.file.size()
+        self.rewind()
+        for _ in self.scan(self.position):
+            pass
+        self.fileSize = self.position
+        self.rewind()
+
+    def legacyChecksum(self, xCheck: int, log: bytearray | bytes) -> int:
+        '''
+        版本 1 的校验和, 逐字节计算
+        '''
+        xCheck = handle_exceed(xCheck)
+        for i in log:
+            xCheck = handle_exceed(xCheck * SEED)
+            val = i
+            if val >= 128:
+                val -= 256
+            xCheck = handle_exceed(xCheck + val)
+        return xCheck & MASK
+
+    def calChecksum(self, xCheck: int, log: bytearray | bytes) -> int:
+        if self.version == LOG_VERSION_LEGACY:
+            return self.legacyChecksum(xCheck, log)
+        return zlib.crc32(log, xCheck)
+
+    def scan(self, position: int, chunkSize: int = READ_CHUNK) -> Iterator[tuple]:
+        '''
+        从 position 开始顺序读取 [log], 依次返回 (日志位置, 完整 [log] 的 memoryview), 同时更新 position
+        '''
+        self.position = position
+        if position < self.base + self.headerSize:
+            return
+        end = self.fileSize
+        chunk = memoryview(b'')
+        chunkStart = position
+        while position + OF_DATA < end:
+            of = position - chunkStart
+            if of + OF_DATA > len(chunk):
+                chunkStart = position
+                chunk = memoryview(self.file.read(position - self.base, min(chunkSize, end - position)))
+                of = 0
+                if len(chunk) < OF_DATA:
+                    return
+            size = struct.unpack(">i", chunk[of + OF_SIZE : of + OF_CHECKSUM])[0]
+            if size < 0 or position + OF_DATA + size > end:
+                return
+            if of + OF_DATA + size > len(chunk):
+                chunkStart = position
+                chunk = memoryview(self.file.read(position - self.base, min(max(chunkSize, OF_DATA + size), end - position)))
+                of = 0
+                if len(chunk) < OF_DATA + size:
+                    return
+            log = chunk[of : of + OF_DATA + size]
+            checkSum1 = self.calChecksum(0, log[OF_DATA : len(log)])
+            checkSum2 = struct.unpack(">I", log[OF_CHECKSUM : OF_DATA])[0]
+            if checkSum1 != checkSum2:
+                return
+            self.position = position + len(log)
+            yield (position, log)
+            position += len(log)
+
+    def records(self, position: int = -1) -> Iterator[tuple]:
+        '''
+        从 position 开始顺序读取日志, 依次返回 (日志位置, [Data] 的 memoryview), position 为 -1 时从头开始
+        '''
+        if position < 0:
+            position = self.base + self.headerSize
+        for position, log in self.scan(position):
+            yield (position, log[OF_DATA : len(log)])
+
+    def next(self) -> None | memoryview:
+        '''
+        读取 position 位置的 [log]
+        '''
+        for _, log in self.scan(self.position, OF_DATA):
+            return log[OF_DATA : len(log)]
+        return None
+
+    def rewind(self) -> None:
+        self.position = self.base + self.headerSize
+
+    def seek(self, position: int) -> None:
+        self.position = position
+
+    def tail(self) -> int:
+        return self.fileSize
+
+    def flush(self, position: int = -1) -> None:
+        '''
+        旧日志只读, 没有需要落盘的日志
+        '''
+        pass
+
+    def sync(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.file.close()
+
+def handle_exceed(xCheck: int) -> int:
+    '''
+    对 4 字节整数的手动处理
+    '''
+    res = xCheck & MASK
+    if res & 0x80000000:
+        res = res - 0x100000000
+    return res
+
+def exists(path: str) -> bool:
+    return os.path.exists(path + LOG_SUFFIX)
+
+def fileopen(path: str) -> LegacyLogger:
+    '''
+    打开旧版本的 log 文件
+    '''
+    fileName = path + LOG_SUFFIX
+    # 回收日志时崩溃留下的临时文件, 原来的日志文件是完整的
+    try:
+        os.remove(fileName + LOG_TMP_SUFFIX)
+    except OSError:
+        pass
+    lg = LegacyLogger(fileName)
+    lg.init()
+    return lg
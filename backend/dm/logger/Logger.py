@@ -1,41 +1,124 @@
-# 日志的二进制文件: [XChecksum][Log1][Log2][Log3]...[LogN][BadTail]
+# 日志由编号连续的若干段组成, 第 n 段的文件是 <path>.log.<n 的 16 位十六进制>, 每段的大小都是 SegmentSize
+# 日志位置是逻辑位置, 第 n 段覆盖 [n * SegmentSize, (n + 1) * SegmentSize), 段内的偏移量就是在段文件中的偏移量
+# 每段的开头是 [Header]: [Magic][Version][SegmentSize][SegNo][Start], Start 是段中第一条 [log] 的位置
+# 之后是 [Log1][Log2]...[LogN][End][BadTail]
 # 每个 [Log] 包括 [Size][Checksum][Data], [Size]是一个 4 字节整数
-# XChecksum 为所有 Checksum 的校检值求和, 所有 Checksum 都是一个 4 字节整数
-# BadTail 是在数据库崩溃时, 没有来得及写完的日志数据
+# Checksum 是 [log] 的位置和 [Data] 一起计算的 CRC32, 复用的段中残留的旧日志位置不同, 校验不会通过
+# 一条 [log] 不会跨段, 当前段放不下时写一个 Size 为 -1, 没有 [Data] 的 [End], 之后的 [log] 从下一段开始
+# BadTail 是在数据库崩溃时, 没有来得及写完的日志数据, 打开日志时清除
+# 写入一段时就预先准备好下一段: 新建文件并预分配空间, 或者复用回收的段, 追加日志不会随着日志变长而变慢
+# 检查点之前的日志按整段回收, 回收的段改名为之后的段重复使用; 写满的段可以交给归档回调函数, 还没有归档的段不会被回收
+# 组提交: [log] 先追加到内存中的日志缓冲区, 由刷盘线程成批写入并 fsync
+# 提交的事务等待自己的提交日志落盘, 同一批中的多个提交共用一次 fsync
+# 恢复等需要顺序读取整个日志的地方用 records 迭代, 日志按块读入, 每条 [log] 都是块上的 memoryview, 不再逐条读取和复制
+# 旧版本的单文件日志 <path>.log 由 LegacyLogger 读取, 恢复完成后用 convert 换成分段日志
+# 但写下单文件日志的数据文件都还没有格式标记, 打开时就被拒绝, 走不到这里; 这样的数据库由 Upgrade 导出导入, 它用 LegacyLogger 在内存中重放旧日志
+import os
+import shutil
 import struct
 import threading
+import traceback
+import zlib
+from typing import Callable, Iterator
+from backend.common.RandomAccessFile import RandomAccessFile
+from backend.dm.logger import LegacyLogger
+from backend.dm.logger.LegacyLogger import LOG_VERSION_LEGACY
+
+LOG_MAGIC = b'LDBL'
+LOG_VERSION = 4
+OF_MAGIC = 0
+OF_VERSION = OF_MAGIC + 4
+OF_SEGMENT_SIZE = OF_VERSION + 4
+OF_SEGNO = OF_SEGMENT_SIZE + 4
+OF_START = OF_SEGNO + 8
+HEADER_SIZE = OF_START + 8
 
-SEED = 13331
-OF_XCHECKSUM = 4
 OF_SIZE = 0
 OF_CHECKSUM = OF_SIZE + 4
 OF_DATA = OF_CHECKSUM + 4
-MASK = 0xFFFFFFFF
+# [End] 的 Size
+END_MARKER = -1
 
 LOG_SUFFIX = ".log"
+ARCHIVE_TMP_SUFFIX = ".tmp"
+# 默认的段大小
+SEGMENT_SIZE = 1 << 24
+# 当前段之后最多保留的准备好的段, 回收的段超过这个数时直接删除
+MAX_PREPARED_SEGMENTS = 2
+# 顺序读取日志时每次读入的字节数, 比它长的 [log] 单独读入
+READ_CHUNK = 1 << 20
+# 刷盘线程默认每隔 FLUSH_INTERVAL 秒写一次缓冲区, 缓冲区超过 FLUSH_BATCH_SIZE 字节或者有事务等待提交时立即写
+FLUSH_INTERVAL = 0.01
+FLUSH_BATCH_SIZE = 1 << 16
+# 归档失败后重试的间隔
+ARCHIVE_INTERVAL = 1.0
 
 class Logger(object):
-    def __init__(self, file: str, xChecksum = 0):
-        self.file = file
+    def __init__(self, path: str, segmentSize: int = SEGMENT_SIZE):
+        self.path = path
+        self.version = LOG_VERSION
+        self.segmentSize = segmentSize
+        # 已经打开的段文件: 段号 -> RandomAccessFile, 追加和读取都是按偏移量的 pwrite/pread
+        self.files = {}
+        # 最早的段, 以及其中第一条 [log] 的位置
+        self.firstSegment = 0
+        self.start = HEADER_SIZE
+        # 已经准备好的最大段号
+        self.preparedSegment = -1
         # 日志指针的位置
         self.position = 0
-        # 日志文件的大小
+        # 日志的逻辑大小, 包括缓冲区中还没有写入文件的部分, 也就是下一条 [log] 的位置
         self.fileSize = 0
-        # 所有Checksum的求和
-        self.xChecksum = xChecksum
+        # 已经写入文件并 fsync 的大小, 缓冲区中的日志从这个位置开始
+        self.flushedSize = 0
         self.lock = threading.RLock()
-    
+        # 日志缓冲区, 等待落盘的线程在 cond 上阻塞
+        self.cond = threading.Condition(self.lock)
+        # 缓冲区中的 (位置, [log])
+        self.buffer = []
+        self.bufferSize = 0
+        self.batchSize = FLUSH_BATCH_SIZE
+        # 同一时刻只有一个线程写缓冲区, 它写的时候新的日志继续进入缓冲区, 组成下一批
+        # 准备和回收段也在这个锁内进行
+        self.flushLock = threading.Lock()
+        self.flusher = None
+        self.flusherStop = False
+        # 等待落盘的线程要求日志至少写到的位置, 刷盘线程写到这里之前不再等待
+        self.flushTarget = 0
+        # 写入或 fsync 失败时的错误, 之后不再重试, 等待落盘的线程和之后的 flush 都抛出它
+        self.flushError = None
+        # 归档回调函数 archive(段文件名, 段号), 段号不大于 archivedSegment 的段都已经归档
+        self.archive = None
+        self.archiver = None
+        self.archiverStop = False
+        self.archivedSegment = -1
+
     def init(self) -> None:
         '''
-        写入 XChecksum
+        找到所有的段, 从最早的段的文件头读出段大小和第一条 [log] 的位置, 再检查并移除 BadTail
         '''
-        with open(self.file, "rb+") as f:
-            f.seek(0, 0)
-            raw = f.read(4)
-            f.seek(0, 2)
-            self.fileSize = f.tell()
-        f.close()
-        self.xChecksum = struct.unpack(">i", raw)[0]
+        segments = listSegments(self.path)
+        if len(segments) == 0:
+            raise Exception("BadLogFileException")
+        raw = RandomAccessFile(segmentName(self.path, segments[0]))
+        try:
+            header = raw.read(0, HEADER_SIZE)
+        finally:
+            raw.close()
+        if len(header) < HEADER_SIZE or header[OF_MAGIC : OF_VERSION] != LOG_MAGIC \
+            or struct.unpack(">I", header[OF_VERSION : OF_SEGMENT_SIZE])[0] != LOG_VERSION \
+            or struct.unpack(">q", header[OF_SEGNO : OF_START])[0] != segments[0]:
+            raise Exception("BadLogFileException")
+        self.segmentSize = struct.unpack(">I", header[OF_SEGMENT_SIZE : OF_SEGNO])[0]
+        self.firstSegment = segments[0]
+        self.start = struct.unpack(">q", header[OF_START : HEADER_SIZE])[0]
+        # 段号连续的部分才可能有日志
+        last = self.firstSegment
+        while last + 1 in segments:
+            last += 1
+        self.preparedSegment = last
+        self.fileSize = self.segmentStart(last + 1)
+        self.flushedSize = self.fileSize
         self.checkAndRemoveTail()
 
     def checkAndRemoveTail(self) -> None:
@@ -43,140 +126,612 @@ class Logger(object):
         检查并移除 BadTail
         '''
         self.rewind()
-        xCheck = 0
-        while True:
-            log = self.internNext()
-            if log == None:
-                break
-            xCheck = self.calChecksum(xCheck, log)
+        for _ in self.scan(self.position):
+            pass
         self.truncate(self.position)
         self.rewind()
 
-    def handle_exceed(self, xCheck: int) -> int:
+    def segmentOf(self, position: int) -> int:
+        return position // self.segmentSize
+
+    def segmentStart(self, segment: int) -> int:
+        return segment * self.segmentSize
+
+    def segmentFile(self, segment: int) -> RandomAccessFile | None:
+        '''
+        打开第 segment 段的文件, 文件不存在时返回 None
+        '''
+        self.lock.acquire()
+        try:
+            f = self.files.get(segment)
+            if f is None:
+                try:
+                    f = RandomAccessFile(segmentName(self.path, segment))
+                except OSError:
+                    return None
+                self.files[segment] = f
+            return f
+        finally:
+            self.lock.release()
+
+    def header(self, segment: int, start: int) -> bytes:
+        return LOG_MAGIC + struct.pack(">I", LOG_VERSION) + struct.pack(">I", self.segmentSize) \
+            + struct.pack(">q", segment) + struct.pack(">q", start)
+
+    def checkSegment(self, segment: int) -> bool:
+        '''
+        第 segment 段是否存在并且文件头完整
+        '''
+        f = self.segmentFile(segment)
+        if f is None:
+            return False
+        raw = f.read(0, HEADER_SIZE)
+        return len(raw) == HEADER_SIZE and raw[OF_MAGIC : OF_VERSION] == LOG_MAGIC \
+            and struct.unpack(">q", raw[OF_SEGNO : OF_START])[0] == segment
+
+    def prepareSegment(self, segment: int, start: int = -1) -> None:
         '''
-        对 4 字节整数的手动处理
+        新建第 segment 段, 预分配空间并写好文件头, start 为 -1 时第一条 [log] 紧跟在文件头之后
+        由持有 flushLock 的线程调用
         '''
-        res = xCheck & MASK
-        if res & 0x80000000:
-            res = res - 0x100000000
-        return res
+        if start < 0:
+            start = self.segmentStart(segment) + HEADER_SIZE
+        name = segmentName(self.path, segment)
+        f = RandomAccessFile(name, True)
+        f.allocate(0, self.segmentSize)
+        f.write(0, self.header(segment, start))
+        f.sync()
+        syncDirectory(name)
+        self.lock.acquire()
+        try:
+            old = self.files.pop(segment, None)
+            self.files[segment] = f
+            self.preparedSegment = max(self.preparedSegment, segment)
+        finally:
+            self.lock.release()
+        if old is not None:
+            old.close()
 
-    def calChecksum(self, xCheck: int, log: bytearray) -> int:
+    def calChecksum(self, position: int, data: bytearray | bytes | memoryview) -> int:
         '''
-        计算Checksum
+        位置为 position 的 [log] 的校验和, 返回 4 字节无符号整数
         '''
-        for i in log:
-            xCheck = self.handle_exceed(xCheck * SEED)
-            val = i
-            if val >= 128:
-                val -= 256
-            xCheck = self.handle_exceed(xCheck + val)
-        return xCheck
-    
-    def wrapLog(self, data: bytearray | bytes) -> bytearray | bytes:
+        return zlib.crc32(data, zlib.crc32(struct.pack(">q", position)))
+
+    def wrapLog(self, position: int, data: bytearray | bytes) -> bytes:
         '''
-        包装一个 [log]
+        包装位置为 position 的 [log]
         '''
-        checksum = struct.pack(">i", self.calChecksum(0, data))
+        checksum = struct.pack(">I", self.calChecksum(position, data))
         size = struct.pack(">i", len(data))
         return size + checksum + data
 
-    def log(self, data: bytearray | bytes) -> None:
+    def log(self, data: bytearray | bytes) -> int:
         '''
-        写入 [log]
+        把 [log] 追加到日志缓冲区, 返回这条 [log] 的位置
+        返回时日志还不一定落盘, 需要持久化的调用者再调用 flush
         '''
-        log = self.wrapLog(data)
+        if OF_DATA + len(data) > self.segmentSize - HEADER_SIZE:
+            raise Exception("LogTooLargeException")
         self.lock.acquire()
         try:
-            with open(self.file, 'rb+') as f:
-                f.seek(0, 2)
-                f.write(log)
-            f.close()
+            position = self.fileSize
+            of = position - self.segmentStart(self.segmentOf(position))
+            if of < HEADER_SIZE:
+                position += HEADER_SIZE - of
+            elif of + OF_DATA + len(data) > self.segmentSize:
+                # 当前段放不下, 段末留得下 [End] 时写一个 [End]
+                if of + OF_DATA <= self.segmentSize:
+                    self.append(position, struct.pack(">i", END_MARKER) + struct.pack(">I", self.calChecksum(position, b'')))
+                position = self.segmentStart(self.segmentOf(position) + 1) + HEADER_SIZE
+            log = self.wrapLog(position, data)
+            self.append(position, log)
+            self.fileSize = position + len(log)
+            full = self.bufferSize >= self.batchSize
+            if full and self.flusher is not None:
+                self.cond.notify_all()
         finally:
             self.lock.release()
-        self.updateXChecksum(log)
+        # 没有刷盘线程时由写满缓冲区的线程自己写
+        if full and self.flusher is None:
+            self.writeBuffer()
+        return position
+
+    def append(self, position: int, log: bytes) -> None:
+        self.buffer.append((position, log))
+        self.bufferSize += len(log)
 
-    def next(self) -> None | bytearray:
+    def flush(self, position: int = -1) -> None:
         '''
-        读取 position 位置的 [log]
+        保证 position 处的 [log] 及其之前的日志都已经落盘, position 为 -1 时是缓冲区中的所有日志
+        刷盘线程在运行时只是唤醒它并等待, 否则自己写缓冲区; 两种情况下并发的调用者都会合并成一次写入和 fsync
+        '''
+        self.cond.acquire()
+        try:
+            target = self.fileSize if position < 0 else position + 1
+            if self.flushedSize >= target:
+                return
+            if self.flushError is not None:
+                raise self.flushError
+            if self.flusher is not None:
+                self.flushTarget = max(self.flushTarget, target)
+                self.cond.notify_all()
+                while self.flushedSize < target and self.flusher is not None and self.flushError is None:
+                    self.cond.wait()
+                if self.flushedSize >= target:
+                    return
+                if self.flushError is not None:
+                    raise self.flushError
+        finally:
+            self.cond.release()
+        self.writeBuffer()
+
+    def writeBuffer(self) -> None:
+        '''
+        把缓冲区中的日志写入文件, 每段一次写入, 再 fsync 写过的段
+        写完之后准备好下一段
+        写入失败时记下错误并唤醒等待的线程, 让它们抛出这个错误; fsync 失败之后页缓存中的数据是否落盘无法确定, 所以不再重试
+        '''
+        self.flushLock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                if self.flushError is not None:
+                    raise self.flushError
+                count = len(self.buffer)
+                if count == 0:
+                    return
+                logs = self.buffer[:count]
+            finally:
+                self.lock.release()
+            written = []
+            size = 0
+            i = 0
+            try:
+                while i < count:
+                    segment = self.segmentOf(logs[i][0])
+                    j = i
+                    while j < count and self.segmentOf(logs[j][0]) == segment:
+                        j += 1
+                    if segment > self.preparedSegment:
+                        self.prepareSegment(segment)
+                    data = b''.join([log for _, log in logs[i : j]])
+                    f = self.segmentFile(segment)
+                    f.write(logs[i][0] - self.segmentStart(segment), data)
+                    written.append(f)
+                    size += len(data)
+                    i = j
+                for f in written:
+                    f.sync()
+            except Exception as e:
+                self.cond.acquire()
+                try:
+                    self.flushError = e
+                    self.cond.notify_all()
+                finally:
+                    self.cond.release()
+                raise
+            position, log = logs[-1]
+            self.cond.acquire()
+            try:
+                del self.buffer[:count]
+                self.bufferSize -= size
+                self.flushedSize = position + len(log)
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+            # 等待的线程已经被唤醒, 之后再准备下一段, 写到下一段时不需要等待创建文件
+            if self.preparedSegment <= segment:
+                self.prepareSegment(segment + 1)
+        finally:
+            self.flushLock.release()
+
+    def startFlusher(self, interval: float = FLUSH_INTERVAL, batchSize: int = FLUSH_BATCH_SIZE) -> None:
+        '''
+        启动刷盘线程, 每隔 interval 秒, 或者缓冲区超过 batchSize 字节, 或者有事务在等待提交时写一次缓冲区
+        interval 不大于 0 时不启动, 由等待落盘的线程自己写
+        '''
+        self.batchSize = batchSize
+        if interval <= 0 or self.flusher is not None:
+            return
+        self.flusherStop = False
+        self.flusher = threading.Thread(target = self.runFlusher, args = (interval,), daemon = True)
+        self.flusher.start()
+
+    def stopFlusher(self) -> None:
+        '''
+        停止刷盘线程并写入缓冲区中剩下的日志, 之前写入失败时剩下的日志不再写入
+        '''
+        self.cond.acquire()
+        try:
+            flusher = self.flusher
+            self.flusherStop = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        if flusher is not None:
+            flusher.join()
+        self.cond.acquire()
+        try:
+            self.flusher = None
+            # 还在等待的线程改为自己写
+            self.cond.notify_all()
+            if self.flushError is not None:
+                return
+        finally:
+            self.cond.release()
+        self.writeBuffer()
+
+    def runFlusher(self, interval: float) -> None:
+        while True:
+            self.cond.acquire()
+            try:
+                if not self.flusherStop and self.flushTarget <= self.flushedSize and self.bufferSize < self.batchSize:
+                    self.cond.wait(interval)
+                if self.flusherStop:
+                    return
+            finally:
+                self.cond.release()
+            try:
+                self.writeBuffer()
+            except Exception:
+                # 错误已经交给等待的线程, 不再重试
+                traceback.print_exc()
+                return
+
+    def startArchiver(self, archive: Callable[[str, int], None], interval: float = ARCHIVE_INTERVAL) -> None:
+        '''
+        设置归档回调函数 archive(段文件名, 段号) 并启动归档线程, 写满的段按段号顺序归档
+        回调函数抛出异常时每隔 interval 秒重试; 打开日志时还没有回收的段都会再归档一次, 回调函数需要能重复执行
+        '''
+        if archive is None or self.archiver is not None:
+            return
+        self.archive = archive
+        self.archivedSegment = self.firstSegment - 1
+        self.archiverStop = False
+        self.archiver = threading.Thread(target = self.runArchiver, args = (interval,), daemon = True)
+        self.archiver.start()
+
+    def stopArchiver(self) -> None:
+        self.cond.acquire()
+        try:
+            archiver = self.archiver
+            self.archiverStop = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        if archiver is not None:
+            archiver.join()
+        self.archiver = None
+
+    def runArchiver(self, interval: float) -> None:
+        '''
+        已经落盘的日志到达下一段时, 之前的段不会再写入, 可以归档
+        '''
+        failed = False
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.archiverStop and (failed or self.archivedSegment + 1 >= self.segmentOf(self.flushedSize)):
+                    self.cond.wait(interval)
+                    failed = False
+                if self.archiverStop:
+                    return
+                segment = self.archivedSegment + 1
+            finally:
+                self.cond.release()
+            try:
+                self.archive(segmentName(self.path, segment), segment)
+            except Exception:
+                traceback.print_exc()
+                failed = True
+                continue
+            self.cond.acquire()
+            try:
+                self.archivedSegment = segment
+            finally:
+                self.cond.release()
+
+    def tail(self) -> int:
+        '''
+        下一条 [log] 将要写入的位置
         '''
         self.lock.acquire()
         try:
-            log = self.internNext()
-            if log == None:
-                return None
-            return log[OF_DATA : len(log)]
+            return self.fileSize
         finally:
             self.lock.release()
-    
-    def internNext(self) -> None | bytearray:
-        '''
-        读取 [log] 的具体实现, 同时更新 position
-        '''
-        if self.position + OF_DATA >= self.fileSize:
-            return None
-        # 读取size
-        with open(self.file, "rb+") as f:
-            f.seek(self.position)
-            tmp = f.read(4)
-        f.close()
-        size = struct.unpack(">i", tmp)[0]
-        if self.position + OF_DATA + size > self.fileSize:
-            return None
-        # 读取checkSum + data
-        with open(self.file, "rb+") as f:
-            f.seek(self.position)
-            buf = f.read(OF_DATA + size)
-        f.close()
-        log = bytearray(buf)
-        checkSum1 = self.calChecksum(0, log[OF_DATA : len(log)])
-        checkSum2 = struct.unpack(">i", log[OF_CHECKSUM : OF_DATA])[0]
-        if checkSum1 != checkSum2:
-            return None
-        self.position += len(log)
-        return log
-
-    def updateXChecksum(self, log: bytearray | bytes) -> None:
-        '''
-        一条 [log] 变动时, 要修改 XChecksum
-        '''
-        self.xChecksum = self.calChecksum(self.xChecksum, log)
-        with open(self.file, 'rb+') as f:
-            f.seek(0, 0)
-            f.write(struct.pack(">i", self.xChecksum))
-        f.close()
+
+    def sync(self) -> None:
+        '''
+        把缓冲区中所有的日志刷到磁盘上
+        '''
+        self.flush()
+
+    def next(self) -> None | memoryview:
+        '''
+        读取 position 位置的 [log]
+        '''
+        for _, log in self.scan(self.position, OF_DATA):
+            return log[OF_DATA : len(log)]
+        return None
+
+    def scan(self, position: int, chunkSize: int = READ_CHUNK) -> Iterator[tuple]:
+        '''
+        从 position 开始顺序读取 [log], 依次返回 (日志位置, 完整 [log] 的 memoryview), 同时更新 position
+        每次从段文件中读入 chunkSize 字节, 读到 [End] 时转到下一段, 读到 BadTail 或已经落盘的日志末尾时结束
+        迭代期间不持有锁, 调用者需要保证读到的段不会被回收
+        '''
+        self.position = position
+        if position < self.start:
+            return
+        end = self.flushedSize
+        segment = -1
+        f = None
+        chunk = memoryview(b'')
+        chunkStart = position
+        while position + OF_DATA <= end:
+            if self.segmentOf(position) != segment:
+                segment = self.segmentOf(position)
+                if not self.checkSegment(segment):
+                    return
+                f = self.segmentFile(segment)
+                chunk = memoryview(b'')
+                chunkStart = position
+            segmentEnd = min(self.segmentStart(segment + 1), end)
+            of = position - self.segmentStart(segment)
+            if of < HEADER_SIZE:
+                position += HEADER_SIZE - of
+                continue
+            if position + OF_DATA > segmentEnd:
+                position = self.segmentStart(segment + 1) + HEADER_SIZE
+                continue
+            of = position - chunkStart
+            if of + OF_DATA > len(chunk):
+                chunkStart = position
+                chunk = memoryview(f.read(position - self.segmentStart(segment), min(chunkSize, segmentEnd - position)))
+                of = 0
+                if len(chunk) < OF_DATA:
+                    return
+            size = struct.unpack(">i", chunk[of + OF_SIZE : of + OF_CHECKSUM])[0]
+            checksum = struct.unpack(">I", chunk[of + OF_CHECKSUM : of + OF_DATA])[0]
+            if size == END_MARKER:
+                if checksum != self.calChecksum(position, b''):
+                    return
+                position = self.segmentStart(segment + 1) + HEADER_SIZE
+                continue
+            if size <= 0 or position + OF_DATA + size > segmentEnd:
+                return
+            if of + OF_DATA + size > len(chunk):
+                # [log] 跨过了块的末尾, 从它开始重新读一块
+                chunkStart = position
+                chunk = memoryview(f.read(position - self.segmentStart(segment), min(max(chunkSize, OF_DATA + size), segmentEnd - position)))
+                of = 0
+                if len(chunk) < OF_DATA + size:
+                    return
+            log = chunk[of : of + OF_DATA + size]
+            if self.calChecksum(position, log[OF_DATA : len(log)]) != checksum:
+                return
+            self.position = position + len(log)
+            yield (position, log)
+            position += len(log)
+
+    def records(self, position: int = -1) -> Iterator[tuple]:
+        '''
+        从 position 开始顺序读取日志, 依次返回 (日志位置, [Data] 的 memoryview), position 为 -1 时从头开始
+        '''
+        if position < 0:
+            position = self.start
+        for position, log in self.scan(position):
+            yield (position, log[OF_DATA : len(log)])
 
     def truncate(self, x: int) -> None:
         '''
-        截断 log 文件前 x 部分
+        截掉 x 之后的日志: x 所在段中之后的内容清零, 之后的段全部删除, 只在缓冲区为空时调用
+        之后的段中可能有崩溃时没有写完的日志, 它们的位置会被重新使用, 不能留下
         '''
+        self.flushLock.acquire()
+        try:
+            segment = self.segmentOf(x)
+            for s in listSegments(self.path):
+                if s > segment:
+                    self.removeSegment(s)
+            if segment == self.firstSegment or self.checkSegment(segment):
+                f = self.segmentFile(segment)
+                f.truncate(max(x - self.segmentStart(segment), HEADER_SIZE))
+                f.allocate(0, self.segmentSize)
+                f.sync()
+                self.preparedSegment = segment
+            else:
+                if segment in listSegments(self.path):
+                    self.removeSegment(segment)
+                self.preparedSegment = segment - 1
+            self.lock.acquire()
+            try:
+                self.fileSize = x
+                self.flushedSize = x
+            finally:
+                self.lock.release()
+        finally:
+            self.flushLock.release()
+
+    def removeSegment(self, segment: int) -> None:
         self.lock.acquire()
         try:
-            with open(self.file, "rb+") as f:
-                f.truncate(x)
-            f.close()
+            f = self.files.pop(segment, None)
         finally:
             self.lock.release()
+        if f is not None:
+            f.close()
+        name = segmentName(self.path, segment)
+        os.remove(name)
+        syncDirectory(name)
+
+    def recycle(self, position: int) -> None:
+        '''
+        回收 position 所在段之前的所有段, position 之前的日志都不再需要
+        回收的段改名为之后的段重复使用, 已经准备好的段足够时直接删除; 设置了归档回调函数时, 还没有归档的段暂时保留
+        '''
+        self.flushLock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                last = min(self.segmentOf(position), self.segmentOf(self.flushedSize))
+                if self.archive is not None:
+                    last = min(last, self.archivedSegment + 1)
+                if last <= self.firstSegment:
+                    return
+                segments = list(range(self.firstSegment, last))
+                self.firstSegment = last
+                self.start = self.segmentStart(last) + HEADER_SIZE
+                current = self.segmentOf(self.fileSize)
+                files = [self.files.pop(s, None) for s in segments]
+            finally:
+                self.lock.release()
+            for f in files:
+                if f is not None:
+                    f.close()
+            for s in segments:
+                name = segmentName(self.path, s)
+                if self.preparedSegment - current >= MAX_PREPARED_SEGMENTS:
+                    os.remove(name)
+                    syncDirectory(name)
+                    continue
+                # 段中残留的旧日志位置不同, 校验不会通过, 只需要改写文件头
+                segment = self.preparedSegment + 1
+                target = segmentName(self.path, segment)
+                os.replace(name, target)
+                f = RandomAccessFile(target)
+                f.write(0, self.header(segment, self.segmentStart(segment) + HEADER_SIZE))
+                f.sync()
+                syncDirectory(target)
+                self.lock.acquire()
+                try:
+                    self.files[segment] = f
+                    self.preparedSegment = segment
+                finally:
+                    self.lock.release()
+        finally:
+            self.flushLock.release()
 
     def rewind(self) -> None:
-        self.position = OF_XCHECKSUM
+        self.position = self.start
 
-def create(path: str) -> Logger:
+    def seek(self, position: int) -> None:
+        '''
+        把日志指针移到 position, position 需要是某条 [log] 的起始位置
+        '''
+        self.position = position
+
+    def close(self) -> None:
+        self.stopFlusher()
+        self.stopArchiver()
+        self.lock.acquire()
+        try:
+            files = list(self.files.values())
+            self.files.clear()
+        finally:
+            self.lock.release()
+        for f in files:
+            f.close()
+
+def segmentName(path: str, segment: int) -> str:
+    return "%s%s.%016x" % (path, LOG_SUFFIX, segment)
+
+def listSegments(path: str) -> list:
     '''
-    创建 log 文件
+    按段号排列的所有段
     '''
-    fileName = path + LOG_SUFFIX
-    with open(fileName, 'wb+') as f:
-        f.seek(0, 0)
-        f.write(struct.pack('>i', 0))
-    f.close()
-    return Logger(fileName)
-
-def fileopen(path: str) -> Logger:
+    directory = os.path.dirname(path) or '.'
+    prefix = os.path.basename(path) + LOG_SUFFIX + '.'
+    segments = []
+    for name in os.listdir(directory):
+        suffix = name[len(prefix) : ]
+        if name.startswith(prefix) and len(suffix) == 16:
+            try:
+                segments.append(int(suffix, 16))
+            except ValueError:
+                pass
+    segments.sort()
+    return segments
+
+def syncDirectory(fileName: str) -> None:
     '''
-    打开 log 文件
+    新建, 改名和删除段文件之后 fsync 所在的目录, 不支持时跳过
     '''
-    fileName = path + LOG_SUFFIX
-    lg = Logger(fileName)
+    try:
+        fd = os.open(os.path.dirname(fileName) or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def archiveToDirectory(directory: str) -> Callable[[str, int], None]:
+    '''
+    返回一个归档回调函数, 把段文件复制到 directory 中, 先写临时文件再改名, 同名的文件直接覆盖
+    '''
+    os.makedirs(directory, exist_ok = True)
+    def archive(fileName: str, segment: int) -> None:
+        target = os.path.join(directory, os.path.basename(fileName))
+        tmp = target + ARCHIVE_TMP_SUFFIX
+        shutil.copyfile(fileName, tmp)
+        f = RandomAccessFile(tmp)
+        try:
+            f.sync()
+        finally:
+            f.close()
+        os.replace(tmp, target)
+    return archive
+
+def create(path: str, segmentSize: int = SEGMENT_SIZE) -> Logger:
+    '''
+    创建日志, 只有第 0 段, 旧的日志文件都删除
+    '''
+    for s in listSegments(path):
+        os.remove(segmentName(path, s))
+    if LegacyLogger.exists(path):
+        os.remove(path + LOG_SUFFIX)
+    lg = Logger(path, segmentSize)
+    lg.prepareSegment(0)
+    lg.fileSize = HEADER_SIZE
+    lg.flushedSize = HEADER_SIZE
+    lg.rewind()
+    return lg
+
+def fileopen(path: str) -> Logger | LegacyLogger.LegacyLogger:
+    '''
+    打开日志
+    还有旧版本的单文件日志时打开旧日志用于恢复, 转换时崩溃留下的段都删除
+    '''
+    if LegacyLogger.exists(path):
+        for s in listSegments(path):
+            os.remove(segmentName(path, s))
+        return LegacyLogger.fileopen(path)
+    lg = Logger(path)
     lg.init()
     return lg
+
+def convert(path: str, legacy: LegacyLogger.LegacyLogger, segmentSize: int = SEGMENT_SIZE) -> Logger:
+    '''
+    把旧版本的单文件日志换成分段日志, 调用者保证旧日志中的修改都已经写回
+    新的日志从旧日志的末尾开始, 日志位置继续增长, 页面上的 PageLsn 仍然有效
+    删除旧日志文件之后转换才算完成
+    '''
+    position = legacy.tail()
+    legacy.close()
+    lg = Logger(path, segmentSize)
+    segment = lg.segmentOf(position)
+    position = max(position, lg.segmentStart(segment) + HEADER_SIZE)
+    lg.prepareSegment(segment, position)
+    lg.firstSegment = segment
+    lg.start = position
+    lg.fileSize = position
+    lg.flushedSize = position
+    lg.rewind()
+    os.remove(path + LOG_SUFFIX)
+    syncDirectory(path + LOG_SUFFIX)
+    return lg
@@ -9,7 +9,16 @@ class Page(object):
         self.data = data
         # dirty 标志着这个页面是否是脏页面, 在缓存驱逐的时候, 脏页面需要被写回磁盘
         self.dirty = False
+        # 页面变脏时的日志位置, 不晚于页面上第一个还没有写回的修改对应的日志, 干净的页面为 None
+        self.recLsn = None
+        # 读入之后最近一次修改对应的日志位置, 写回页面之前日志至少要落盘到这里, 0 表示没有需要先落盘的日志
+        self.lsn = 0
         self.Lock = threading.RLock()
+        # 正在修改页面上 DataItem 的线程数, 写回时要等它们都完成才能复制页面
+        self.writers = 0
+        # 等待复制页面的线程数, 有线程在等时新的修改先等复制完成, 写回不会一直等下去
+        self.copying = 0
+        self.cond = threading.Condition(self.Lock)
 
         self.pc = pc
 
@@ -22,7 +31,41 @@ class Page(object):
     def release(self) -> None:
         self.pc.release(self)
 
+    def beginWrite(self) -> None:
+        '''
+        修改页面上的 DataItem 之前调用, 直到 endWrite 之前页面都不会被复制写回
+        '''
+        with self.cond:
+            while self.copying > 0:
+                self.cond.wait()
+            self.writers += 1
+
+    def endWrite(self) -> None:
+        with self.cond:
+            self.writers -= 1
+            if self.writers == 0:
+                self.cond.notify_all()
+
+    def lockForCopy(self) -> None:
+        '''
+        获取页面锁, 并等待进行中的 DataItem 修改都完成, 之后可以复制出一个完整的页面, 由 unlock 释放
+        '''
+        self.Lock.acquire()
+        self.copying += 1
+        try:
+            while self.writers > 0:
+                self.cond.wait()
+        finally:
+            self.copying -= 1
+            if self.copying == 0:
+                self.cond.notify_all()
+
     def setDirty(self, dirty: bool) -> None:
+        '''
+        修改页面之前要先标记脏页面, 再写对应的日志, recLsn 才不会晚于这条日志
+        '''
+        if dirty and self.recLsn is None and self.pc is not None:
+            self.recLsn = self.pc.currentLsn()
         self.dirty = dirty
 
     def isDirty(self) -> None:
@@ -0,0 +1,33 @@
+# 空闲空间映射页(FSM): 依次记录普通页面的空闲空间, 打开数据库时读入这些页面就能建立 PageIndex, 不需要扫描整个数据文件
+# 每一项是一个 2 字节无符号数, 第 k 个 FSM 页记录页号在 [k * ENTRIES_PER_PAGE, (k + 1) * ENTRIES_PER_PAGE) 内的页面
+# NOT_HEAP 表示对应的页面不是普通页面(PageOne, FSM 页本身)或者还不存在
+import struct
+from backend.dm.pageCache import PageCache
+from backend.dm.page.Page import Page
+
+LEN_ENTRY = 2
+ENTRIES_PER_PAGE = PageCache.PAGE_SIZE // LEN_ENTRY
+NOT_HEAP = 0xFFFF
+
+def initRaw() -> bytearray | bytes:
+    '''
+    生成初始化的数据, 所有项都是 NOT_HEAP
+    '''
+    return bytearray(b'\xff' * PageCache.PAGE_SIZE)
+
+def entryOf(pgno: int) -> tuple:
+    '''
+    页号 pgno 对应的 (第几个 FSM 页, 页内第几项)
+    '''
+    return (pgno // ENTRIES_PER_PAGE, pgno % ENTRIES_PER_PAGE)
+
+def setFreeSpace(pg: Page, kth: int, freeSpace: int) -> None:
+    pg.setDirty(True)
+    offset = kth * LEN_ENTRY
+    pg.data[offset : offset + LEN_ENTRY] = struct.pack('>H', freeSpace)
+
+def getFreeSpaces(pg: Page) -> tuple:
+    '''
+    一次解析出整页的所有项
+    '''
+    return struct.unpack('>%dH' % ENTRIES_PER_PAGE, pg.data[0 : ENTRIES_PER_PAGE * LEN_ENTRY])
@@ -1,17 +1,43 @@
 # 第一页: 特殊管理页
+# 0 ~ 3 字节是魔数, 4 ~ 7 字节是数据文件的格式版本, 打开时版本不一致的数据库直接拒绝, 不会再去读它的日志和 xid 文件
 # 在每次数据库启动时,会生成一串随机字节,存储在 100 ~ 107 字节.在数据库正常关闭时,会将这串字节拷贝到第一页的 108 ~ 115 字节.
+# 116 ~ 123 字节记录最近一次检查点日志的位置, 0 表示还没有做过检查点
+# 124 ~ 127 字节记录正常关闭时已经使用的页数(高水位), 数据文件按区段预分配, 文件长度可能大于这个值
+# 128 ~ 129 字节记录 FSM 页的个数, 之后每 4 字节依次记录一个 FSM 页的页号
 import os
+import struct
 from backend.dm.pageCache import PageCache
 from backend.dm.page.Page import Page
 
+OF_MAGIC = 0
+DATA_MAGIC = b'LDBD'
+OF_FORMAT_VERSION = OF_MAGIC + 4
+# 槽页布局, 行外存储, 页面 LSN 等都改变了页面格式, 之前的数据文件没有这个标记
+DATA_FORMAT_VERSION = 1
+LEN_FORMAT = OF_FORMAT_VERSION + 4
 OF_VC = 100
 LEN_VC = 8
+OF_CHECKPOINT = OF_VC + 2 * LEN_VC
+LEN_CHECKPOINT = 8
+OF_PAGE_NUMBER = OF_CHECKPOINT + LEN_CHECKPOINT
+LEN_PAGE_NUMBER = 4
+OF_FSM_COUNT = OF_PAGE_NUMBER + LEN_PAGE_NUMBER
+OF_FSM_PAGES = OF_FSM_COUNT + 2
+MAX_FSM_PAGES = (PageCache.PAGE_SIZE - OF_FSM_PAGES) // 4
 
 def InitRaw() -> bytearray | bytes:
     raw = bytearray(PageCache.PAGE_SIZE)
+    raw[OF_MAGIC : LEN_FORMAT] = DATA_MAGIC + struct.pack('>I', DATA_FORMAT_VERSION)
     setVcOpen_raw(raw)
     return raw
 
+def checkFormat_raw(raw: bytearray | bytes) -> bool:
+    '''
+    数据文件的格式版本是否和当前版本一致
+    '''
+    return len(raw) >= LEN_FORMAT and raw[OF_MAGIC : OF_FORMAT_VERSION] == DATA_MAGIC \
+        and struct.unpack('>I', raw[OF_FORMAT_VERSION : LEN_FORMAT])[0] == DATA_FORMAT_VERSION
+
 def setVcOpen_raw(raw: bytearray | bytes) -> None:
     '''
     打开时传递随机字节
@@ -42,3 +68,39 @@ def checkVc_raw(raw: bytearray | bytes) -> bool:
 
 def checkVc_page(pg: Page) -> bool:
     return checkVc_raw(pg.getData())
+
+
+def setCheckpoint_page(pg: Page, position: int) -> None:
+    '''
+    记录最近一次检查点日志的位置
+    '''
+    pg.setDirty(True)
+    pg.data[OF_CHECKPOINT : OF_CHECKPOINT + LEN_CHECKPOINT] = struct.pack('>q', position)
+
+def getCheckpoint_page(pg: Page) -> int:
+    return struct.unpack('>q', pg.getData()[OF_CHECKPOINT : OF_CHECKPOINT + LEN_CHECKPOINT])[0]
+
+def setPageNumber_page(pg: Page, pageNumber: int) -> None:
+    '''
+    记录已经使用的页数
+    '''
+    pg.setDirty(True)
+    pg.data[OF_PAGE_NUMBER : OF_PAGE_NUMBER + LEN_PAGE_NUMBER] = struct.pack('>i', pageNumber)
+
+def getPageNumber_page(pg: Page) -> int:
+    return struct.unpack('>i', pg.getData()[OF_PAGE_NUMBER : OF_PAGE_NUMBER + LEN_PAGE_NUMBER])[0]
+
+def setFsmPages_page(pg: Page, fsmPages: list) -> None:
+    '''
+    记录所有 FSM 页的页号
+    '''
+    if len(fsmPages) > MAX_FSM_PAGES:
+        raise Exception("DatabaseTooLargeException")
+    pg.setDirty(True)
+    raw = struct.pack('>H', len(fsmPages)) + struct.pack('>%di' % len(fsmPages), *fsmPages)
+    pg.data[OF_FSM_COUNT : OF_FSM_COUNT + len(raw)] = raw
+
+def getFsmPages_page(pg: Page) -> list:
+    raw = pg.getData()
+    count = struct.unpack('>H', raw[OF_FSM_COUNT : OF_FSM_PAGES])[0]
+    return list(struct.unpack('>%di' % count, raw[OF_FSM_PAGES : OF_FSM_PAGES + 4 * count]))
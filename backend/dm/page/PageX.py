@@ -1,62 +1,242 @@
-# 一个普通页面以一个 2 字节无符号数起始, 表示这一页的空闲位置的偏移, 剩下的部分都是实际存储的数据
+# 普通页面采用槽式结构:
+# [DataLen] [SlotCount] [Garbage] [FreeSlots] [PageLsn] [Slot 0] [Slot 1] ... [空闲空间] ... [数据]
+# PageLsn 是最后一条作用到这个页面上的日志的位置, 重做时跳过不晚于它的日志
+# 槽目录从页头向后增长, 数据从页尾向前增长, DataLen 是页尾数据区的长度, 全 0 的页面就是一个空页面
+# 每个槽 [Offset] [Length] [Gen], Offset 为 0 表示槽已释放
+# 释放的数据留在数据区中计入 Garbage, 整理页面时才真正回收
+# 释放的槽可以被之后的插入复用, 复用时 Gen 加 1; uid 中带有 Gen, 索引中残留的旧 uid 不会指向复用后的数据
 import struct
 from backend.dm.pageCache import PageCache
 from backend.dm.page.Page import Page
 
-OF_FREE = 0
-OF_DATA = 2
-MAX_FREE_SPACE = (PageCache.PAGE_SIZE) - OF_DATA
-    
+OF_DATA_LEN = 0
+OF_SLOT_COUNT = OF_DATA_LEN + 2
+OF_GARBAGE = OF_SLOT_COUNT + 2
+OF_FREE_SLOTS = OF_GARBAGE + 2
+OF_LSN = OF_FREE_SLOTS + 2
+OF_SLOTS = OF_LSN + 8
+
+# 槽的大小
+SLOT_SIZE = 6
+GEN_MASK = (1 << 16) - 1
+MAX_FREE_SPACE = PageCache.PAGE_SIZE - OF_SLOTS - SLOT_SIZE
+
 def initRaw() -> bytearray | bytes:
     '''
     生成初始化的数据
     '''
-    raw = bytearray(PageCache.PAGE_SIZE)
-    setFSO(raw, OF_DATA)
-    return raw
+    return bytearray(PageCache.PAGE_SIZE)
+
+def getField(raw: bytearray | bytes, offset: int) -> int:
+    return struct.unpack('>H', raw[offset : offset + 2])[0]
+
+def setField(raw: bytearray | bytes, offset: int, value: int) -> None:
+    raw[offset : offset + 2] = struct.pack('>H', value)
+
+def getLsn(pg: Page) -> int:
+    return struct.unpack('>q', pg.data[OF_LSN : OF_SLOTS])[0]
+
+def setLsn(pg: Page, lsn: int) -> None:
+    '''
+    记下作用到页面上的日志的位置, 调用者持有页面锁
+    同时记在 Page 对象中, 写回页面之前日志至少要落盘到这里
+    '''
+    if lsn > getLsn(pg):
+        pg.data[OF_LSN : OF_SLOTS] = struct.pack('>q', lsn)
+    if lsn > pg.lsn:
+        pg.lsn = lsn
+
+def slotOffset(slot: int) -> int:
+    return OF_SLOTS + slot * SLOT_SIZE
 
-def setFSO(raw: bytearray | bytes, ofData: int) -> None:
+def getSlot(raw: bytearray | bytes, slot: int) -> tuple:
     '''
-    设置空闲位置的偏移
+    第 slot 个槽的 (Offset, Length, Gen)
     '''
-    of_data_bytes = struct.pack('>h', ofData)
-    raw[OF_FREE : OF_FREE + OF_DATA] = of_data_bytes
+    of = slotOffset(slot)
+    return struct.unpack('>HHH', raw[of : of + SLOT_SIZE])
 
-def getFSO_page(pg: Page) -> bytearray | bytes:
-    return getFSO_raw(pg.data)
+def setSlot(raw: bytearray | bytes, slot: int, offset: int, length: int, gen: int) -> None:
+    of = slotOffset(slot)
+    raw[of : of + SLOT_SIZE] = struct.pack('>HHH', offset, length, gen)
 
-def getFSO_raw(raw: bytearray | bytes) -> bytearray | bytes:
-    return struct.unpack('>h', raw[0 : 2])[0]
+def getFSO_page(pg: Page) -> int:
+    '''
+    数据区的起始位置, 即空闲空间的结束位置
+    '''
+    return PageCache.PAGE_SIZE - getField(pg.data, OF_DATA_LEN)
 
-def insert(pg: Page, raw: bytearray | bytes) -> int:
+def isValidPage(pg: Page) -> bool:
     '''
-    将 raw 插入 pg 中, 返回插入位置
+    检查页头是否合法
     '''
-    pg.setDirty(True)
-    offset = getFSO_raw(pg.data)
-    pg.data[offset : offset + len(raw)] = raw
-    setFSO(pg.data, (offset + len(raw)) & ((1 << 16) - 1))
-    return offset
+    raw = pg.data
+    count = getField(raw, OF_SLOT_COUNT)
+    return slotOffset(count) <= getFSO_page(pg) and getField(raw, OF_GARBAGE) <= getField(raw, OF_DATA_LEN) \
+        and getField(raw, OF_FREE_SLOTS) <= count
+
+def slotNeeded(raw: bytearray | bytes) -> int:
+    '''
+    插入时是否需要新的槽
+    '''
+    if getField(raw, OF_FREE_SLOTS) > 0:
+        return 0
+    return SLOT_SIZE
+
+def getContiguousFreeSpace(pg: Page) -> int:
+    '''
+    不整理页面就能插入的数据大小
+    '''
+    raw = pg.data
+    free = getFSO_page(pg) - slotOffset(getField(raw, OF_SLOT_COUNT)) - slotNeeded(raw)
+    return max(free, 0)
 
 def getFreeSpace(pg: Page) -> int:
     '''
-    获取页面的空闲空间大小
+    获取页面的空闲空间大小, 包括整理页面后可以回收的空间
+    '''
+    raw = pg.data
+    free = getFSO_page(pg) - slotOffset(getField(raw, OF_SLOT_COUNT)) - slotNeeded(raw) + getField(raw, OF_GARBAGE)
+    return max(free, 0)
+
+def getItem(pg: Page, slot: int, gen: int) -> tuple | None:
+    '''
+    第 slot 个槽中第 gen 代数据的 (Offset, Length), 槽已释放或已被复用时返回 None
+    '''
+    raw = pg.data
+    if slot >= getField(raw, OF_SLOT_COUNT):
+        return None
+    offset, length, slotGen = getSlot(raw, slot)
+    if offset == 0 or slotGen != gen:
+        return None
+    return (offset, length)
+
+def nextSlot(pg: Page) -> tuple:
+    '''
+    下一次插入使用的 (槽号, Gen), 优先复用已释放的槽
     '''
-    return PageCache.PAGE_SIZE - (getFSO_raw(pg.data) & ((1 << 32) - 1))
+    raw = pg.data
+    count = getField(raw, OF_SLOT_COUNT)
+    if getField(raw, OF_FREE_SLOTS) > 0:
+        for slot in range(count):
+            offset, _, gen = getSlot(raw, slot)
+            if offset == 0:
+                return (slot, (gen + 1) & GEN_MASK)
+    return (count, 0)
+
+def ensureSlot(pg: Page, slot: int) -> None:
+    '''
+    槽目录扩展到包含第 slot 个槽, 新增的槽都是已释放的状态, 下一代为 0
+    '''
+    raw = pg.data
+    count = getField(raw, OF_SLOT_COUNT)
+    if slot < count:
+        return
+    if slotOffset(slot + 1) > getFSO_page(pg):
+        compact(pg)
+    for i in range(count, slot + 1):
+        setSlot(raw, i, 0, 0, GEN_MASK)
+    setField(raw, OF_SLOT_COUNT, slot + 1)
+    setField(raw, OF_FREE_SLOTS, getField(raw, OF_FREE_SLOTS) + slot + 1 - count)
+
+def insert(pg: Page, raw: bytearray | bytes, slot: int, gen: int) -> None:
+    '''
+    将 raw 作为第 gen 代数据插入 pg 的第 slot 个槽
+    连续空间需要足够, 不够时由调用者先整理页面
+    '''
+    pg.setDirty(True)
+    data = pg.data
+    ensureSlot(pg, slot)
+    dataLen = getField(data, OF_DATA_LEN) + len(raw)
+    offset = PageCache.PAGE_SIZE - dataLen
+    data[offset : offset + len(raw)] = raw
+    setField(data, OF_DATA_LEN, dataLen)
+    setSlot(data, slot, offset, len(raw), gen)
+    setField(data, OF_FREE_SLOTS, getField(data, OF_FREE_SLOTS) - 1)
+
+def free(pg: Page, slot: int) -> None:
+    '''
+    释放第 slot 个槽, 数据占用的空间计入 Garbage, 槽保留 Gen 留作墓碑
+    '''
+    pg.setDirty(True)
+    data = pg.data
+    offset, length, gen = getSlot(data, slot)
+    if offset == 0:
+        return
+    setSlot(data, slot, 0, 0, gen)
+    setField(data, OF_GARBAGE, getField(data, OF_GARBAGE) + length)
+    setField(data, OF_FREE_SLOTS, getField(data, OF_FREE_SLOTS) + 1)
+
+def compact(pg: Page) -> None:
+    '''
+    整理页面, 把所有有效数据紧凑地移到页尾, 回收被释放的空间
+    数据的槽号不变, 只修改槽中的 Offset, 调用者需要保证没有其它线程持有指向页面内部的引用
+    '''
+    pg.setDirty(True)
+    data = pg.data
+    live = []
+    for slot in range(getField(data, OF_SLOT_COUNT)):
+        offset, length, gen = getSlot(data, slot)
+        if offset != 0:
+            live.append((offset, slot, length, gen))
+    # 从最靠近页尾的数据开始往后移, 目标位置不会覆盖还没有移动的数据
+    live.sort(reverse = True)
+    end = PageCache.PAGE_SIZE
+    for offset, slot, length, gen in live:
+        end -= length
+        if end != offset:
+            data[end : end + length] = bytes(data[offset : offset + length])
+            setSlot(data, slot, end, length, gen)
+    setField(data, OF_DATA_LEN, PageCache.PAGE_SIZE - end)
+    setField(data, OF_GARBAGE, 0)
+
+def recoverInsert(pg: Page, raw: bytearray | bytes, slot: int, gen: int) -> None:
+    '''
+    重做插入
+    槽中已经是这一代的数据时原地覆盖; 这一代已经被释放, 或者槽已经被复用时跳过
+    '''
+    pg.setDirty(True)
+    ensureSlot(pg, slot)
+    offset, length, slotGen = getSlot(pg.data, slot)
+    if offset != 0:
+        if slotGen == gen and length == len(raw):
+            pg.data[offset : offset + length] = raw
+        return
+    if slotGen != (gen - 1) & GEN_MASK:
+        return
+    if getContiguousFreeSpace(pg) < len(raw):
+        compact(pg)
+    insert(pg, raw, slot, gen)
+
+def recoverFree(pg: Page, slot: int, gen: int) -> None:
+    '''
+    让第 slot 个槽成为已释放的第 gen 代, 用于重做释放和撤销插入
+    第 gen 代数据还没有写入页面时也要把 Gen 推进, 避免之后复用的槽与索引中残留的 uid 相同
+    '''
+    pg.setDirty(True)
+    ensureSlot(pg, slot)
+    offset, length, slotGen = getSlot(pg.data, slot)
+    if offset != 0 and slotGen == gen:
+        free(pg, slot)
+    elif offset == 0 and slotGen == (gen - 1) & GEN_MASK:
+        setSlot(pg.data, slot, 0, 0, gen)
 
-def recoverInsert(pg: Page, raw: bytearray | bytes, offset: int) -> None:
+def recoverUpdate(pg: Page, raw: bytearray | bytes, slot: int, gen: int) -> None:
     '''
-    将 raw 插入 pg 中的 offset 位置, 并将 pg 的 offset 设置为较大的 offset
+    将 raw 写入第 slot 个槽中第 gen 代的数据, 数据已经被释放时跳过
     '''
+    item = getItem(pg, slot, gen)
+    if item == None or item[1] != len(raw):
+        return
     pg.setDirty(True)
-    pg.data[offset : offset + len(raw)] = raw
-    rawFSO = getFSO_raw(pg.data)
-    if rawFSO < offset + len(raw):
-        setFSO(pg.data, (offset + len(raw)) & ((1 << 16) - 1))
+    pg.data[item[0] : item[0] + len(raw)] = raw
 
-def recoverUpdate(pg: Page, raw: bytearray | bytes, offset: int) -> None:
+def recoverUpdateRange(pg: Page, length: int, offset: int, raw: bytearray | bytes, slot: int, gen: int) -> None:
     '''
-    将 raw 插入 pg 中的 offset 位置, 不更新 offset
+    将 raw 写入第 slot 个槽中第 gen 代数据的 offset 处, 数据已经被释放或长度不是 length 时跳过
     '''
+    item = getItem(pg, slot, gen)
+    if item == None or item[1] != length:
+        return
     pg.setDirty(True)
-    pg.data[offset : offset + len(raw)] = raw
\ No newline at end of file
+    pg.data[item[0] + offset : item[0] + offset + len(raw)] = raw
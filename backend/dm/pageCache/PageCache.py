@@ -1,37 +1,176 @@
+import mmap
 import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from backend.dm.page import Page
 from backend.common.AbstractCache import AbstractClass
+from backend.common.RandomAccessFile import RandomAccessFile
 
 # 每个页面默认 8kb, 如果需要对大数据的更快速写入, 可以适当增大这个值
 PAGE_SIZE = 1 << 13
 MEM_MIN_LIM = 10
 DB_SUFFIX = '.db'
+# 数据文件每次增长的页数, 一次预分配整个区段, 不必每开一页都扩展一次文件
+EXTENT_PAGES = 64
+# 全 0 的页面, 预分配的空间读出来就是全 0, 这样的新页不需要写入
+ZERO_PAGE = bytes(PAGE_SIZE)
+# mmap 模式下每次映射(以及文件增长)的页数, 区段大小需要是 mmap.ALLOCATIONGRANULARITY 的整数倍
+MMAP_EXTENT_PAGES = 64
+MMAP_EXTENT_SIZE = MMAP_EXTENT_PAGES * PAGE_SIZE
+# 后台写线程默认每隔 BGWRITER_INTERVAL 秒最多写回 BGWRITER_MAX_PAGES 个脏页面
+BGWRITER_INTERVAL = 0.2
+BGWRITER_MAX_PAGES = 64
+# 写回时每个条带每批最多钉住容量的 1/BGWRITER_STRIPE_SHARE 个没有被引用的页面
+BGWRITER_STRIPE_SHARE = 4
+# 预读: 连续访问了 SEQUENTIAL_TRIGGER 次相邻的页面后, 异步读入之后的 PREFETCH_WINDOW 个页面
+PREFETCH_WINDOW = 8
+PREFETCH_THREADS = 2
+SEQUENTIAL_TRIGGER = 2
+# 同时跟踪的顺序访问流的个数, 顺序扫描中穿插着对其它页面的访问时也能识别出来
+SEQUENTIAL_STREAMS = 4
 
 class PageCache(AbstractClass):
+    '''
+    缓冲池: 最多缓存 maxResource 个页面
+    被引用的页面不会被驱逐, 引用释放后页面仍留在缓存中, 缓存满时由 CLOCK 算法选出页面驱逐, 脏页面在驱逐时写回
+    '''
     def __init__(self, file: str, maxResource: int):
-        super(PageCache, self).__init__(maxResource)
-        with open(file, 'ab+') as f:
-            f.seek(0, 2)
-            length = f.tell()
-        f.close()
-        self.file = file
+        super(PageCache, self).__init__(maxResource, True)
+        # 数据文件在整个生命周期中只打开一次, 页面读写都是按偏移量的 pread/pwrite
+        self.file = RandomAccessFile(file, True)
+        # fileLock 只保护文件长度的变化, 页面读写不再串行
         self.fileLock = threading.RLock()
-        # pageNumber 记录当前打开的数据库文件有多少页
-        self.pageNumber = length // PAGE_SIZE
+        # allocatedPages 是数据文件中已经分配的页数, 文件按区段增长, 超过 pageNumber 的部分都是全 0 的空页
+        self.allocatedPages = self.file.size() // PAGE_SIZE
+        # pageNumber 记录当前打开的数据库文件有多少页, 即已经使用的页面的高水位
+        self.pageNumber = self.allocatedPages
+        self.bgWriter = None
+        self.bgWriterStop = threading.Event()
+        self.bgWriterStart = 0
+        # 预读窗口, 不大于 0 时关闭预读; I/O 线程池在第一次预读时创建
+        self.prefetchWindow = PREFETCH_WINDOW
+        self.prefetcher = None
+        self.prefetchLock = threading.Lock()
+        self.prefetchClosed = False
+        # 顺序访问检测: 每个访问流最后访问的页号 -> (连续访问相邻页面的次数, 已经预读到的页号)
+        self.streams = OrderedDict()
+        # 写回页面之前调用, 把日志刷到磁盘上(WAL), 由 DataManager 设置
+        self.logFlusher = None
+        # 返回日志末尾的位置, 页面变脏时用来确定 recLsn, 由 DataManager 设置
+        self.logTail = None
+        # 正在写回的页面: 页号 -> 复制时的 recLsn, 复制时清除了脏标记, 写完之前检查点仍然把它们算作脏页面
+        self.inFlight = {}
+        self.inFlightCond = threading.Condition()
 
     def newPage(self, initData: bytearray | bytes) -> int:
         '''
         开一个新页
         '''
-        self.pageNumber += 1
-        pgno = self.pageNumber
-        pg = Page.Page(pgno, initData, None)
-        # 新建的页面需要立刻写回
-        self.flush(pg)
-        return pgno
+        return self.newPages(initData, 1)
+
+    def newPages(self, initData: bytearray | bytes, count: int) -> int:
+        '''
+        连续开 count 个新页, 内容都是 initData, 返回第一页的页号
+        '''
+        self.fileLock.acquire()
+        try:
+            first = self.pageNumber + 1
+            self.pageNumber += count
+            self.allocate(self.pageNumber)
+        finally:
+            self.fileLock.release()
+        # 新建的页面需要立刻写回, 预分配的空间已经是全 0, 全 0 的页面不用再写
+        if bytes(initData) != ZERO_PAGE:
+            for pgno in range(first, first + count):
+                self.flush(Page.Page(pgno, initData, None))
+        return first
+
+    def allocate(self, pgno: int) -> None:
+        '''
+        保证数据文件中至少分配了 pgno 页, 不够时按整个区段预分配, 调用者需要持有 fileLock
+        '''
+        if pgno <= self.allocatedPages:
+            return
+        pages = (pgno + EXTENT_PAGES - 1) // EXTENT_PAGES * EXTENT_PAGES
+        self.file.allocate(self.pageOffset(self.allocatedPages + 1), (pages - self.allocatedPages) * PAGE_SIZE)
+        self.allocatedPages = pages
+
+    def setPageNumber(self, pageNumber: int) -> None:
+        '''
+        打开数据库时, 用 PageOne 中记录的高水位代替文件长度得到的页数
+        '''
+        self.fileLock.acquire()
+        try:
+            if 0 < pageNumber <= self.allocatedPages:
+                self.pageNumber = pageNumber
+        finally:
+            self.fileLock.release()
 
     def getPage(self, pgno: int) -> Page.Page:
-        return super().get(pgno)
+        pg = super().get(pgno)
+        if self.prefetchWindow > 0:
+            self.detectSequential(pgno)
+        return pg
+
+    def detectSequential(self, pgno: int) -> None:
+        '''
+        检测顺序访问, 访问到已预读部分的一半时发出下一批预读, 让预读始终领先于访问
+        '''
+        pgnos = None
+        with self.prefetchLock:
+            if pgno in self.streams:
+                self.streams.move_to_end(pgno)
+                return
+            run, prefetchedUpTo = self.streams.pop(pgno - 1, (-1, 0))
+            run += 1
+            if run >= SEQUENTIAL_TRIGGER and pgno + self.prefetchWindow // 2 >= prefetchedUpTo:
+                start = max(pgno + 1, prefetchedUpTo + 1)
+                end = min(pgno + self.prefetchWindow, self.pageNumber)
+                if start <= end:
+                    pgnos = range(start, end + 1)
+                    prefetchedUpTo = end
+            self.streams[pgno] = (run, prefetchedUpTo)
+            if len(self.streams) > SEQUENTIAL_STREAMS:
+                self.streams.popitem(last = False)
+        if pgnos is not None:
+            self.prefetch(pgnos)
+
+    def prefetch(self, pgnos) -> None:
+        '''
+        异步地把 pgnos 读入缓存, 一批页面交给 I/O 线程池中的一个线程读取
+        之后访问这些页面时就是缓存命中
+        '''
+        if self.prefetchWindow <= 0:
+            return
+        pgnos = [pgno for pgno in pgnos if 0 < pgno <= self.pageNumber]
+        if len(pgnos) == 0:
+            return
+        with self.prefetchLock:
+            if self.prefetchClosed:
+                return
+            if self.prefetcher is None:
+                self.prefetcher = ThreadPoolExecutor(max_workers = PREFETCH_THREADS, thread_name_prefix = "prefetch")
+            self.prefetcher.submit(self.prefetchPages, pgnos)
+
+    def prefetchPages(self, pgnos: list) -> None:
+        for pgno in pgnos:
+            try:
+                self.preload(pgno)
+            except Exception:
+                traceback.print_exc()
+                return
+
+    def stopPrefetcher(self) -> None:
+        '''
+        等待已经发出的预读完成, 之后不再预读
+        '''
+        with self.prefetchLock:
+            self.prefetchClosed = True
+            prefetcher = self.prefetcher
+            self.prefetcher = None
+        if prefetcher is not None:
+            prefetcher.shutdown(wait = True)
 
     def getForCache(self, key: int) -> Page.Page:
         '''
@@ -39,13 +178,7 @@ class PageCache(AbstractClass):
         '''
         pgno = key
         offset = self.pageOffset(pgno)
-        self.fileLock.acquire()
-        try:
-            with open(self.file, 'rb+') as f:
-                f.seek(offset, 0)
-                data = f.read(PAGE_SIZE)
-        finally:
-            self.fileLock.release()
+        data = self.file.read(offset, PAGE_SIZE)
         return Page.Page(pgno, bytearray(data), self)
 
     def releaseForCache(self, pg: Page.Page) -> None:
@@ -54,36 +187,195 @@ class PageCache(AbstractClass):
         '''
         if pg.isDirty():
             self.flush(pg)
-            pg.setDirty(False)
 
     def release(self, pg):
         super().release(pg.pageNumber)
 
     def flush(self, pg: Page.Page) -> None:
         '''
-        页面写入文件系统
+        页面写入文件系统, 页面正在被其它线程写回时等待它写完再写
         '''
-        pgno = pg.pageNumber
-        offset = self.pageOffset(pgno)
-        self.fileLock.acquire()
+        self.flushPages([pg], True)
+
+    def flushPages(self, pages: list, wait: bool = False) -> None:
+        '''
+        把一批页面写入文件系统
+        先在页面锁内复制所有页面, 并等待进行中的 DataItem 修改完成, 保证写出的页面不会只包含修改的一半
+        复制时清除脏标记和 recLsn, 页面连同原来的 recLsn 记在 inFlight 中, 写完之后才移除
+        同一个页面正在被其它线程写回时, wait 为 True 则等待它写完, 否则跳过, 页面保持为脏; 避免较早的副本后写完, 覆盖掉较新的副本
+        只有一个页面时才能等待, 一批页面持有着已经复制的页面去等待其它页面, 可能和另一批页面互相等待
+        复制之后再刷一次日志, 只需要刷到这批页面中最晚的修改对应的日志, 整批页面只需要等一次日志落盘
+        '''
+        copies = []
+        lsn = 0
         try:
-            with open(self.file, 'rb+') as f:
-                f.seek(offset, 0)
-                f.write(bytes(pg.data))
+            for pg in pages:
+                pg.lockForCopy()
+                try:
+                    with self.inFlightCond:
+                        while wait and pg.pageNumber in self.inFlight:
+                            self.inFlightCond.wait()
+                        if pg.pageNumber in self.inFlight:
+                            continue
+                        self.inFlight[pg.pageNumber] = pg.recLsn
+                    copies.append((pg.pageNumber, bytes(pg.data)))
+                    lsn = max(lsn, pg.lsn)
+                    pg.setDirty(False)
+                    pg.recLsn = None
+                finally:
+                    pg.unlock()
+            self.flushLog(lsn)
+            for pgno, data in copies:
+                self.file.write(self.pageOffset(pgno), data)
         finally:
-            self.fileLock.release()
-    
+            with self.inFlightCond:
+                for pgno, data in copies:
+                    self.inFlight.pop(pgno, None)
+                self.inFlightCond.notify_all()
+
+    def flushLog(self, lsn: int = -1) -> None:
+        '''
+        WAL: 写回页面之前把日志刷到 lsn 处, lsn 为 -1 时刷入所有日志, 为 0 时没有需要刷的日志
+        '''
+        if self.logFlusher is not None and lsn != 0:
+            self.logFlusher(lsn)
+
+    def currentLsn(self) -> int:
+        if self.logTail is None:
+            return 0
+        return self.logTail()
+
     def flushPage(self, pg: Page.Page) -> None:
         self.flush(pg)
 
+    def flushAll(self) -> None:
+        '''
+        把缓存中所有的脏页面写回, 页面仍留在缓存中
+        '''
+        self.writeBack(lambda pg: True, True, -1)
+
+    def sync(self) -> None:
+        '''
+        把已经写出的页面刷到磁盘上
+        '''
+        self.file.sync()
+
+    def startBgWriter(self, interval: float = BGWRITER_INTERVAL, maxPages: int = BGWRITER_MAX_PAGES) -> None:
+        '''
+        启动后台写线程, 每隔 interval 秒最多写回 maxPages 个脏页面, 让驱逐时不必再同步写回
+        interval 或 maxPages 不大于 0 时不启动
+        '''
+        if interval <= 0 or maxPages <= 0 or self.bgWriter is not None:
+            return
+        self.bgWriterStop.clear()
+        self.bgWriter = threading.Thread(target = self.bgWrite, args = (interval, maxPages), daemon = True)
+        self.bgWriter.start()
+
+    def stopBgWriter(self) -> None:
+        if self.bgWriter is None:
+            return
+        self.bgWriterStop.set()
+        self.bgWriter.join()
+        self.bgWriter = None
+
+    def bgWrite(self, interval: float, maxPages: int) -> None:
+        while not self.bgWriterStop.wait(interval):
+            try:
+                self.writeDirtyPages(maxPages)
+            except Exception:
+                traceback.print_exc()
+
+    def dirtyPageTable(self, threshold: int) -> dict:
+        '''
+        模糊检查点使用的脏页表: 页号 -> recLsn
+        recLsn 早于 threshold 的脏页面先写回, 这样长期不被驱逐的脏页面也不会让日志一直无法回收
+        之后依次收集仍然是脏的页面, 被驱逐还没有写完的页面, 以及正在写回的页面
+        在这之前写完的页面由检查点接下来的 sync 落盘, 还没有写完的页面都在脏页表中
+        '''
+        self.writeBack(lambda pg: (pg.recLsn if pg.recLsn is not None else 0) < threshold, True, -1)
+        table = {}
+        for stripe in self.stripes:
+            with stripe.cond:
+                for key, pg in list(stripe.cache.items()) + list(stripe.evicting.items()):
+                    if pg.isDirty():
+                        table[key] = pg.recLsn if pg.recLsn is not None else 0
+        with self.inFlightCond:
+            for pgno, recLsn in self.inFlight.items():
+                if recLsn is not None:
+                    table[pgno] = min(recLsn, table.get(pgno, recLsn))
+        return table
+
+    def writeDirtyPages(self, maxPages: int) -> int:
+        '''
+        按 CLOCK 顺序找出最多 maxPages 个没有被引用的脏页面写回, 即最先会被驱逐的那些页面
+        '''
+        # 每次从不同的条带开始, 避免总是只写回前面几个条带
+        self.bgWriterStart = (self.bgWriterStart + 1) % len(self.stripes)
+        return self.writeBack(lambda pg: True, False, maxPages, self.bgWriterStart)
+
+    def writeBack(self, select, pinned: bool, maxPages: int, firstStripe: int = 0) -> int:
+        '''
+        逐个条带地写回 select 选中的脏页面, 一共最多写回 maxPages 个, maxPages 为 -1 时不限
+        pinned 为 False 时跳过正在被引用的页面; 一个条带写完一批才钉住下一批, 每个页面最多写一次, 返回写回的页面个数
+        '''
+        written = 0
+        for i in range(len(self.stripes)):
+            stripe = self.stripes[(firstStripe + i) % len(self.stripes)]
+            done = set()
+            while maxPages == -1 or written < maxPages:
+                limit = BGWRITER_MAX_PAGES if maxPages == -1 else min(BGWRITER_MAX_PAGES, maxPages - written)
+                with stripe.cond:
+                    pages = self.pinDirtyPages(stripe, lambda pg: pg.pageNumber not in done and select(pg), pinned, limit)
+                if len(pages) == 0:
+                    break
+                try:
+                    self.flushPages(pages)
+                finally:
+                    for pg in pages:
+                        done.add(pg.pageNumber)
+                        AbstractClass.release(self, pg.pageNumber)
+                written += len(pages)
+        return written
+
+    def pinDirtyPages(self, stripe, select, pinned: bool, limit: int) -> list:
+        '''
+        按 CLOCK 顺序选出条带中最多 limit 个 select 选中的脏页面并持有引用, 防止写回期间被驱逐, 调用者需要持有条带的锁
+        钉住没有被引用的页面会占用条带中可以驱逐的位置, 每批最多占用条带容量的 1/BGWRITER_STRIPE_SHARE, 并且至少留下一个
+        否则写回期间(包括等待日志落盘)并发的缺页找不到可以驱逐的页面, 会抛出 CacheFullException
+        '''
+        spare = limit
+        if stripe.maxResources > 0:
+            unpinned = sum(1 for key in stripe.clock if stripe.references[key] == 0)
+            spare = min(limit, max(1, stripe.maxResources // BGWRITER_STRIPE_SHARE), stripe.maxResources - stripe.count + unpinned - 1)
+        pages = []
+        for key in stripe.clock:
+            if len(pages) == limit:
+                break
+            pg = stripe.cache[key]
+            if not pg.isDirty() or not select(pg):
+                continue
+            if stripe.references[key] == 0:
+                if spare <= 0:
+                    continue
+                spare -= 1
+            elif not pinned:
+                continue
+            stripe.references[key] += 1
+            pages.append(pg)
+        return pages
+
     def truncateByBgno(self, maxPgno: int) -> None:
         '''
         把数据文件截断至 maxPgno
         '''
         size = self.pageOffset(maxPgno + 1)
-        with open(self.file, 'rb+') as f:
-            f.truncate(size)
-        self.pageNumber = maxPgno
+        self.fileLock.acquire()
+        try:
+            self.file.truncate(size)
+            self.pageNumber = maxPgno
+            self.allocatedPages = maxPgno
+        finally:
+            self.fileLock.release()
 
     def pageOffset(self, pgno: int) -> int:
         '''
@@ -93,11 +385,149 @@ class PageCache(AbstractClass):
     
     def getPageNumber(self) -> int:
         return self.pageNumber
-    
-def create(path: str, memory: int) -> PageCache:
+
+    def close(self) -> None:
+        self.stopPrefetcher()
+        self.stopBgWriter()
+        super().close()
+        self.file.close()
+
+class MmapPageCache(PageCache):
+    '''
+    mmap 模式的缓冲池: 数据文件按区段映射到内存, 页面数据是映射上的 memoryview 切片, 读页面不再复制
+    映射是私有的(写时复制), 操作系统不会在日志落盘之前把修改过的页面写回文件; 写回和普通模式一样, 日志落盘之后复制页面再 pwrite
+    修改过的页面在映射上是一份匿名的私有副本, pwrite 之后也不会释放; 页面被驱逐时已经写回, 这时丢弃副本, 之后再读到的就是文件中的内容
+    所以私有副本最多是缓冲池中的页数, 内存仍然受缓冲池大小的限制
+    文件按整个区段增长, 多出来的空页在正常关闭时截掉, 崩溃后由恢复流程截断
+    '''
+    def __init__(self, file: str, maxResource: int):
+        super(MmapPageCache, self).__init__(file, maxResource)
+        self.extents = []
+        self.views = []
+        self.fileLock.acquire()
+        try:
+            self.ensureMapped(self.pageNumber)
+        finally:
+            self.fileLock.release()
+
+    def ensureMapped(self, pgno: int) -> None:
+        '''
+        保证 pgno 所在的区段已经映射, 调用者需要持有 fileLock
+        '''
+        while len(self.extents) * MMAP_EXTENT_PAGES < pgno:
+            offset = len(self.extents) * MMAP_EXTENT_SIZE
+            if self.file.size() < offset + MMAP_EXTENT_SIZE:
+                self.file.allocate(offset, MMAP_EXTENT_SIZE)
+            m = mmap.mmap(self.file.fd, MMAP_EXTENT_SIZE, offset = offset, access = mmap.ACCESS_COPY)
+            self.extents.append(m)
+            self.views.append(memoryview(m))
+
+    def pageView(self, pgno: int) -> memoryview:
+        '''
+        pgno 页在映射上的切片
+        '''
+        if (pgno - 1) // MMAP_EXTENT_PAGES >= len(self.views):
+            self.fileLock.acquire()
+            try:
+                self.ensureMapped(pgno)
+            finally:
+                self.fileLock.release()
+        offset = ((pgno - 1) % MMAP_EXTENT_PAGES) * PAGE_SIZE
+        return self.views[(pgno - 1) // MMAP_EXTENT_PAGES][offset : offset + PAGE_SIZE]
+
+    def newPages(self, initData: bytearray | bytes, count: int) -> int:
+        '''
+        映射和文件中超过 pageNumber 的部分可能是恢复时逻辑截掉的旧页面, 新页总是要写入 initData
+        '''
+        self.fileLock.acquire()
+        try:
+            first = self.pageNumber + 1
+            self.pageNumber += count
+            self.ensureMapped(self.pageNumber)
+        finally:
+            self.fileLock.release()
+        for pgno in range(first, first + count):
+            self.pageView(pgno)[:] = initData
+            self.file.write(self.pageOffset(pgno), initData)
+            self.dropCopy(pgno)
+        return first
+
+    def releaseForCache(self, pg: Page.Page) -> None:
+        '''
+        被驱逐的页面写回之后丢弃它的私有副本
+        驱逐时页面已经没有引用, 在写回完成之前也不会被重新读入, 不会有修改落在丢弃的副本上
+        '''
+        super().releaseForCache(pg)
+        self.dropCopy(pg.pageNumber)
+
+    def dropCopy(self, pgno: int) -> None:
+        '''
+        丢弃 pgno 页在映射上的私有副本, 调用者保证文件中已经是页面最新的内容
+        '''
+        if not hasattr(mmap, 'MADV_DONTNEED') or (pgno - 1) // MMAP_EXTENT_PAGES >= len(self.extents):
+            return
+        offset = ((pgno - 1) % MMAP_EXTENT_PAGES) * PAGE_SIZE
+        self.extents[(pgno - 1) // MMAP_EXTENT_PAGES].madvise(mmap.MADV_DONTNEED, offset, PAGE_SIZE)
+
+    def getForCache(self, key: int) -> Page.Page:
+        return Page.Page(key, self.pageView(key), self)
+
+    def truncateByBgno(self, maxPgno: int) -> None:
+        '''
+        映射中的区段保持不变, 只修改逻辑页数, 多余的页在关闭时截掉
+        '''
+        self.fileLock.acquire()
+        try:
+            self.pageNumber = maxPgno
+        finally:
+            self.fileLock.release()
+
+    def prefetchPages(self, pgnos: list) -> None:
+        '''
+        页面数据就在映射中, 预读只需要让内核提前把对应的区间读进来
+        '''
+        if not hasattr(mmap, 'MADV_WILLNEED'):
+            return
+        start = None
+        last = None
+        for pgno in sorted(pgnos) + [None]:
+            if pgno is not None and start is not None and pgno == last + 1 and (pgno - 1) % MMAP_EXTENT_PAGES != 0:
+                last = pgno
+                continue
+            # 页数已经增加但区段还没有映射完成时跳过
+            if start is not None and (start - 1) // MMAP_EXTENT_PAGES < len(self.extents):
+                offset = ((start - 1) % MMAP_EXTENT_PAGES) * PAGE_SIZE
+                self.extents[(start - 1) // MMAP_EXTENT_PAGES].madvise(mmap.MADV_WILLNEED, offset, (last - start + 1) * PAGE_SIZE)
+            start = pgno
+            last = pgno
+
+    def close(self) -> None:
+        self.stopPrefetcher()
+        self.stopBgWriter()
+        AbstractClass.close(self)
+        self.views = []
+        for m in self.extents:
+            try:
+                m.close()
+            except BufferError:
+                # 上层还持有页面切片, 交给垃圾回收
+                pass
+        self.extents = []
+        self.file.truncate(self.pageOffset(self.pageNumber + 1))
+        self.file.close()
+
+def create(path: str, memory: int, useMmap: bool = False) -> PageCache:
     file = path + DB_SUFFIX
+    if memory // PAGE_SIZE < MEM_MIN_LIM:
+        raise Exception("MemTooSmallException")
+    if useMmap:
+        return MmapPageCache(file, memory // PAGE_SIZE)
     return PageCache(file, memory // PAGE_SIZE)
 
-def fileopen(path: str, memory: int) -> PageCache:
+def fileopen(path: str, memory: int, useMmap: bool = False) -> PageCache:
     file = path + DB_SUFFIX
+    if memory // PAGE_SIZE < MEM_MIN_LIM:
+        raise Exception("MemTooSmallException")
+    if useMmap:
+        return MmapPageCache(file, memory // PAGE_SIZE)
     return PageCache(file, memory // PAGE_SIZE)
@@ -0,0 +1,123 @@
+# 持久化的空闲空间映射
+# PageIndex 只存在于内存中, FreeSpaceMap 把每个普通页面的空闲空间记录在专门的 FSM 页上, 打开数据库时直接读入
+# 插入消耗空间时同步修改 FSM 页; FSM 页不写日志, 和其它脏页面一样由缓冲池写回
+# 崩溃恢复后 FSM 页可能与数据不一致, 此时扫描所有普通页面重建
+import threading
+from backend.dm.page import PageFSM
+from backend.dm.page import PageOne
+from backend.dm.page import PageX
+from backend.dm.page.Page import Page
+from backend.dm.pageCache import PageCache
+from backend.dm.pageIndex.PageIndex import PageIndex
+
+class FreeSpaceMap(object):
+    def __init__(self, pc: PageCache.PageCache, pageOne: Page):
+        self.pc = pc
+        self.pageOne = pageOne
+        self.lock = threading.RLock()
+        # 第 k 个元素是第 k 个 FSM 页的页号
+        self.fsmPages = PageOne.getFsmPages_page(pageOne)
+        self.fsmPageSet = set(self.fsmPages)
+
+    def isFsmPage(self, pgno: int) -> bool:
+        return pgno in self.fsmPageSet
+
+    def update(self, pgno: int, freeSpace: int) -> None:
+        '''
+        记录页面 pgno 的空闲空间
+        '''
+        k, kth = PageFSM.entryOf(pgno)
+        self.lock.acquire()
+        try:
+            fsmPgno = self.fsmPageOf(k)
+        finally:
+            self.lock.release()
+        pg = self.pc.getPage(fsmPgno)
+        try:
+            pg.lock()
+            try:
+                PageFSM.setFreeSpace(pg, kth, freeSpace)
+            finally:
+                pg.unlock()
+        finally:
+            pg.release()
+
+    def fsmPageOf(self, k: int) -> int:
+        '''
+        第 k 个 FSM 页的页号, 不存在时新建
+        新建的 FSM 页立即记入 PageOne 并写回, 避免崩溃后被当成普通页面
+        调用者需要持有 lock
+        '''
+        while len(self.fsmPages) <= k:
+            pgno = self.pc.newPage(PageFSM.initRaw())
+            self.fsmPages.append(pgno)
+            self.fsmPageSet.add(pgno)
+            PageOne.setFsmPages_page(self.pageOne, self.fsmPages)
+            self.pc.flushPage(self.pageOne)
+        return self.fsmPages[k]
+
+    def load(self, pIndex: PageIndex) -> bool:
+        '''
+        从 FSM 页建立 pIndex
+        FSM 页不存在, 或者没有覆盖所有的普通页面时返回 False, 需要重建
+        '''
+        pageNumber = self.pc.getPageNumber()
+        maxHeapPgno = pageNumber
+        while maxHeapPgno in self.fsmPageSet:
+            maxHeapPgno -= 1
+        if maxHeapPgno > 1 and len(self.fsmPages) <= maxHeapPgno // PageFSM.ENTRIES_PER_PAGE:
+            return False
+        for fsmPgno in self.fsmPages:
+            if fsmPgno > pageNumber:
+                return False
+        for k in range(len(self.fsmPages)):
+            pg = self.pc.getPage(self.fsmPages[k])
+            try:
+                entries = PageFSM.getFreeSpaces(pg)
+            finally:
+                pg.release()
+            base = k * PageFSM.ENTRIES_PER_PAGE
+            for kth in range(len(entries)):
+                pgno = base + kth
+                if entries[kth] != PageFSM.NOT_HEAP and 1 < pgno <= pageNumber:
+                    pIndex.add(pgno, entries[kth])
+        return True
+
+    def rebuild(self, pIndex: PageIndex) -> None:
+        '''
+        扫描所有普通页面, 重建 pIndex 和 FSM 页
+        恢复时被截掉的 FSM 页连同其后的 FSM 页一起丢弃, 需要时重新分配
+        '''
+        pageNumber = self.pc.getPageNumber()
+        self.lock.acquire()
+        try:
+            kept = 0
+            while kept < len(self.fsmPages) and self.fsmPages[kept] <= pageNumber:
+                kept += 1
+            if kept < len(self.fsmPages):
+                self.fsmPages = self.fsmPages[0 : kept]
+                self.fsmPageSet = set(self.fsmPages)
+                PageOne.setFsmPages_page(self.pageOne, self.fsmPages)
+                self.pc.flushPage(self.pageOne)
+            for fsmPgno in self.fsmPages:
+                pg = self.pc.getPage(fsmPgno)
+                pg.lock()
+                pg.setDirty(True)
+                pg.data[0 : PageCache.PAGE_SIZE] = PageFSM.initRaw()
+                pg.unlock()
+                pg.release()
+        finally:
+            self.lock.release()
+        for pgno in range(2, pageNumber + 1):
+            if self.isFsmPage(pgno):
+                continue
+            pg = self.pc.getPage(pgno)
+            try:
+                # 崩溃前刚分配, 还没有记入 PageOne 的 FSM 页不是合法的普通页面
+                if not PageX.isValidPage(pg):
+                    continue
+                freeSpace = PageX.getFreeSpace(pg)
+            finally:
+                pg.release()
+            pIndex.add(pgno, freeSpace)
+            self.update(pgno, freeSpace)
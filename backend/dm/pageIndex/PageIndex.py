@@ -15,18 +15,38 @@ class PageIndex(object):
     def __init__(self):
         self.lock = threading.RLock()
         self.lists = [[] for _ in range(INTERVALS_NO + 1)]
+        # 页号 -> 在 lists 中的页面信息, 被 select 取出的页面不在其中
+        self.pages = {}
 
     def add(self, pgno: int, freeSpace: int) -> None:
         '''
-        向 PageIndex 添加页面信息
+        向 PageIndex 添加页面信息, 页面已经在 PageIndex 中时替换原来的信息
         '''
         self.lock.acquire()
         try:
-            number = freeSpace // THRESHOLD
-            self.lists[number].append(PageInfo(pgno, freeSpace))
+            self.remove(pgno)
+            pi = PageInfo(pgno, freeSpace)
+            self.lists[freeSpace // THRESHOLD].append(pi)
+            self.pages[pgno] = pi
         finally:
             self.lock.release()
 
+    def update(self, pgno: int, freeSpace: int) -> None:
+        '''
+        更新页面的空闲空间, 页面正被 select 取出使用时不做修改, 使用者放回时会带上最新的空闲空间
+        '''
+        self.lock.acquire()
+        try:
+            if pgno in self.pages:
+                self.add(pgno, freeSpace)
+        finally:
+            self.lock.release()
+
+    def remove(self, pgno: int) -> None:
+        pi = self.pages.pop(pgno, None)
+        if pi != None:
+            self.lists[pi.freeSpace // THRESHOLD].remove(pi)
+
     def select(self, spaceSize: int) -> PageInfo | None:
         '''
         从 PageIndex 中选择一个合适的页面来存储需要 spaceSize 大小数据的操作
@@ -42,6 +62,7 @@ class PageIndex(object):
                     number = number + 1
                     continue
                 ret_val = self.lists[number].pop(0)
+                self.pages.pop(ret_val.pgno, None)
                 return ret_val
             return None
         finally:
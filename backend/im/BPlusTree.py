@@ -60,20 +60,31 @@ class BPlusTree(object):
         return self.searchRange(key, key)
 
     def searchRange(self, leftKey: int, rightKey: int) -> list:
+        uids = []
+        for batch in self.scanRange(leftKey, rightKey):
+            uids.extend(batch)
+        return uids
+
+    def scanRange(self, leftKey: int, rightKey: int):
+        '''
+        沿叶子节点依次返回 [leftKey, rightKey] 中每个叶子上的 uid, 一次只持有一个叶子的结果
+        两次返回之间叶子可能分裂, 分裂出去的都是已经返回过的 key 和新插入的 key, 不会漏掉已有的 key
+        '''
         rootUid = self.rootUid()
         leafUid = self.searchLeaf(rootUid, leftKey)
-        uids = []
         while True:
             leaf = backend.im.Node.loadNode(self, leafUid)
+            # 沿兄弟链表继续查找时, 先预读右兄弟, 与本节点的查找重叠
+            siblingUid = leaf.rangeSibling(rightKey)
+            if siblingUid != 0:
+                self.dm.prefetch([siblingUid])
             res = leaf.leafSearchRange(leftKey, rightKey)
             leaf.release()
-            for i in res.uids:
-                uids.append(i)
+            yield res.uids
             if res.siblingUid == 0:
                 break
             else:
                 leafUid = res.siblingUid
-        return uids
 
     def insert(self, key: int, uid: int) -> None:
         rootUid = self.rootUid()
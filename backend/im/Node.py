@@ -104,6 +104,19 @@ class Node(object):
         finally:
             self.dataItem.rLock.release()
 
+    def rangeSibling(self, rightKey: int) -> int:
+        '''
+        范围查找到 rightKey 为止时, 会继续读取右兄弟的话返回右兄弟的 uid, 否则返回 0
+        '''
+        self.dataItem.rLock.acquire()
+        try:
+            noKeys = getRawNoKeys(self.raw)
+            if noKeys > 0 and getRawKthKey(self.raw, noKeys - 1) > rightKey:
+                return 0
+            return getRawSibling(self.raw)
+        finally:
+            self.dataItem.rLock.release()
+
     def insertAndSplit(self, uid: int, key: int) -> InsertAndSplitRes:
         success = False
         res = self.InsertAndSplitRes()
@@ -114,7 +127,12 @@ class Node(object):
                 res.siblingUid = getRawSibling(self.raw)
                 return res
             if self.needSplit() == True:
-                r = self.split()
+                try:
+                    r = self.split()
+                except Exception as e:
+                    # 新节点没有插入成功, 撤回这次插入, 否则日志中会记下一个超出容量的节点
+                    success = False
+                    raise e
                 res.newSon = r.newSon
                 res.newKey = r.newKey
                 return res
@@ -1,8 +1,9 @@
 '''
 该数据库支持的SQL语法如下
 <begin statement>
-    begin [isolation level (read committedrepeatable read)]
+    begin [isolation level (read committedrepeatable read)] [synchronous_commit (onoff)]
         begin isolation level read committed
+        begin synchronous_commit off
 
 <commit statement>
     commit
@@ -174,20 +175,22 @@ def parseInsert(tokenizer: Tokenizer):
 
 def parseSelect(tokenizer: Tokenizer):
     select = backend.parser.statement.Statements.Select()
+    fields = []
     if tokenizer.peek() == "*":
-        select.fields.append("*")
+        fields.append("*")
         tokenizer.pop()
     else:
         while True:
             field = tokenizer.peek()
             if not isName(field):
                 raise Exception("InvalidCommandException")
-            select.fields.append(field)
+            fields.append(field)
             tokenizer.pop()
             if tokenizer.peek() == ",":
                 tokenizer.pop()
             else:
                 break
+    select.fields = fields
     if tokenizer.peek() != "from":
         raise Exception("InvalidCommandException")
     tokenizer.pop()
@@ -318,31 +321,37 @@ def parseCommit(tokenizer: Tokenizer):
     return backend.parser.statement.Statements.Commit()
 
 def parseBegin(tokenizer: Tokenizer):
-    if tokenizer.peek() != "isolation":
-        return backend.parser.statement.Statements.Begin()
-    tokenizer.pop()
-    if tokenizer.peek() != "level":
-        raise Exception("InvalidCommandException")
-    tokenizer.pop()
-    level = tokenizer.peek()
-    if level == "read":
+    isRepeatableRead = False
+    synchronousCommit = None
+    if tokenizer.peek() == "isolation":
         tokenizer.pop()
-        if tokenizer.peek() != "committed":
+        if tokenizer.peek() != "level":
             raise Exception("InvalidCommandException")
         tokenizer.pop()
-        if tokenizer.peek() != "":
+        level = tokenizer.peek()
+        if level == "read":
+            tokenizer.pop()
+            if tokenizer.peek() != "committed":
+                raise Exception("InvalidCommandException")
+            tokenizer.pop()
+        elif level == "repeatable":
+            tokenizer.pop()
+            if tokenizer.peek() != "read":
+                raise Exception("InvalidCommandException")
+            tokenizer.pop()
+            isRepeatableRead = True
+        else:
             raise Exception("InvalidCommandException")
-        return backend.parser.statement.Statements.Begin()
-    elif level == "repeatable":
+    if tokenizer.peek() == "synchronous_commit":
         tokenizer.pop()
-        if tokenizer.peek() != "read":
+        mode = tokenizer.peek()
+        if mode != "on" and mode != "off":
             raise Exception("InvalidCommandException")
         tokenizer.pop()
-        if tokenizer.peek() != "":
-            raise Exception("InvalidCommandException")
-        return backend.parser.statement.Statements.Begin(isRepeatableRead = True)
-    else:
+        synchronousCommit = mode == "on"
+    if tokenizer.peek() != "":
         raise Exception("InvalidCommandException")
+    return backend.parser.statement.Statements.Begin(isRepeatableRead, synchronousCommit)
 
 def isName(name: str) -> bool:
     return not (len(name) == 1 and not Tokenizer.isAlphaBeta(name.encode('utf-8')[0]))
@@ -3,8 +3,10 @@ class Abort(object):
         pass
 
 class Begin(object):
-    def __init__(self, isRepeatableRead = False):
+    def __init__(self, isRepeatableRead = False, synchronousCommit = None):
         self.isRepeatableRead = isRepeatableRead
+        # None 表示使用服务器的默认设置
+        self.synchronousCommit = synchronousCommit
 
 class Commit(object):
     def __init__(self):
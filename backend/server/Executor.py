@@ -1,5 +1,6 @@
 import backend.parser.statement.Statements as Statements
 import backend.parser.Parser as Parser
+from backend.tm.TransactionManager import SUPER_XID
 from backend.tbm.TableManager import TableManager
 
 class Executor(object):
@@ -39,6 +40,12 @@ class Executor(object):
     def execute2(self, stat) -> bytearray | bytes | None:
         tmpTransaction = False
         e = None
+        # 事务之外的只读语句用虚拟事务执行, 以超级事务的身份按读提交读取
+        # 不分配 xid, 不读写 xid 文件, 不进入活跃事务表, 也不在 LockTable 中加锁
+        if self.xid == 0 and isinstance(stat, Statements.Select):
+            return self.tbm.read(SUPER_XID, stat)
+        if self.xid == 0 and isinstance(stat, Statements.Show):
+            return self.tbm.show(SUPER_XID)
         if self.xid == 0:
             tmpTransaction = True
             res = self.tbm.begin(Statements.Begin())
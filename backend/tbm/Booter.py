@@ -1,5 +1,6 @@
 # 记录第一个表的uid
 import os
+from backend.common.RandomAccessFile import RandomAccessFile
 
 BOOTER_SUFFIX = ".bt"
 BOOTER_TMP_SUFFIX = ".bt_tmp"
@@ -8,34 +9,43 @@ class Booter:
     """
     管理启动文件操作
     包括创建、打开、加载和更新启动文件
+    启动文件只在打开时和每次替换后打开一次, load 按偏移量读取
     """
     def __init__(self, path: str):
         self.path = path
-        self.file = None
+        self.file = RandomAccessFile(path + BOOTER_SUFFIX)
 
     def load(self) -> bytes:
-        with open(self.path + BOOTER_SUFFIX, 'rb') as f:
-            return f.read()
+        return self.file.read(0, self.file.size())
 
     def update(self, data: bytearray | bytes) -> None:
+        '''
+        先写临时文件再原子地替换启动文件, 替换前关闭旧的描述符, 替换后重新打开
+        '''
         tmp_path = self.path + BOOTER_TMP_SUFFIX
-        with open(tmp_path, 'wb') as tmp_file:
-            tmp_file.write(data)
-        
+        tmp_file = RandomAccessFile(tmp_path, True)
+        try:
+            tmp_file.truncate(0)
+            tmp_file.write(0, data)
+            tmp_file.sync()
+        finally:
+            tmp_file.close()
+        self.file.close()
         os.replace(tmp_path, self.path + BOOTER_SUFFIX)
+        self.file = RandomAccessFile(self.path + BOOTER_SUFFIX)
+
+    def close(self) -> None:
+        self.file.close()
 
 def create(path: str) -> Booter:
     remove_bad_tmp(path)
-    f = open(path + BOOTER_SUFFIX, 'w+b')
-    if not f:
-        raise Exception("File already exists")
+    f = RandomAccessFile(path + BOOTER_SUFFIX, True)
+    f.truncate(0)
+    f.close()
     return Booter(path)
 
 def fileopen(path: str) -> Booter:
     remove_bad_tmp(path)
-    f = open(path + BOOTER_SUFFIX, 'r+b')
-    if not f:
-        raise Exception("File does not exist")
     return Booter(path)
 
 def remove_bad_tmp(path: str) -> None:
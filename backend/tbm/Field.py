@@ -1,6 +1,7 @@
 import struct
 from typing import Self
 import backend.im.BPlusTree
+import backend.tbm.Toast as Toast
 import backend.tm.TransactionManager
 import backend.parser.statement.Statements as Statements
 '''
@@ -64,6 +65,12 @@ class Field:
 
     def search(self, left: int, right: int) -> list:
         return self.bt.searchRange(left, right)
+
+    def scan(self, left: int, right: int):
+        '''
+        按叶子节点分批返回 [left, right] 中的 uid, 用于遍历整个索引
+        '''
+        return self.bt.scanRange(left, right)
     
     def handle_exceed(self, xCheck: int) -> int:
         res = xCheck & 0xFFFFFFFF
@@ -71,10 +78,10 @@ class Field:
             res = res - 0x100000000
         return res
 
-    def value2Uid(self, key: int | str) -> int:
+    def value2Uid(self, key: int | str | Toast.ToastPointer) -> int:
         uid = 0
         if self.fieldType == "string":
-            s = key.encode('utf-8')
+            s = self.detoast(key).encode('utf-8')
             for b in s:
                 uid = self.handle_exceed(uid * 13331)
                 val = b
@@ -96,14 +103,17 @@ class Field:
         elif self.fieldType == "string":
             return s
         
-    def value2Raw(self, v: int | str) -> bytearray | bytes:
+    def value2Raw(self, v: int | str | Toast.ToastPointer) -> bytearray | bytes:
         raw = None
         if self.fieldType == "int32":
             raw = struct.pack('>i', v)
         elif self.fieldType == "int64":
             raw = struct.pack('>q', v)
         elif self.fieldType == "string":
-            raw = struct.pack('>i', len(v)) + v.encode('utf-8')
+            if isinstance(v, Toast.ToastPointer):
+                return v.raw()
+            data = v.encode('utf-8')
+            raw = struct.pack('>i', len(data)) + data
         return raw
     
     def parseValue(self, raw: bytearray | bytes) -> ParseValueRes:
@@ -115,20 +125,33 @@ class Field:
             res.v = struct.unpack('>q', raw[0 : 8])[0]
             res.shift = 8
         elif self.fieldType == "string":
+            # 行外存储的字段只解析出指针, 需要时再读取内容
+            if Toast.isPointer(raw):
+                res.v = Toast.parsePointer(raw)
+                res.shift = Toast.POINTER_SIZE
+                return res
             length = struct.unpack('>i', raw[0 : 4])[0]
             res.v = raw[4 : 4 + length].decode('utf-8')
             res.shift = length + 4
         return res
     
-    def printValue(self, v: int | str) -> str:
+    def printValue(self, v: int | str | Toast.ToastPointer) -> str:
         s = None
         if self.fieldType == "int32":
             s = str(v)
         elif self.fieldType == "int64":
             s = str(v)
         elif self.fieldType == "string":
-            s = v
+            s = self.detoast(v)
         return s
+
+    def detoast(self, v: str | Toast.ToastPointer) -> str:
+        '''
+        读出行外存储的字段内容
+        '''
+        if isinstance(v, Toast.ToastPointer):
+            return Toast.load(self.tb.tbm.dm, v).decode('utf-8')
+        return v
     
     def toString(self) -> str:
         return "({}, {}, {})".format(self.fieldName, self.fieldType, "Index" if self.index != 0 else "NoIndex")
@@ -7,6 +7,7 @@ Table 维护了表结构
 from typing import Self
 import struct
 import backend.tbm.Field
+import backend.tbm.Toast as Toast
 import backend.tm.TransactionManager
 import backend.parser.statement.Statements as Statements
 
@@ -68,13 +69,14 @@ class Table(object):
         value = fd.string2Value(update.value)
         count = 0
         for uid in uids:
-            raw = self.tbm.vm.read(xid, uid)
+            raw = self.tbm.vm.read(xid, uid, self.freeChunks)
             if raw is None:
                 continue
             self.tbm.vm.delete(xid, uid)
-            entry = self.parseEntry(raw)
+            # 新版本复制一份行外存储的字段, 不和旧版本共用块
+            entry = self.detoastEntry(self.parseEntry(raw))
             entry[fd.fieldName] = value
-            raw = self.entry2Raw(entry)
+            raw = self.entry2Raw(self.toastEntry(xid, entry))
             newUid = self.tbm.vm.insert(xid, raw)
             count += 1
             for field in self.fields:
@@ -83,19 +85,62 @@ class Table(object):
         return count
     
     def read(self, xid: int, read: Statements.Select) -> str:
+        fields = self.projectFields(read.fields)
         uids = self.parseWhere(read.where)
+        self.tbm.dm.prefetch(uids)
         sb = []
         for uid in uids:
-            raw = self.tbm.vm.read(xid, uid)
+            raw = self.tbm.vm.read(xid, uid, self.freeChunks)
             if raw is None:
                 continue
             entry = self.parseEntry(raw)
-            sb.append(self.printEntry(entry) + "\n")
+            try:
+                sb.append(self.printEntry(entry, fields) + "\n")
+            except Exception as e:
+                # 超级事务不在活跃事务中, 读到的版本随后可能被删除并回收, 块已经回收时等同于读到了删除之后的状态
+                if xid == backend.tm.TransactionManager.SUPER_XID and str(e) == "ToastChunkNotFoundException":
+                    continue
+                raise e
         return ''.join(sb)
+
+    def freeze(self, limit: int) -> None:
+        '''
+        冻结表结构, 字段和表中所有的版本, 每个版本都在第一个有索引的字段中
+        表结构和字段加载表时还要读取, 不回收
+        索引按叶子节点分批遍历, 不会一次把整个索引的 uid 读入内存
+        '''
+        vm = self.tbm.vm
+        vm.freeze(self.uid, limit, False)
+        for field in self.fields:
+            vm.freeze(field.uid, limit, False)
+        for field in self.fields:
+            if field.isIndexed():
+                for uids in field.scan(-9223372036854775808, 9223372036854775807):
+                    for uid in uids:
+                        vm.freeze(uid, limit, True, self.freeChunks)
+                break
+
+    def projectFields(self, names: list) -> list:
+        '''
+        select 需要输出的字段, 行外存储的字段只有被选中时才会读取
+        '''
+        if len(names) == 0 or "*" in names:
+            return self.fields
+        fields = []
+        for name in names:
+            fd = None
+            for field in self.fields:
+                if field.fieldName == name:
+                    fd = field
+                    break
+            if fd is None:
+                raise Exception("FieldNotFoundException")
+            fields.append(fd)
+        return fields
     
     def insert(self, xid: int, insert: Statements.Insert) -> None:
         entry = self.string2Entry(insert.values)
-        raw = self.entry2Raw(entry)
+        raw = self.entry2Raw(self.toastEntry(xid, entry))
         uid = self.tbm.vm.insert(xid, raw)
         for field in self.fields:
             if field.isIndexed():
@@ -178,12 +223,14 @@ class Table(object):
             raise Exception("InvalidLogOpException")
         return res
     
-    def printEntry(self, entry: dict) -> str:
+    def printEntry(self, entry: dict, fields: list | None = None) -> str:
+        if fields is None:
+            fields = self.fields
         sb = "["
-        for i in range(len(self.fields)):
-            field = self.fields[i]
+        for i in range(len(fields)):
+            field = fields[i]
             sb += field.printValue(entry.get(field.fieldName))
-            if i == len(self.fields) - 1:
+            if i == len(fields) - 1:
                 sb += "]"
             else:
                 sb += ", "
@@ -198,6 +245,45 @@ class Table(object):
             pos += r.shift
         return entry
     
+    def toastEntry(self, xid: int, entry: dict) -> dict:
+        '''
+        行的长度超过 TOAST_THRESHOLD 时, 从最长的字符串字段开始移到行外存储, 直到行足够短
+        返回新的 entry, 被移走的字段换成指针
+        '''
+        raws = {}
+        for field in self.fields:
+            raws[field.fieldName] = field.value2Raw(entry.get(field.fieldName))
+        length = sum(len(raw) for raw in raws.values())
+        if length <= Toast.TOAST_THRESHOLD:
+            return entry
+        entry = dict(entry)
+        candidates = [f for f in self.fields if f.fieldType == "string" and isinstance(entry.get(f.fieldName), str)]
+        candidates.sort(key = lambda f: len(raws[f.fieldName]), reverse = True)
+        for field in candidates:
+            if length <= Toast.TOAST_THRESHOLD or len(raws[field.fieldName]) <= Toast.POINTER_SIZE:
+                break
+            pointer = Toast.store(self.tbm.dm, xid, entry.get(field.fieldName).encode('utf-8'))
+            entry[field.fieldName] = pointer
+            length -= len(raws[field.fieldName]) - Toast.POINTER_SIZE
+        return entry
+
+    def detoastEntry(self, entry: dict) -> dict:
+        '''
+        把行外存储的字段读回行内
+        '''
+        for field in self.fields:
+            if isinstance(entry.get(field.fieldName), Toast.ToastPointer):
+                entry[field.fieldName] = field.detoast(entry.get(field.fieldName))
+        return entry
+
+    def freeChunks(self, raw: bytearray | bytes) -> None:
+        '''
+        行的版本被回收时调用, 回收它拥有的行外存储的块
+        '''
+        for value in self.parseEntry(raw).values():
+            if isinstance(value, Toast.ToastPointer):
+                Toast.free(self.tbm.dm, value)
+
     def entry2Raw(self, entry: dict) -> bytearray | bytes:
         raw = b''
         for field in self.fields:
@@ -1,11 +1,17 @@
 import struct
 import threading
+import traceback
 import backend.tbm.Booter
 import backend.tbm.Table
 import backend.parser.statement.Statements as Statements
 from backend.vm.VersionManager import VersionManager
 from backend.dm.DataManager import DataManager
 from backend.tbm.Booter import Booter
+
+# 冻结线程每隔 FREEZE_INTERVAL 秒检查一次, xid 文件中保存的事务状态超过 FREEZE_THRESHOLD 个时做一次冻结
+FREEZE_INTERVAL = 60
+FREEZE_THRESHOLD = 1 << 20
+
 class BeginRes(object):
     def __init__(self, xid = 0, result = b''):
         self.xid = xid
@@ -19,6 +25,8 @@ class TableManager:
         self.tableCache = {}
         self.xidTableCache = {}
         self.lock = threading.RLock()
+        self.freezer = None
+        self.freezerStop = threading.Event()
         self.loadTables()
     
     def loadTables(self) -> None:
@@ -39,7 +47,7 @@ class TableManager:
     def begin(self, begin: Statements.Begin) -> BeginRes:
         res = BeginRes()
         level = 1 if begin.isRepeatableRead else 0
-        res.xid = self.vm.begin(level)
+        res.xid = self.vm.begin(level, begin.synchronousCommit)
         res.result = b'begin'
         return res
     
@@ -118,11 +126,56 @@ class TableManager:
         count = table.delete(xid, delete)
         return ("delete " + str(count)).encode('utf-8')
 
+    def freeze(self) -> bool:
+        '''
+        冻结所有已经结束并且对所有活跃事务都可见的事务:
+        记录中这些事务的 XMIN 改成超级事务, 已经不可见的版本被回收, 被撤销的删除清除掉
+        冻结的修改落盘之后, xid 文件中不再保存这些事务的状态, 文件有变化时返回 True
+        '''
+        limit = self.vm.freezeLimit()
+        self.lock.acquire()
+        try:
+            tables = list(self.tableCache.values())
+        finally:
+            self.lock.release()
+        for tb in tables:
+            tb.freeze(limit)
+        self.dm.logger.flush()
+        return self.vm.tm.truncate(limit)
+
+    def startFreezer(self, interval: float = FREEZE_INTERVAL, threshold: int = FREEZE_THRESHOLD) -> None:
+        '''
+        启动冻结线程, 每隔 interval 秒检查一次, xid 文件中保存的事务状态超过 threshold 个时冻结
+        '''
+        if interval <= 0 or self.freezer is not None:
+            return
+        self.freezerStop.clear()
+        self.freezer = threading.Thread(target = self.runFreezer, args = (interval, threshold), daemon = True)
+        self.freezer.start()
+
+    def stopFreezer(self) -> None:
+        if self.freezer is None:
+            return
+        self.freezerStop.set()
+        self.freezer.join()
+        self.freezer = None
+
+    def runFreezer(self, interval: float, threshold: int) -> None:
+        tm = self.vm.tm
+        while not self.freezerStop.wait(interval):
+            try:
+                if tm.xidCounter - tm.base >= threshold:
+                    self.freeze()
+            except Exception:
+                traceback.print_exc()
+
 def create(path: str, vm: VersionManager, dm: DataManager) -> TableManager:
     booter = backend.tbm.Booter.create(path)
     booter.update(struct.pack('>q', 0))
     return TableManager(vm, dm, booter)
 
-def fileopen(path: str, vm: VersionManager, dm: DataManager) -> TableManager:
+def fileopen(path: str, vm: VersionManager, dm: DataManager, freezeInterval: float = FREEZE_INTERVAL) -> TableManager:
     booter = backend.tbm.Booter.fileopen(path)
-    return TableManager(vm, dm, booter)
+    tbm = TableManager(vm, dm, booter)
+    tbm.startFreezer(freezeInterval)
+    return tbm
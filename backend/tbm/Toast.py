@@ -0,0 +1,104 @@
+'''
+行外存储较长的字符串字段
+一行数据超过 TOAST_THRESHOLD 时, 从最长的字符串字段开始, 把字段的内容切成若干块存到单独的 DataItem 中, 行内只留下一个指针
+每一块基本占满一个页面, 块之间串成链表:
+[NextUid][Data]
+行内的指针格式为:
+[TOAST_MARKER][Length][FirstUid]
+字符串字段的长度不会是负数, 用 TOAST_MARKER 区分行内的值和指针
+读取时只有真正需要输出的字段才会沿着链表读出内容
+块由插入行的事务写入, 之后不再修改
+每个版本拥有自己的块: 更新行时新版本把没有修改的字段也复制一份, 不和旧版本共用指针; 版本被回收时连同它的块一起回收
+'''
+import struct
+from backend.dm.DataManager import DataManager
+from backend.dm.dataItem import DataItem
+from backend.dm.page import PageX
+from backend.dm.pageCache import PageCache
+
+TOAST_MARKER = -1
+# 行内指针的长度
+POINTER_SIZE = 4 + 4 + 8
+# 一行超过这个长度时开始把字段移到行外
+TOAST_THRESHOLD = PageCache.PAGE_SIZE // 4
+
+OF_CHUNK_NEXT = 0
+OF_CHUNK_DATA = OF_CHUNK_NEXT + 8
+# 每一块能存放的数据, 一块正好能放进一个空页面
+CHUNK_SIZE = PageX.MAX_FREE_SPACE - DataItem.OF_DATA - OF_CHUNK_DATA
+
+class ToastPointer(object):
+    def __init__(self, length: int, uid: int):
+        # 字段内容的字节数
+        self.length = length
+        # 第一块的 uid
+        self.uid = uid
+
+    def raw(self) -> bytes:
+        return struct.pack('>i', TOAST_MARKER) + struct.pack('>i', self.length) + struct.pack('>q', self.uid)
+
+def isPointer(raw: bytearray | bytes) -> bool:
+    return struct.unpack('>i', raw[0 : 4])[0] == TOAST_MARKER
+
+def parsePointer(raw: bytearray | bytes) -> ToastPointer:
+    length = struct.unpack('>i', raw[4 : 8])[0]
+    uid = struct.unpack('>q', raw[8 : 16])[0]
+    return ToastPointer(length, uid)
+
+def store(dm: DataManager, xid: int, data: bytearray | bytes) -> ToastPointer:
+    '''
+    把 data 切块写入, 从最后一块开始写, 每一块写入时都已经知道下一块的 uid
+    '''
+    starts = list(range(0, len(data), CHUNK_SIZE))
+    nextUid = 0
+    for start in reversed(starts):
+        chunk = struct.pack('>q', nextUid) + data[start : start + CHUNK_SIZE]
+        nextUid = dm.insert(xid, chunk)
+    return ToastPointer(len(data), nextUid)
+
+def load(dm: DataManager, pointer: ToastPointer) -> bytes:
+    '''
+    沿着链表读出字段的内容
+    '''
+    chunks = []
+    uid = pointer.uid
+    while uid != 0:
+        di = dm.read(uid)
+        if di == None:
+            raise Exception("ToastChunkNotFoundException")
+        try:
+            sa = di.data()
+            uid = struct.unpack('>q', sa.raw[sa.start + OF_CHUNK_NEXT : sa.start + OF_CHUNK_DATA])[0]
+            chunks.append(bytes(sa.raw[sa.start + OF_CHUNK_DATA : sa.end]))
+        finally:
+            di.release()
+    data = b''.join(chunks)
+    if len(data) != pointer.length:
+        raise Exception("ToastChunkNotFoundException")
+    return data
+
+def free(dm: DataManager, pointer: ToastPointer) -> None:
+    '''
+    回收链表上所有的块, 先找出整条链表再从最后一块开始回收, 中途崩溃时剩下的块仍然能从第一块找到
+    块已经被回收(并发回收同一个版本, 或者上次回收到一半)时, 只回收还能找到的部分
+    '''
+    uids = []
+    uid = pointer.uid
+    while uid != 0:
+        di = dm.read(uid)
+        if di == None:
+            break
+        try:
+            sa = di.data()
+            uids.append(uid)
+            uid = struct.unpack('>q', sa.raw[sa.start + OF_CHUNK_NEXT : sa.start + OF_CHUNK_DATA])[0]
+        finally:
+            di.release()
+    for uid in reversed(uids):
+        di = dm.read(uid)
+        if di == None:
+            continue
+        try:
+            dm.free(di)
+        finally:
+            di.release()
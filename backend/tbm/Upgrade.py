@@ -0,0 +1,311 @@
+'''
+离线升级: 把旧版本的数据库导出, 再导入到一个新建的数据库
+旧版本的数据文件没有格式标记, 页面是只追加的: 以 2 字节的空闲位置偏移起始, 之后依次是 [ValidFlag][DataSize][Data], uid 是 (页号, 页内偏移)
+槽页布局改变了 uid 的含义, 索引和表结构中保存的 uid 都不能原地转换, 所以按表导出可见的记录, 在新的数据库中重新插入
+旧数据库没有正常关闭时, 先在内存中按旧的日志重做已完成的事务, 撤销未完成的事务, 不修改旧数据库的任何文件
+旧的单文件日志由 LegacyLogger 读取, 旧的 xid 文件由 TransactionManager.readLegacy 读取
+'''
+import os
+import struct
+import backend.tm.TransactionManager as TransactionManager
+import backend.dm.DataManager as DataManager
+import backend.tbm.TableManager as TableManager
+import backend.parser.statement.Statements as Statements
+from backend.dm.logger import LegacyLogger
+from backend.dm.pageCache import PageCache
+from backend.tbm.Booter import BOOTER_SUFFIX
+from backend.vm.VersionManager import VersionManager
+
+# 旧版本的 PageOne: 100 ~ 107 字节是启动时的随机字节, 108 ~ 115 字节是正常关闭时拷贝的随机字节
+OF_VC = 100
+LEN_VC = 8
+# 旧版本的页面和 DataItem
+OF_FREE = 0
+OF_PAGE_DATA = 2
+OF_VALID = 0
+OF_SIZE = 1
+OF_DATA = 3
+# 旧版本的日志: [LogType][XID][Pgno][Offset][Raw] 和 [LogType][XID][UID][OldRaw][NewRaw]
+LOG_TYPE_INSERT = 0
+OF_XID = 1
+OF_INSERT_PGNO = OF_XID + 8
+OF_INSERT_OFFSET = OF_INSERT_PGNO + 4
+OF_INSERT_RAW = OF_INSERT_OFFSET + 2
+OF_UPDATE_UID = OF_XID + 8
+OF_UPDATE_RAW = OF_UPDATE_UID + 8
+# 旧版本的 entry: [XMIN][XMAX][data]
+OF_XMIN = 0
+OF_XMAX = 8
+OF_ENTRY_DATA = 16
+# 旧版本的 B+ 树节点: [LeafFlag][KeyNumber][SiblingUid][Son0][Key0]...
+NO_KEYS_OFFSET = 1
+SIBLING_OFFSET = 3
+NODE_HEADER_SIZE = 11
+
+class LegacyDatabase(object):
+    '''
+    只读地打开一个旧版本的数据库, 页面读入内存后不再写回
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path + PageCache.DB_SUFFIX, 'rb')
+        self.pages = {}
+        self.xidCounter, self.status = TransactionManager.readLegacy(path)
+        # 恢复时撤销的事务
+        self.aborted = set()
+        pageOne = self.page(1)
+        if pageOne[OF_VC : OF_VC + LEN_VC] != pageOne[OF_VC + LEN_VC : OF_VC + 2 * LEN_VC]:
+            self.recover()
+
+    def page(self, pgno: int) -> bytearray:
+        pg = self.pages.get(pgno)
+        if pg is None:
+            self.file.seek((pgno - 1) * PageCache.PAGE_SIZE)
+            pg = bytearray(self.file.read(PageCache.PAGE_SIZE))
+            pg.extend(bytes(PageCache.PAGE_SIZE - len(pg)))
+            self.pages[pgno] = pg
+        return pg
+
+    def fieldOf(self, xid: int) -> int:
+        '''
+        xid 文件中记录的事务状态, 超过 xidCounter 的事务还没有开始就崩溃了, 当作进行中
+        '''
+        if xid > self.xidCounter:
+            return TransactionManager.FIELD_TRAN_ACTIVE
+        index = xid - 1
+        b = self.status[index // TransactionManager.XIDS_PER_BYTE]
+        return (b >> ((index % TransactionManager.XIDS_PER_BYTE) * TransactionManager.XID_FIELD_BITS)) & TransactionManager.FIELD_MASK
+
+    def getStatus(self, xid: int) -> int:
+        '''
+        导出时的事务状态, 恢复时撤销的事务和仍是进行中的事务都是已撤销
+        '''
+        if xid == TransactionManager.SUPER_XID:
+            return TransactionManager.FIELD_TRAN_COMMITTED
+        field = self.fieldOf(xid)
+        if field == TransactionManager.FIELD_TRAN_ACTIVE or xid in self.aborted:
+            return TransactionManager.FIELD_TRAN_ABORTED
+        return field
+
+    def isCommitted(self, xid: int) -> bool:
+        return self.getStatus(xid) == TransactionManager.FIELD_TRAN_COMMITTED
+
+    def recover(self) -> None:
+        '''
+        按旧版本的恢复流程: 重做已完成的事务, 再倒序撤销未完成的事务
+        只有版本 1 的日志是旧版本的数据文件写下的, 之后的日志格式都对应槽页布局
+        '''
+        if not LegacyLogger.exists(self.path):
+            raise Exception("BadLogFileException")
+        lg = LegacyLogger.LegacyLogger(self.path + LegacyLogger.LOG_SUFFIX)
+        try:
+            lg.init()
+            if lg.version != LegacyLogger.LOG_VERSION_LEGACY:
+                raise Exception("BadLogFileException")
+            undo = []
+            for _, log in lg.records():
+                log = bytes(log)
+                xid = struct.unpack('>q', log[OF_XID : OF_XID + 8])[0]
+                if xid != TransactionManager.SUPER_XID and self.fieldOf(xid) == TransactionManager.FIELD_TRAN_ACTIVE:
+                    undo.append(log)
+                    self.aborted.add(xid)
+                else:
+                    self.redo(log)
+            for log in reversed(undo):
+                self.undo(log)
+        finally:
+            lg.close()
+
+    def redo(self, log: bytes) -> None:
+        if log[0] == LOG_TYPE_INSERT:
+            pgno, offset, raw = parseInsertLog(log)
+            self.write(pgno, offset, raw, True)
+        else:
+            pgno, offset, oldRaw, newRaw = parseUpdateLog(log)
+            self.write(pgno, offset, newRaw, False)
+
+    def undo(self, log: bytes) -> None:
+        if log[0] == LOG_TYPE_INSERT:
+            pgno, offset, raw = parseInsertLog(log)
+            raw = bytearray(raw)
+            raw[OF_VALID] = 1
+            self.write(pgno, offset, raw, True)
+        else:
+            pgno, offset, oldRaw, newRaw = parseUpdateLog(log)
+            self.write(pgno, offset, oldRaw, False)
+
+    def write(self, pgno: int, offset: int, raw: bytes | bytearray, insert: bool) -> None:
+        pg = self.page(pgno)
+        pg[offset : offset + len(raw)] = raw
+        if insert and struct.unpack('>H', pg[OF_FREE : OF_PAGE_DATA])[0] < offset + len(raw):
+            pg[OF_FREE : OF_PAGE_DATA] = struct.pack('>H', offset + len(raw))
+
+    def readItem(self, uid: int) -> tuple:
+        '''
+        读取 uid 处的 DataItem, 返回 (是否合法, 数据), 被撤销的插入是非法的
+        '''
+        pg = self.page((uid >> 32) & ((1 << 32) - 1))
+        offset = uid & ((1 << 16) - 1)
+        size = struct.unpack('>H', pg[offset + OF_SIZE : offset + OF_DATA])[0]
+        return (pg[offset + OF_VALID] == 0, bytes(pg[offset + OF_DATA : offset + OF_DATA + size]))
+
+    def readEntry(self, uid: int) -> tuple:
+        '''
+        读取 uid 处的 entry, 返回 (对新开始的事务是否可见, 数据)
+        '''
+        valid, raw = self.readItem(uid)
+        xmin = struct.unpack('>q', raw[OF_XMIN : OF_XMAX])[0]
+        xmax = struct.unpack('>q', raw[OF_XMAX : OF_ENTRY_DATA])[0]
+        visible = valid and self.isCommitted(xmin) and (xmax == 0 or not self.isCommitted(xmax))
+        return (visible, raw[OF_ENTRY_DATA : ])
+
+    def tables(self) -> list:
+        '''
+        按创建的先后返回所有可见的表: (表名, [(字段名, 类型, 索引的 bootUid)])
+        '''
+        with open(self.path + BOOTER_SUFFIX, 'rb') as f:
+            uid = struct.unpack('>q', f.read(8))[0]
+        tables = []
+        while uid != 0:
+            # 建表的事务被撤销时表不可见, 但链表仍然要经过它
+            visible, raw = self.readEntry(uid)
+            length = struct.unpack('>i', raw[0 : 4])[0]
+            name = raw[4 : 4 + length].decode('utf-8')
+            position = 4 + length
+            uid = struct.unpack('>q', raw[position : position + 8])[0]
+            position += 8
+            fields = []
+            while position < len(raw):
+                fields.append(self.readField(struct.unpack('>q', raw[position : position + 8])[0]))
+                position += 8
+            if visible:
+                tables.append((name, fields))
+        tables.reverse()
+        return tables
+
+    def readField(self, uid: int) -> tuple:
+        _, raw = self.readEntry(uid)
+        length = struct.unpack('>i', raw[0 : 4])[0]
+        name = raw[4 : 4 + length].decode('utf-8')
+        position = 4 + length
+        length = struct.unpack('>i', raw[position : position + 4])[0]
+        fieldType = raw[position + 4 : position + 4 + length].decode('utf-8')
+        position += 4 + length
+        index = struct.unpack('>q', raw[position : position + 8])[0]
+        return (name, fieldType, index)
+
+    def rows(self, fields: list):
+        '''
+        依次返回表中可见的记录, 每条记录是各字段值的字符串
+        和旧版本的全表查询一样沿第一个有索引的字段的叶子节点读取, 没有索引的表读不到记录
+        '''
+        index = next((f[2] for f in fields if f[2] != 0), 0)
+        if index == 0:
+            return
+        nodeUid = struct.unpack('>q', self.readItem(index)[1][0 : 8])[0]
+        node = self.readItem(nodeUid)[1]
+        # 一直沿最左边的儿子走到叶子
+        while node[0] != 1:
+            nodeUid = sonOf(node, 0)
+            node = self.readItem(nodeUid)[1]
+        seen = set()
+        while True:
+            for kth in range(struct.unpack('>h', node[NO_KEYS_OFFSET : SIBLING_OFFSET])[0]):
+                uid = sonOf(node, kth)
+                # 更新会在索引中留下新旧两个版本, 同一个 uid 也可能被插入多次
+                if uid in seen:
+                    continue
+                seen.add(uid)
+                visible, raw = self.readEntry(uid)
+                if visible:
+                    yield parseValues(fields, raw)
+            sibling = struct.unpack('>q', node[SIBLING_OFFSET : NODE_HEADER_SIZE])[0]
+            if sibling == 0:
+                break
+            node = self.readItem(sibling)[1]
+
+    def close(self) -> None:
+        self.file.close()
+
+def sonOf(node: bytes, kth: int) -> int:
+    offset = NODE_HEADER_SIZE + kth * (8 * 2)
+    return struct.unpack('>q', node[offset : offset + 8])[0]
+
+def parseInsertLog(log: bytes) -> tuple:
+    pgno = struct.unpack('>i', log[OF_INSERT_PGNO : OF_INSERT_OFFSET])[0]
+    offset = struct.unpack('>H', log[OF_INSERT_OFFSET : OF_INSERT_RAW])[0]
+    return (pgno, offset, log[OF_INSERT_RAW : ])
+
+def parseUpdateLog(log: bytes) -> tuple:
+    uid = struct.unpack('>q', log[OF_UPDATE_UID : OF_UPDATE_RAW])[0]
+    length = (len(log) - OF_UPDATE_RAW) // 2
+    oldRaw = log[OF_UPDATE_RAW : OF_UPDATE_RAW + length]
+    newRaw = log[OF_UPDATE_RAW + length : OF_UPDATE_RAW + length * 2]
+    return ((uid >> 32) & ((1 << 32) - 1), uid & ((1 << 16) - 1), oldRaw, newRaw)
+
+def parseValues(fields: list, raw: bytes) -> list:
+    '''
+    按旧版本的格式解析一条记录: int32, int64 是定长的大端整数, string 是 [Length][UTF-8]
+    '''
+    values = []
+    position = 0
+    for _, fieldType, _ in fields:
+        if fieldType == "int32":
+            values.append(str(struct.unpack('>i', raw[position : position + 4])[0]))
+            position += 4
+        elif fieldType == "int64":
+            values.append(str(struct.unpack('>q', raw[position : position + 8])[0]))
+            position += 8
+        elif fieldType == "string":
+            length = struct.unpack('>i', raw[position : position + 4])[0]
+            values.append(raw[position + 4 : position + 4 + length].decode('utf-8'))
+            position += 4 + length
+        else:
+            raise Exception("InvalidFieldException")
+    return values
+
+def isLegacy(path: str) -> bool:
+    '''
+    数据文件是否没有当前版本的格式标记
+    '''
+    try:
+        DataManager.checkFormat(path)
+        return False
+    except Exception:
+        return True
+
+def upgrade(oldPath: str, newPath: str, mem: int) -> int:
+    '''
+    把 oldPath 处的旧版本数据库导出, 导入到 newPath 处新建的数据库中, 返回导入的记录数
+    旧数据库不会被修改; newPath 处已经有数据库时不覆盖
+    每个表在一个事务中建表并插入所有记录, 中途失败时新数据库中只会留下已经完成的表
+    '''
+    if not isLegacy(oldPath):
+        raise Exception("InvalidDataFileException")
+    if os.path.exists(newPath + PageCache.DB_SUFFIX):
+        raise Exception("DatabaseExistsException")
+    old = LegacyDatabase(oldPath)
+    tm = TransactionManager.create(newPath)
+    dm = DataManager.create(newPath, mem, tm)
+    vm = VersionManager(tm, dm)
+    tbm = TableManager.create(newPath, vm, dm)
+    count = 0
+    try:
+        for name, fields in old.tables():
+            xid = vm.begin(0)
+            try:
+                create = Statements.Create(name, [f[0] for f in fields], [f[1] for f in fields], [f[0] for f in fields if f[2] != 0])
+                tbm.create(xid, create)
+                for values in old.rows(fields):
+                    tbm.insert(xid, Statements.Insert(name, values))
+                    count += 1
+            except Exception as e:
+                vm.abort(xid)
+                raise e
+            vm.commit(xid)
+    finally:
+        old.close()
+        tbm.booter.close()
+        dm.close()
+        tm.close()
+    return count
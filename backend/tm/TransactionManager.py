@@ -1,10 +1,36 @@
+# xid 文件: [XidCounter][Magic][Version][Base][Status...]
+# 每个事务的状态占 2 位, 一个字节存 4 个事务, 第 xid 个事务在第 (xid - Base) // 4 个字节的第 (xid - Base) % 4 组低位起的 2 位
+# Base 之前的事务都已经被冻结: 它们创建的记录的 XMIN 改成了超级事务, 不再保存状态, 查询时视为已提交
+# 文件按区段整块增长并映射到内存, 查询状态只是读映射上的一个字节, 修改状态直接写映射, 由操作系统写回文件
+# 旧版本的 xid 文件没有 [Base], 更早的版本每个事务占 1 个字节, 打开时转换成当前格式
+import mmap
+import os
 import struct
 import threading
+from backend.common.RandomAccessFile import RandomAccessFile
+from backend.dm.logger import Logger
 
 # XID 文件头长度
-LEN_XID_HEADER_LENGTH = 8
-# 每个事务占用长度
-XID_FIELD_SIZE = 1
+LEN_XID_HEADER_LENGTH = 24
+XID_MAGIC = b'LDBX'
+XID_VERSION = 3
+OF_COUNTER = 0
+OF_MAGIC = OF_COUNTER + 8
+OF_VERSION = OF_MAGIC + 4
+OF_BASE = OF_VERSION + 4
+# 版本 2 的文件头没有 [Base], Base 总是 1
+# 写下版本 2 文件的数据库已经是槽页布局, 但数据文件还没有格式标记, 同样打开时就被拒绝, 打开时的转换走不到
+V2_HEADER_LENGTH = OF_BASE
+XID_VERSION_V2 = 2
+# 版本 1 的文件头只有 [XidCounter], 每个事务占用 1 个字节
+# 版本 1 的 xid 文件属于槽页布局之前的数据库, 数据文件在打开时就被拒绝, 打开时的转换走不到; Upgrade 用 readLegacy 读取它
+LEGACY_HEADER_LENGTH = 8
+LEGACY_FIELD_SIZE = 1
+
+# 每个事务状态占用的位数, 以及一个字节能存的事务数
+XID_FIELD_BITS = 2
+XIDS_PER_BYTE = 8 // XID_FIELD_BITS
+FIELD_MASK = (1 << XID_FIELD_BITS) - 1
 
 # 事务的三种状态
 FIELD_TRAN_ACTIVE = 0
@@ -15,66 +41,120 @@ FIELD_TRAN_ABORTED = 2
 SUPER_XID = 0
 # 文件后缀
 XID_SUFFIX = '.xid'
+XID_TMP_SUFFIX = '.xid_tmp'
+# 字节中是否有处于进行中状态的事务, 以及把其中进行中的事务都改成已撤销, 按整个字节查表
+def fieldsOf(b: int) -> list:
+    return [(b >> shift) & FIELD_MASK for shift in range(0, 8, XID_FIELD_BITS)]
+HAS_ACTIVE = bytes(int(FIELD_TRAN_ACTIVE in fieldsOf(b)) for b in range(256))
+ABORT_ACTIVE = bytes(sum((FIELD_TRAN_ABORTED if field == FIELD_TRAN_ACTIVE else field) << (i * XID_FIELD_BITS)
+                         for i, field in enumerate(fieldsOf(b))) for b in range(256))
+# 文件每次增长和映射的字节数, 需要是 mmap.ALLOCATIONGRANULARITY 的整数倍, 一个区段能存 256K 个事务
+XID_EXTENT_SIZE = 1 << 16
 
 class TransactionManager(object):
-    def __init__(self, raf: str):
-        self.file = raf
+    def __init__(self, raf: str, syncOnCommit: bool = False):
+        self.fileName = raf
+        self.file = RandomAccessFile(raf)
         self.xidCounter = 0
         self.counterLock = threading.RLock()
+        # 同一个字节里有 4 个事务的状态, 修改状态是读-改-写, 需要互斥; 查询不加锁
+        self.statusLock = threading.Lock()
+        # syncOnCommit 为 True 时提交和回滚之后立即把状态所在的页刷到磁盘
+        # 默认由检查点持久化, 崩溃时丢失的提交状态由恢复流程根据提交日志补上
+        self.syncOnCommit = syncOnCommit
+        # 文件中第一个保存了状态的事务
+        self.base = 1
+        # (base, 区段映射), 截断文件时整体替换, 查询时一次取出, 不会看到不匹配的 base 和映射
+        self.mapping = (1, [])
         self.checkXIDCounter()
+        self.ensureMapped(self.xidCounter)
 
     def checkXIDCounter(self) -> None:
         '''
         检验 xid 文件是否合法
         '''
-        with open(self.file, 'rb') as f:
-            f.seek(0, 0)
-            header = f.read(8)
-            expected_length = struct.unpack('>Q', header)[0] + 8
-            f.seek(0, 2)
-            file_size = f.tell()
-            if expected_length != file_size:
-                raise Exception("InvalidXIDFileException")
-        f.close()
-        self.xidCounter = file_size - 8
-    
-    def getXidPosition(self, xid: int) -> int:
-        '''
-        根据事务 xid 读取 xid 文件对应的位置
-        '''
-        return LEN_XID_HEADER_LENGTH + (xid - 1) * XID_FIELD_SIZE
-    
+        header = self.file.read(0, LEN_XID_HEADER_LENGTH)
+        if len(header) < LEN_XID_HEADER_LENGTH or header[OF_MAGIC : OF_VERSION] != XID_MAGIC \
+            or struct.unpack('>I', header[OF_VERSION : OF_BASE])[0] != XID_VERSION:
+            raise Exception("InvalidXIDFileException")
+        xidCounter = struct.unpack('>q', header[OF_COUNTER : OF_MAGIC])[0]
+        base = struct.unpack('>q', header[OF_BASE : LEN_XID_HEADER_LENGTH])[0]
+        if base < 1 or (base - 1) % XIDS_PER_BYTE != 0 or xidCounter < base - 1 \
+            or statusPosition(xidCounter, base)[0] >= self.file.size():
+            raise Exception("InvalidXIDFileException")
+        self.xidCounter = xidCounter
+        self.base = base
+        self.mapping = (base, [])
+
+    def ensureMapped(self, xid: int, mapping: tuple | None = None) -> None:
+        '''
+        保证 xid 的状态所在的区段已经映射到 mapping (默认是当前的映射), 文件不够长时按区段增长
+        调用者需要持有 counterLock 或者在初始化中
+        '''
+        base, extents = self.mapping if mapping is None else mapping
+        offset = statusPosition(max(xid, base), base)[0]
+        while len(extents) * XID_EXTENT_SIZE <= offset:
+            start = len(extents) * XID_EXTENT_SIZE
+            if self.file.size() < start + XID_EXTENT_SIZE:
+                self.file.allocate(start, XID_EXTENT_SIZE)
+            extents.append(mmap.mmap(self.file.fd, XID_EXTENT_SIZE, offset = start, access = mmap.ACCESS_WRITE))
+
     def updateXID(self, xid: int, status: int) -> None:
         '''
-        xid 文件更新新的事务状态
+        修改事务 xid 的状态, 直接写到映射上, 已经冻结的事务不再记录
         '''
-        offset = self.getXidPosition(xid)
-        tmp = struct.pack('B', status)
-        with open(self.file, 'rb+') as f:
-            f.seek(offset, 0)
-            f.write(tmp)
-        f.close()
+        self.statusLock.acquire()
+        try:
+            base, extents = self.mapping
+            if xid < base:
+                return
+            offset, shift = statusPosition(xid, base)
+            extent = extents[offset // XID_EXTENT_SIZE]
+            offset %= XID_EXTENT_SIZE
+            extent[offset] = (extent[offset] & ~(FIELD_MASK << shift) & 0xFF) | (status << shift)
+        finally:
+            self.statusLock.release()
+        if self.syncOnCommit and status != FIELD_TRAN_ACTIVE:
+            start = offset - offset % mmap.PAGESIZE
+            extent.flush(start, mmap.PAGESIZE)
 
     def incrXIDCounter(self) -> None:
         '''
-        自增 xidCounter 同时修改 xid 文件
+        自增 xidCounter 同时修改 xid 文件头
         '''
         self.xidCounter += 1
-        with open(self.file, 'rb+') as f:
-            f.seek(0, 0)
-            f.write(struct.pack('>q', self.xidCounter))
-        f.close()
+        self.mapping[1][0][OF_COUNTER : OF_MAGIC] = struct.pack('>q', self.xidCounter)
+
+    def advanceCounter(self, xid: int) -> None:
+        '''
+        恢复时日志中出现了比 xidCounter 更大的事务, 说明崩溃时 xid 文件头还没有落盘
+        把 xidCounter 提高到 xid 并映射它的状态, 之后开始的事务不会重复使用日志中的 xid
+        '''
+        self.counterLock.acquire()
+        try:
+            if xid <= self.xidCounter:
+                return
+            self.ensureMapped(xid)
+            self.xidCounter = xid
+            self.mapping[1][0][OF_COUNTER : OF_MAGIC] = struct.pack('>q', self.xidCounter)
+        finally:
+            self.counterLock.release()
+
+    def getStatus(self, xid: int) -> int:
+        '''
+        读取事务 xid 的状态
+        '''
+        base, extents = self.mapping
+        if xid < base:
+            return FIELD_TRAN_COMMITTED
+        offset, shift = statusPosition(xid, base)
+        return (extents[offset // XID_EXTENT_SIZE][offset % XID_EXTENT_SIZE] >> shift) & FIELD_MASK
 
     def checkXID(self, xid: int, status: int) -> bool:
         '''
         检查 xid 的事务是否处于 status 状态
         '''
-        offset = self.getXidPosition(xid)
-        with open(self.file, 'rb') as f:
-            f.seek(offset, 0)
-            rec = f.read(XID_FIELD_SIZE)
-        f.close()
-        return struct.unpack('B', rec)[0] == status
+        return self.getStatus(xid) == status
 
     def begin(self) -> int:
         '''
@@ -83,6 +163,7 @@ class TransactionManager(object):
         self.counterLock.acquire()
         try:
             xid = self.xidCounter + 1
+            self.ensureMapped(xid)
             self.updateXID(xid, FIELD_TRAN_ACTIVE)
             self.incrXIDCounter()
         finally:
@@ -118,7 +199,7 @@ class TransactionManager(object):
             return True
         else:
             return self.checkXID(xid, FIELD_TRAN_COMMITTED)
-        
+
     def isAborted(self, xid: int) -> bool:
         '''
         查询一个事务的状态是否是已取消
@@ -128,16 +209,179 @@ class TransactionManager(object):
         else:
             return self.checkXID(xid, FIELD_TRAN_ABORTED)
 
-def create(path: str) -> TransactionManager:
+    def isFrozen(self, xid: int) -> bool:
+        '''
+        事务是否已经被冻结, 冻结的事务视为已提交, 它的修改不会再被撤销
+        '''
+        return xid != SUPER_XID and xid < self.mapping[0]
+
+    def truncate(self, horizon: int) -> bool:
+        '''
+        horizon 之前的事务都已经冻结, 不再保存它们的状态, 重写 xid 文件只保留之后的部分
+        仍处于进行中状态的事务不会被截掉, 新的 Base 不超过其中最早的一个
+        新文件先写成临时文件再替换, 替换之前崩溃时旧文件仍然完整; 文件没有变化时返回 False
+        '''
+        base = horizon - (horizon - 1) % XIDS_PER_BYTE
+        self.counterLock.acquire()
+        try:
+            if base <= self.base:
+                return False
+            self.statusLock.acquire()
+            try:
+                oldBase, extents = self.mapping
+                start = statusPosition(base, oldBase)[0]
+                active = readMapped(extents, LEN_XID_HEADER_LENGTH, start).translate(HAS_ACTIVE).find(1)
+                if active != -1:
+                    base = oldBase + active * XIDS_PER_BYTE
+                    if base <= oldBase:
+                        return False
+                    start = statusPosition(base, oldBase)[0]
+                end = statusPosition(max(self.xidCounter, base - 1), oldBase)[0] + 1
+                status = readMapped(extents, start, end)
+                writeXidFile(self.fileName, self.xidCounter, base, status)
+                file = self.file
+                self.file = RandomAccessFile(self.fileName)
+                mapping = (base, [])
+                self.ensureMapped(self.xidCounter, mapping)
+                # 旧的映射留给还在读它的线程, 不再引用时自动解除
+                self.mapping = mapping
+                self.base = base
+                file.close()
+            finally:
+                self.statusLock.release()
+        finally:
+            self.counterLock.release()
+        return True
+
+    def abortActive(self) -> None:
+        '''
+        打开数据库时还没有开始任何事务, 仍处于进行中状态的事务都是上次没有结束的, 全部改成已撤销
+        需要在恢复流程判断出要撤销的事务之后调用
+        '''
+        self.counterLock.acquire()
+        self.statusLock.acquire()
+        try:
+            extents = self.mapping[1]
+            start = LEN_XID_HEADER_LENGTH
+            end = statusPosition(max(self.xidCounter, self.base - 1), self.base)[0] + 1
+            while start < end:
+                extent = extents[start // XID_EXTENT_SIZE]
+                of = start % XID_EXTENT_SIZE
+                length = min(end - start, XID_EXTENT_SIZE - of)
+                extent[of : of + length] = extent[of : of + length].translate(ABORT_ACTIVE)
+                start += length
+        finally:
+            self.statusLock.release()
+            self.counterLock.release()
+
+    def sync(self) -> None:
+        '''
+        把事务状态刷到磁盘上, 提交时只写日志, 状态文件由检查点负责持久化
+        '''
+        self.counterLock.acquire()
+        try:
+            extents = list(self.mapping[1])
+        finally:
+            self.counterLock.release()
+        for extent in extents:
+            extent.flush()
+
+    def close(self) -> None:
+        self.sync()
+        for extent in self.mapping[1]:
+            extent.close()
+        self.mapping = (self.base, [])
+        self.file.close()
+
+def statusPosition(xid: int, base: int) -> tuple:
+    '''
+    文件从 base 开始保存状态时, 事务 xid 的状态在文件中的 (字节偏移量, 位偏移量)
+    '''
+    index = xid - base
+    return (LEN_XID_HEADER_LENGTH + index // XIDS_PER_BYTE, (index % XIDS_PER_BYTE) * XID_FIELD_BITS)
+
+def readMapped(extents: list, start: int, end: int) -> bytes:
+    '''
+    读出区段映射上 [start, end) 的字节
+    '''
+    chunks = []
+    while start < end:
+        of = start % XID_EXTENT_SIZE
+        length = min(end - start, XID_EXTENT_SIZE - of)
+        chunks.append(extents[start // XID_EXTENT_SIZE][of : of + length])
+        start += length
+    return b''.join(chunks)
+
+def header(xidCounter: int, base: int) -> bytes:
+    return struct.pack('>q', xidCounter) + XID_MAGIC + struct.pack('>I', XID_VERSION) + struct.pack('>q', base)
+
+def writeXidFile(fileName: str, xidCounter: int, base: int, status: bytes | bytearray) -> None:
+    '''
+    先写临时文件并落盘, 再替换 fileName, 替换之后 fsync 所在的目录, 断电后不会又回到旧文件和旧的 Base
+    '''
+    tmpName = fileName[ : len(fileName) - len(XID_SUFFIX)] + XID_TMP_SUFFIX
+    with open(tmpName, 'wb') as f:
+        f.write(header(xidCounter, base))
+        f.write(status)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpName, fileName)
+    Logger.syncDirectory(fileName)
+
+def create(path: str, syncOnCommit: bool = False) -> TransactionManager:
     '''
     以 path 为目录创建一个事务文件
     '''
     with open(path + XID_SUFFIX, 'wb+') as f:
-        f.write(struct.pack('>q', 0))
-    return TransactionManager(path + XID_SUFFIX)
+        f.write(header(0, 1))
+    return TransactionManager(path + XID_SUFFIX, syncOnCommit)
+
+def readLegacy(path: str) -> tuple:
+    '''
+    读出旧版本 xid 文件中的 (xidCounter, 状态), 状态按当前格式每个事务占 2 位, 从事务 1 开始
+    版本 1 每个事务占 1 个字节; 版本 2 已经是每个事务 2 位, 只是没有 [Base]
+    '''
+    with open(path + XID_SUFFIX, 'rb') as f:
+        raw = f.read()
+    if len(raw) >= V2_HEADER_LENGTH and raw[OF_MAGIC : OF_VERSION] == XID_MAGIC:
+        if struct.unpack('>I', raw[OF_VERSION : OF_BASE])[0] != XID_VERSION_V2:
+            raise Exception("InvalidXIDFileException")
+        xidCounter = struct.unpack('>q', raw[OF_COUNTER : OF_MAGIC])[0]
+        length = (xidCounter + XIDS_PER_BYTE - 1) // XIDS_PER_BYTE
+        if V2_HEADER_LENGTH + length > len(raw):
+            raise Exception("InvalidXIDFileException")
+        return (xidCounter, raw[V2_HEADER_LENGTH : V2_HEADER_LENGTH + length])
+    if len(raw) < LEGACY_HEADER_LENGTH:
+        raise Exception("InvalidXIDFileException")
+    xidCounter = struct.unpack('>q', raw[0 : LEGACY_HEADER_LENGTH])[0]
+    if xidCounter + LEGACY_HEADER_LENGTH != len(raw):
+        raise Exception("InvalidXIDFileException")
+    status = bytearray((xidCounter + XIDS_PER_BYTE - 1) // XIDS_PER_BYTE)
+    for i in range(xidCounter):
+        field = raw[LEGACY_HEADER_LENGTH + i * LEGACY_FIELD_SIZE] & FIELD_MASK
+        status[i // XIDS_PER_BYTE] |= field << ((i % XIDS_PER_BYTE) * XID_FIELD_BITS)
+    return (xidCounter, status)
+
+def convertLegacy(path: str) -> None:
+    '''
+    把旧版本的 xid 文件转换成当前格式
+    '''
+    xidCounter, status = readLegacy(path)
+    writeXidFile(path + XID_SUFFIX, xidCounter, 1, status)
+
+def isLegacy(path: str) -> bool:
+    with open(path + XID_SUFFIX, 'rb') as f:
+        raw = f.read(LEN_XID_HEADER_LENGTH)
+    return raw[OF_MAGIC : OF_VERSION] != XID_MAGIC or struct.unpack('>I', raw[OF_VERSION : OF_BASE])[0] != XID_VERSION
 
-def fileopen(path: str) -> TransactionManager:
+def fileopen(path: str, syncOnCommit: bool = False) -> TransactionManager:
     '''
-    打开 path 事务文件
+    打开 path 事务文件, 旧版本的文件先转换成当前格式
     '''
-    return TransactionManager(path + XID_SUFFIX)
+    try:
+        os.remove(path + XID_TMP_SUFFIX)
+    except OSError:
+        pass
+    if isLegacy(path):
+        convertLegacy(path)
+    return TransactionManager(path + XID_SUFFIX, syncOnCommit)
@@ -3,14 +3,24 @@
 # [XMIN] [XMAX] [data]
 # XMIN 是创建该条记录(版本)的事务编号, 而 XMAX 则是删除该条记录(版本)的事务编号
 # DATA 就是这条记录持有的数据
+# XMIN 和 XMAX 的高位是提示位, 记下已经查到的创建者/删除者事务的最终状态, 之后判断可见性时不用再查询 TM
+# 提示位只是缓存, 不写日志, 丢失了只是重新查询一次; 设置 XMAX 时整个字段被覆盖, 提示位随之清除
+# 例外是冻结时写下的 XMIN 撤销提示位, 它随冻结的修改写日志, 事务状态从 xid 文件中截掉之后只能靠它判断
 
 import struct
 from backend.dm.dataItem.DataItem import DataItem
+from backend.tm.TransactionManager import SUPER_XID
 
 OF_XMIN = 0
 OF_XMAX = OF_XMIN + 8
 OF_DATA = OF_XMAX + 8
 
+# 提示位, xid 用不到这么高的位
+HINT_COMMITTED = 1 << 62
+HINT_ABORTED = 1 << 61
+HINT_MASK = HINT_COMMITTED | HINT_ABORTED
+XID_MASK = HINT_ABORTED - 1
+
 class Entry(object):
     def __init__(self, vm, dataItem: DataItem, uid: int):
         if dataItem == None:
@@ -30,26 +40,90 @@ class Entry(object):
         获取记录中持有的数据
         '''
         sa = self.dataItem.data()
-        data = sa.raw[sa.start + OF_DATA : sa.end]
+        # 页面可能是 mmap 上的切片, 复制一份交给上层
+        data = bytes(sa.raw[sa.start + OF_DATA : sa.end])
         return data
 
-    def getXmin(self) -> int:
+    def getHeader(self) -> tuple:
+        '''
+        一次读出 (XMIN, XMIN 的提示位, XMAX, XMAX 的提示位)
+        '''
         self.dataItem.rLock.acquire()
         try:
             sa = self.dataItem.data()
-            buf = sa.raw[sa.start + OF_XMIN : sa.start + OF_XMAX]
-            return struct.unpack('>q', buf)[0]
+            xmin, xmax = struct.unpack('>qq', sa.raw[sa.start + OF_XMIN : sa.start + OF_DATA])
         finally:
             self.dataItem.rLock.release()
-    
+        return (xmin & XID_MASK, xmin & HINT_MASK, xmax & XID_MASK, xmax & HINT_MASK)
+
+    def getXmin(self) -> int:
+        return self.getHeader()[0]
+
     def getXmax(self) -> int:
-        self.dataItem.rLock.acquire()
+        return self.getHeader()[2]
+
+    def setHint(self, offset: int, xid: int, hint: int) -> None:
+        '''
+        在 offset 处的 XMIN 或 XMAX 上记下事务 xid 的最终状态, 不写日志
+        字段已经被改成别的事务, 或者有线程正在修改这条记录时直接放弃, 下次判断时再设置
+        异步提交的日志落盘之前不记已提交, 否则崩溃后事务被撤销, 页面上的提示位却还在
+        '''
+        if hint == HINT_COMMITTED and not self.vm.dm.commitsFlushed():
+            return
+        if not self.dataItem.wLock.acquire(blocking = False):
+            return
         try:
             sa = self.dataItem.data()
-            buf = sa.raw[sa.start + OF_XMAX : sa.start + OF_DATA]
-            return struct.unpack('>q', buf)[0]
+            start = sa.start + offset
+            field = struct.unpack('>q', sa.raw[start : start + 8])[0]
+            if field & XID_MASK != xid or field & HINT_MASK != 0:
+                return
+            sa.raw[start : start + 8] = struct.pack('>q', field | hint)
+            self.dataItem.pg.setDirty(True)
         finally:
-            self.dataItem.rLock.release()
+            self.dataItem.wLock.release()
+
+    def freeze(self, tm, limit: int) -> bool:
+        '''
+        冻结这个版本, limit 之前的事务都已经结束, 并且对所有活跃事务的快照都可见
+        XMIN 是已提交的事务时改成超级事务, 是已撤销的事务时记上撤销提示位, XMAX 是已撤销的事务时清零, 修改由超级事务写日志
+        返回版本是否对所有事务都不可见: 由已撤销的事务创建, 或者被已提交的事务删除
+        '''
+        self.dataItem.before()
+        changed = False
+        dead = False
+        try:
+            sa = self.dataItem.data()
+            xmin, xmax = struct.unpack('>qq', sa.raw[sa.start + OF_XMIN : sa.start + OF_DATA])
+            xid = xmin & XID_MASK
+            # 先看提示位, 事务的状态被截掉之后 TM 把它当作已提交
+            if xid != SUPER_XID and xid < limit:
+                if xmin & HINT_ABORTED:
+                    dead = True
+                elif xmin & HINT_COMMITTED or tm.isCommitted(xid):
+                    sa.raw[sa.start + OF_XMIN : sa.start + OF_XMAX] = struct.pack('>q', SUPER_XID)
+                    changed = True
+                elif tm.isAborted(xid):
+                    # 不回收的版本要带着撤销提示位写日志, 截断之后仍然不可见
+                    sa.raw[sa.start + OF_XMIN : sa.start + OF_XMAX] = struct.pack('>q', xid | HINT_ABORTED)
+                    changed = True
+                    dead = True
+            xid = xmax & XID_MASK
+            if xid != SUPER_XID and xid < limit:
+                if xmax & HINT_ABORTED:
+                    sa.raw[sa.start + OF_XMAX : sa.start + OF_DATA] = struct.pack('>q', 0)
+                    changed = True
+                elif xmax & HINT_COMMITTED or tm.isCommitted(xid):
+                    dead = True
+                elif tm.isAborted(xid):
+                    sa.raw[sa.start + OF_XMAX : sa.start + OF_DATA] = struct.pack('>q', 0)
+                    changed = True
+        finally:
+            if changed:
+                self.dataItem.after(SUPER_XID)
+            else:
+                self.dataItem.unBefore()
+        return dead
 
     def setXmax(self, xid: int) -> None:
         self.dataItem.before()
@@ -68,6 +142,8 @@ def loadEntry(vm, uid: int) -> Entry:
     从 dm 读取 DataItem 构造为一个 Entry 
     '''
     di = vm.dm.read(uid)
+    if di == None:
+        return None
     return Entry(vm, di, uid)
 
 def wrapEntryRaw(xid: int, data: bytearray | bytes) -> bytearray | bytes:
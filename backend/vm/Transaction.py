@@ -1,22 +1,32 @@
 # vm对一个事务的抽象
-from backend.tm import TransactionManager
+from bisect import bisect_left
 
 class Transaction(object):
-    def __init__(self, xid: int, level: int, active: dict | None):
+    def __init__(self, xid: int, level: int, active: list | None, synchronousCommit: bool = True):
         self.xid = xid
         self.level = level
-        # 快照: 该事务在整个生命周期中能够看到的事务
-        self.snapshot = {}
+        # 为 False 时提交日志进入缓冲区就返回, 由刷盘线程在稍后写到磁盘上
+        self.synchronousCommit = synchronousCommit
+        # 快照: 开始时仍在进行的事务, 按 xid 升序排列, 都比 xid 小
+        # 快照对应的区间是 [xmin, xmax): xmin 之前的事务在开始时都已经结束, xmax 就是本事务, 之后的事务开始得更晚
+        self.snapshot = ()
         self.err = None
         self.autoAborted = False
-        if level != 0:
-            for x in active:
-                self.snapshot[x] = True
+        # 开始时最早的仍在进行的事务, 在它之前提交的删除对这个事务一定可见
+        # 读提交的事务也记下它, 这样 activeXids 中最早的事务的 xmin 就是所有活跃事务中最小的
+        self.xmin = active[0] if active else xid
+        self.xmax = xid
+        if level != 0 and active:
+            self.snapshot = tuple(active)
 
     def isInSnapshot(self, xid: int) -> bool:
-        if xid == TransactionManager.SUPER_XID:
+        '''
+        xid 在本事务开始时是否仍在进行, 区间之外的事务直接判断, 区间之内的二分查找
+        '''
+        if xid < self.xmin or xid >= self.xmax:
             return False
-        return self.snapshot.get(xid) != None
+        i = bisect_left(self.snapshot, xid)
+        return i < len(self.snapshot) and self.snapshot[i] == xid
 
-def newTransaction(xid: int, level: int, active: bool) -> Transaction:
-    return Transaction(xid, level, active)
+def newTransaction(xid: int, level: int, active: list | None, synchronousCommit: bool = True) -> Transaction:
+    return Transaction(xid, level, active, synchronousCommit)
@@ -3,6 +3,8 @@
 删除的操作只有一个设置 XMAX
 '''
 import threading
+from bisect import bisect_left
+from typing import Callable
 import backend.tm
 import backend.tm.TransactionManager
 import backend.vm.Entry
@@ -15,25 +17,37 @@ from backend.vm.Entry import Entry
 from backend.common.AbstractCache import AbstractClass
 
 class VersionManager(AbstractClass):
-    def __init__(self, tm: TransactionManager, dm: DataManager):
+    def __init__(self, tm: TransactionManager, dm: DataManager, synchronousCommit: bool = True):
         super().__init__(0)
         self.tm = tm
         self.dm = dm
+        # 开启事务时没有指定时使用的提交方式
+        self.synchronousCommit = synchronousCommit
         self.activeTransaction = {}
-        self.activeTransaction[backend.tm.TransactionManager.SUPER_XID] = newTransaction(backend.tm.TransactionManager.SUPER_XID, 0, None)
+        # 超级事务不会结束, 也是单条只读语句使用的虚拟事务
+        self.superTransaction = newTransaction(backend.tm.TransactionManager.SUPER_XID, 0, None)
+        self.activeTransaction[backend.tm.TransactionManager.SUPER_XID] = self.superTransaction
+        # 仍在进行的事务, 按 xid 升序排列, 新事务的 xid 总是最大的, 开始时追加到末尾
+        # 可重复读事务的快照直接复制它; 事务的最终状态写入 TM 之后才移除, 自动撤销的事务也随之移除
+        # 其中的事务都还在 activeTransaction 中, 结束的事务在移出 activeXids 时一起移出
+        self.activeXids = []
         self.lock = threading.RLock()
         self.lt = LockTable()
 
-    def begin(self, level: int) -> int:
+    def begin(self, level: int, synchronousCommit: bool | None = None) -> int:
         '''
         开启一个事务并初始化事务的结构
-        将其存放在 activeTransaction 中, 用于检查和快照使用
+        将其存放在 activeTransaction 中用于检查, 并追加到 activeXids 中用于快照
+        synchronousCommit 为 False 时提交不等待提交日志落盘, 为 None 时使用默认设置
         '''
+        if synchronousCommit is None:
+            synchronousCommit = self.synchronousCommit
         self.lock.acquire()
         try:
             xid = self.tm.begin()
-            t = newTransaction(xid, level, self.activeTransaction)
+            t = newTransaction(xid, level, self.activeXids, synchronousCommit)
             self.activeTransaction[xid] = t
+            self.activeXids.append(xid)
             return xid
         finally:
             self.lock.release()
@@ -47,36 +61,117 @@ class VersionManager(AbstractClass):
         self.lock.release()
         if t.err != None:
             raise t.err
-        self.lock.acquire()
-        self.activeTransaction.pop(xid, None)
-        self.lock.release()
+        # 等待提交日志落盘, 落盘之前事务仍持有它的锁; 异步提交只把提交日志写入缓冲区
+        # 之后由 DM 通知事务管理器事务已提交
+        self.dm.commit(xid, t.synchronousCommit)
         # 清理该事务持有的所有锁
         self.lt.remove(xid)
-        # 通知事务管理器事务已提交
-        self.tm.commit(xid)
+        self.removeActiveXid(xid)
 
-    def read(self, xid: int, uid: int) -> None | bytearray | bytes:
+    def removeActiveXid(self, xid: int, finished: bool = True) -> None:
         '''
-        读取并判断 entry 对事务的可见性
+        事务的最终状态写入 TM 之后, 之后开始的事务不再把它放进快照
+        finished 为 True 时同时移出 activeTransaction; 自动撤销的事务还要留着它的错误, 等手动 abort 时再移出
         '''
         self.lock.acquire()
-        t = self.activeTransaction[xid]
-        self.lock.release()
+        try:
+            if finished:
+                self.activeTransaction.pop(xid, None)
+            i = bisect_left(self.activeXids, xid)
+            if i < len(self.activeXids) and self.activeXids[i] == xid:
+                del self.activeXids[i]
+        finally:
+            self.lock.release()
+
+    def read(self, xid: int, uid: int, onFree: Callable | None = None) -> None | bytearray | bytes:
+        '''
+        读取并判断 entry 对事务的可见性, 不可见的版本已经对所有事务都不可见时顺便回收, onFree 见 prune
+        超级事务按读提交读取, 不在活跃事务表中加锁查找
+        超级事务也不回收版本: 只读语句不拿 VM 的锁计算 horizon, 也不写释放日志, 回收留给读写事务和冻结线程
+        '''
+        if xid == backend.tm.TransactionManager.SUPER_XID:
+            t = self.superTransaction
+        else:
+            self.lock.acquire()
+            t = self.activeTransaction[xid]
+            self.lock.release()
         if t.err != None:
             raise t.err
         entry = None
         try:
             entry = super().get(uid)
         except Exception as e:
-            if e == Exception("NullEntryException"):
+            if str(e) == "NullEntryException":
                 return None
             else:
                 raise e
         try:
             if backend.vm.Visibility.isVisible(self.tm, t, entry) == True:
                 return entry.data()
-            else:
+            if xid != backend.tm.TransactionManager.SUPER_XID:
+                self.prune(entry, onFree)
+            return None
+        finally:
+            entry.release()
+
+    def prune(self, entry: Entry, onFree: Callable | None = None) -> None:
+        '''
+        版本对所有事务都不再可见时, 交给 DM 回收它占用的空间
+        onFree 不为 None 时先用版本的数据调用它, 由上层回收版本拥有的其它空间, 例如行外存储的块
+        '''
+        if backend.vm.Visibility.isDead(self.tm, entry, self.horizon()):
+            self.reclaim(entry, onFree)
+
+    def reclaim(self, entry: Entry, onFree: Callable | None) -> None:
+        '''
+        先回收版本拥有的空间再回收版本本身, 中途崩溃时版本还在, 之后会被再次回收
+        '''
+        if onFree != None:
+            onFree(entry.data())
+        self.dm.free(entry.dataItem)
+
+    def horizon(self) -> int | None:
+        '''
+        所有活跃事务中最早可能看到的事务, 早于它提交的删除对所有事务都可见, 没有活跃事务时返回 None
+        每个事务的 xmin 是它开始时最早的活跃事务, activeXids 中最早的事务的 xmin 不会大于其它活跃事务的, 不需要扫描所有事务
+        '''
+        self.lock.acquire()
+        try:
+            if len(self.activeXids) == 0:
                 return None
+            return self.activeTransaction[self.activeXids[0]].xmin
+        finally:
+            self.lock.release()
+
+    def freezeLimit(self) -> int:
+        '''
+        可以冻结的事务上限, 比它早的事务都已经结束, 并且对所有活跃事务的快照都可见
+        activeXids 中的事务直到最终状态写入 TM 之后才移除, 正在提交或撤销的事务也不会被冻结
+        '''
+        self.lock.acquire()
+        try:
+            horizon = self.horizon()
+            if horizon == None:
+                return self.tm.xidCounter + 1
+            return horizon
+        finally:
+            self.lock.release()
+
+    def freeze(self, uid: int, limit: int, reclaim: bool = True, onFree: Callable | None = None) -> None:
+        '''
+        冻结 uid 处的版本, 版本已经对所有事务都不可见并且 reclaim 为 True 时回收, onFree 见 prune
+        '''
+        entry = None
+        try:
+            entry = super().get(uid)
+        except Exception as e:
+            if str(e) == "NullEntryException":
+                return
+            else:
+                raise e
+        try:
+            if entry.freeze(self.tm, limit) and reclaim:
+                self.reclaim(entry, onFree)
         finally:
             entry.release()
 
@@ -105,7 +200,7 @@ class VersionManager(AbstractClass):
         try:
             entry = super().get(uid)
         except Exception as e:
-            if e == Exception("NullEntryException"):
+            if str(e) == "NullEntryException":
                 return False
             else:
                 raise e
@@ -149,14 +244,16 @@ class VersionManager(AbstractClass):
         '''
         self.lock.acquire()
         t = self.activeTransaction[xid]
-        if autoAborted == False:
+        if t.autoAborted == True and autoAborted == False:
             self.activeTransaction.pop(xid, None)
         self.lock.release()
-        # 事务不从 activeTransaction 中移除, 因为这可能影响其他事务的快照
+        # 自动撤销的事务留在 activeTransaction 中, 之后的操作和手动 abort 还要读到它的错误
+        # 它已经被 TM 标记为撤销, 不论是否在快照中都不可见, 所以不会留在 activeXids 中
         if t.autoAborted == True:
             return
         self.lt.remove(xid)
-        self.tm.abort(xid)
+        self.dm.abort(xid)
+        self.removeActiveXid(xid, autoAborted == False)
 
     def releaseEntry(self, entry):
         super().release(entry.uid)
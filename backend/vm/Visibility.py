@@ -13,19 +13,54 @@ XMIN 应当在版本创建时填写, 而 XMAX 则在版本被删除, 或者有
 每个事务都只能看到其他 committed 的事务所产生的数据
 一个 aborted 事务产生的数据就不会对其他事务产生任何影响了,也就相当于这个事务不曾存在过
 '''
+'''
+XMIN 和 XMAX 上的提示位记下了已经查到的事务最终状态, 判断时先看提示位, 没有时才查询 TM 并设置提示位
+'''
 from backend.vm.Transaction import Transaction
-from backend.tm.TransactionManager import TransactionManager
-from backend.vm.Entry import Entry
+from backend.tm.TransactionManager import TransactionManager, SUPER_XID, FIELD_TRAN_COMMITTED, FIELD_TRAN_ABORTED
+from backend.vm.Entry import Entry, OF_XMIN, OF_XMAX, HINT_COMMITTED, HINT_ABORTED
+
+def isCommitted(tm: TransactionManager, e: Entry, offset: int, xid: int, hint: int) -> bool:
+    '''
+    记录中 offset 处的事务 xid 是否已提交, hint 是这个字段上的提示位
+    '''
+    if xid == SUPER_XID or hint & HINT_COMMITTED:
+        return True
+    if hint & HINT_ABORTED:
+        return False
+    status = tm.getStatus(xid)
+    if status == FIELD_TRAN_COMMITTED:
+        e.setHint(offset, xid, HINT_COMMITTED)
+        return True
+    if status == FIELD_TRAN_ABORTED:
+        e.setHint(offset, xid, HINT_ABORTED)
+    return False
+
+def isAborted(tm: TransactionManager, e: Entry, offset: int, xid: int, hint: int) -> bool:
+    '''
+    记录中 offset 处的事务 xid 是否已撤销, hint 是这个字段上的提示位
+    '''
+    if xid == SUPER_XID:
+        return False
+    if hint != 0:
+        return hint & HINT_ABORTED != 0
+    status = tm.getStatus(xid)
+    if status == FIELD_TRAN_ABORTED:
+        e.setHint(offset, xid, HINT_ABORTED)
+        return True
+    if status == FIELD_TRAN_COMMITTED:
+        e.setHint(offset, xid, HINT_COMMITTED)
+    return False
+
 def isVeresionSkip(tm: TransactionManager, t: Transaction, e: Entry) -> bool:
     '''
     版本跳跃的检查:
     取出要修改的数据 X 的最新提交版本, 并检查该最新版本的创建者对当前事务是否可见
     '''
-    xmax = e.getXmax()
     if t.level == 0:
         return False
-    else:
-        return tm.isCommitted(xmax) and (xmax > t.xid or t.isInSnapshot(xmax))
+    _, _, xmax, xmaxHint = e.getHeader()
+    return isCommitted(tm, e, OF_XMAX, xmax, xmaxHint) and (xmax > t.xid or t.isInSnapshot(xmax))
 
 def isVisible(tm: TransactionManager, t: Transaction, e: Entry) -> bool:
     if t.level == 0:
@@ -41,15 +76,14 @@ def readCommitted(tm: TransactionManager, t: Transaction, e: Entry) -> bool:
     这样的事务对 Ti 可见
     '''
     xid = t.xid
-    xmin = e.getXmin()
-    xmax = e.getXmax()
+    xmin, xminHint, xmax, xmaxHint = e.getHeader()
     if xmin == xid and xmax == 0:
         return True
-    if tm.isCommitted(xmin):
+    if isCommitted(tm, e, OF_XMIN, xmin, xminHint):
         if xmax == 0:
             return True
         if xmax != xid:
-            if not tm.isCommitted(xmax):
+            if not isCommitted(tm, e, OF_XMAX, xmax, xmaxHint):
                 return True
     return False
 
@@ -66,14 +100,27 @@ def repeatableRead(tm: TransactionManager, t: Transaction, e: Entry) -> bool:
     (尚未被删除或(由其他事务删除且(这个事务尚未提交或这个事务在 Ti 开始之后才开始或这个事务在 Ti 开始前还未提交)))
     '''
     xid = t.xid
-    xmin = e.getXmin()
-    xmax = e.getXmax()
+    xmin, xminHint, xmax, xmaxHint = e.getHeader()
     if xmin == xid and xmax == 0:
         return True
-    if tm.isCommitted(xmin) and xmin < xid and t.isInSnapshot(xmin) == False:
+    if isCommitted(tm, e, OF_XMIN, xmin, xminHint) and xmin < xid and t.isInSnapshot(xmin) == False:
         if xmax == 0:
             return True
         if xmax != xid:
-            if tm.isCommitted(xmax) == False or xmax >xid or t.isInSnapshot(xmax):
+            if isCommitted(tm, e, OF_XMAX, xmax, xmaxHint) == False or xmax >xid or t.isInSnapshot(xmax):
                 return True
-    return False
\ No newline at end of file
+    return False
+
+def isDead(tm: TransactionManager, e: Entry, horizon: int | None) -> bool:
+    '''
+    版本对所有事务都不再可见, 可以被回收:
+    由一个已撤销的事务创建
+    或
+    由一个已提交的事务删除, 且这个事务比所有活跃事务的快照都早(horizon 为 None 表示没有活跃事务)
+    '''
+    xmin, xminHint, xmax, xmaxHint = e.getHeader()
+    if isAborted(tm, e, OF_XMIN, xmin, xminHint):
+        return True
+    if xmax == 0 or not isCommitted(tm, e, OF_XMAX, xmax, xmaxHint):
+        return False
+    return horizon == None or xmax < horizon